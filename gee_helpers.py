@@ -79,10 +79,10 @@ def generateFromToExpression(landclasses):
     """
     output = ""
     from_to_labels = {"No Change": 0}
-    for form_value_key in land_classes:
-        from_value = land_classes[form_value_key]
-        for to_value_key in land_classes:
-            to_value = land_classes[to_value_key]
+    for form_value_key in landclasses:
+        from_value = landclasses[form_value_key]
+        for to_value_key in landclasses:
+            to_value = landclasses[to_value_key]
             if from_value != to_value:
                 change_class_value = str(from_value) + str(to_value)
                 change_class_key = "%s to %s" % (form_value_key, to_value_key)
@@ -103,13 +103,118 @@ def generateThematicChangeImage(from_image, to_image, expression):
     return change_image
 
 
+def compileFromToRemap(landclasses):
+    """
+    Compiles the land class dictionary into a remap table of the
+    composite key from * base + to (base = largest class value + 1),
+    replacing the ternary chain of generateFromToExpression (one branch
+    per class pair) with one lookup per pixel.
+    @param landclasses land_class dictionary
+    @return dictionary of labels (as generateFromToExpression), base,
+            keys and values (ee.Image.remap lists), lut (NumPy lookup
+            table indexed by the composite key)
+    """
+    import numpy as np
+    base = max(landclasses.values()) + 1
+    from_to_labels = {"No Change": 0}
+    keys, values = [], []
+    for from_key, from_value in landclasses.items():
+        for to_key, to_value in landclasses.items():
+            if from_value != to_value:
+                change_class_value = str(from_value) + str(to_value)
+                from_to_labels["%s to %s" % (from_key, to_key)] = change_class_value
+                keys.append(from_value * base + to_value)
+                values.append(int(change_class_value))
+    lut = np.zeros(base * base, dtype="int32")
+    lut[keys] = values
+    return {"labels": from_to_labels, "base": base, "keys": keys, "values": values, "lut": lut}
+
+
+def generateThematicChangeImageRemap(from_image, to_image, compiled):
+    """
+    Server-side thematic change image from a compileFromToRemap table,
+    same codes as generateThematicChangeImage (0 = no change).
+    """
+    key = from_image.select("classification").multiply(compiled["base"]).add(to_image.select("classification"))
+    return key.remap(compiled["keys"], compiled["values"], 0).rename("constant")
+
+
+def thematicChangeLocal(from_array, to_array, compiled):
+    """
+    Thematic change of two classified NumPy arrays from a
+    compileFromToRemap table. Cells outside the classes (or NaN) are 0.
+    """
+    import numpy as np
+    from_array, to_array = np.asarray(from_array), np.asarray(to_array)
+    base = compiled["base"]
+    valid = (from_array >= 0) & (from_array < base) & (to_array >= 0) & (to_array < base)
+    key = np.where(valid, from_array, 0).astype("int64") * base + np.where(valid, to_array, 0).astype("int64")
+    return np.where(valid, compiled["lut"][key], 0)
+
+
+def benchmarkFromToCompilers(landclasses, size=2000, repeat=3, from_image=None, to_image=None, region=None, scale=30):
+    """
+    Times the ternary chain of generateFromToExpression against the
+    remap table of compileFromToRemap.
+    Locally on random size x size class arrays (the chain evaluated
+    branch by branch as the expression does), and on Earth Engine when
+    from_image, to_image and region are given (frequency histogram of
+    the change image, which also checks both give the same codes).
+    @return DataFrame of seconds per method
+    """
+    import time
+    import numpy as np
+    compiled = compileFromToRemap(landclasses)
+    classes = np.array(list(landclasses.values()))
+    rng = np.random.default_rng(1)
+    from_array = rng.choice(classes, (size, size))
+    to_array = np.where(rng.random((size, size)) < 0.1, rng.choice(classes, (size, size)), from_array)
+
+    def ternary():
+        result = np.zeros(from_array.shape, dtype="int32")
+        # The first matching branch wins, so apply them last to first
+        for key, value in zip(compiled["keys"][::-1], compiled["values"][::-1]):
+            result = np.where((from_array == key // compiled["base"]) & (to_array == key % compiled["base"]), value, result)
+        return result
+
+    def timed(func):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            out = func()
+        return (time.perf_counter() - start) / repeat, out
+
+    rows = []
+    ternary_time, ternary_out = timed(ternary)
+    remap_time, remap_out = timed(lambda: thematicChangeLocal(from_array, to_array, compiled))
+    mismatched = int((ternary_out != remap_out).sum())
+    if mismatched:
+        raise ValueError("Ternary and remap change codes differ in %d of %d cells" % (mismatched, ternary_out.size))
+    rows.append({"engine": "numpy", "method": "ternary", "seconds": ternary_time})
+    rows.append({"engine": "numpy", "method": "remap", "seconds": remap_time})
+
+    if from_image is not None:
+        expression = generateFromToExpression(landclasses)["expression"]
+        images = {
+            "ternary": lambda: generateThematicChangeImage(from_image, to_image, expression),
+            "remap": lambda: generateThematicChangeImageRemap(from_image, to_image, compiled),
+        }
+        histograms = {}
+        for method, image in images.items():
+            def histogram():
+                return image().reduceRegion(
+                    reducer=ee.Reducer.frequencyHistogram(), geometry=region, scale=scale, maxPixels=1e12).getInfo()
+            seconds, histograms[method] = timed(histogram)
+            rows.append({"engine": "earthengine", "method": method, "seconds": seconds})
+        if histograms["ternary"] != histograms["remap"]:
+            print("Warning: ternary and remap change images differ")
+    return pd.DataFrame(rows)
+
+
 def getNewBandNames(prefix, bandNames):
     """
     This helper function returns a list of new band names.
     """
-    seq = ee.List.sequence(1, len(bandNames))
-    z = [prefix + str(ee.Number(b).int().getInfo()) for b in seq.getInfo()]
-    return z
+    return [prefix + str(b) for b in range(1, len(bandNames) + 1)]
 
 
 def getPrincipalComponents(centered, scale, region):
@@ -164,6 +269,145 @@ def getPrincipalComponents(centered, scale, region):
     return pc
 
 
+def _readBandChunks(source, chunkRows=512):
+    """
+    Yields (block, start) blocks of rows of all bands of a 3D array
+    (bands, rows, cols) or a multi-band GeoTIFF as float arrays, no
+    data cells are NaN.
+    @param source : 3D NumPy array or GeoTIFF file location
+    @param chunkRows : rows per chunk (Default = 512)
+    """
+    import numpy as np
+    if isinstance(source, str):
+        try:
+            import rasterio
+            from rasterio.windows import Window
+        except ImportError:
+            raise ImportError("Reading GeoTIFFs requires rasterio (pip install rasterio)")
+        with rasterio.open(source) as src:
+            for r in range(0, src.height, chunkRows):
+                window = Window(0, r, src.width, min(chunkRows, src.height - r))
+                yield src.read(window=window, masked=True).astype("float64").filled(np.nan), r
+    else:
+        array = np.asarray(source)
+        for r in range(0, array.shape[1], chunkRows):
+            yield array[:, r:r + chunkRows].astype("float64"), r
+
+
+def _mapChunks(func, chunks, nprocs=4):
+    """
+    Maps func over chunks in nprocs threads with at most 2 * nprocs
+    chunks read ahead (Executor.map would read all chunks at once).
+    """
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=nprocs) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(func, chunk))
+            if len(pending) >= 2 * nprocs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _covariancePartial(block):
+    """
+    Count, band means and co-moment matrix of the pixels of a block
+    (bands, rows, cols) with values in all bands.
+    """
+    import numpy as np
+    pixels = block.reshape(block.shape[0], -1).T
+    pixels = pixels[~np.isnan(pixels).any(axis=1)]
+    if not len(pixels):
+        return 0, np.zeros(block.shape[0]), np.zeros((block.shape[0],) * 2)
+    mean = pixels.mean(axis=0)
+    centered = pixels - mean
+    return len(pixels), mean, centered.T @ centered
+
+
+def _mergeCovariance(a, b):
+    """
+    Merges two (count, mean, co-moment) partials (Chan et al.), so the
+    partials of tiles can be summed in any order.
+    """
+    na, meanA, comA = a
+    nb, meanB, comB = b
+    n = na + nb
+    if not n:
+        return a
+    delta = meanB - meanA
+    mean = meanA + delta * nb / n
+    comoment = comA + comB + (delta[:, None] * delta[None, :]) * na * nb / n
+    return n, mean, comoment
+
+
+def getPrincipalComponentsLocal(source, output=None, chunkRows=512, nprocs=4):
+    """
+    Local version of getPrincipalComponents for a 3D NumPy array
+    (bands, rows, cols) or a multi-band GeoTIFF (needs rasterio), e.g.
+    a multi-date PlanetScope stack.
+
+    The band covariance is accumulated chunk by chunk from partials
+    merged in any order (chunks run in nprocs threads), then the chunks
+    are projected onto the eigenvectors and normalized by the SDs into
+    a memory-mapped output, so memory does not grow with the scene.
+    Bands are centered on their means (no need to center beforehand).
+    @param source : 3D NumPy array or GeoTIFF file location
+    @param output : .npy file of the principal components, a temporary
+                    file if None
+    @param chunkRows : rows per chunk (Default = 512)
+    @param nprocs : chunks processed at once (Default = 4)
+    @return dictionary of pc (memory-mapped array (bands, rows, cols)),
+            bandNames, eigenValues, eigenVectors (in rows) and mean
+    """
+    import tempfile
+    from functools import reduce
+    import numpy as np
+
+    if isinstance(source, str):
+        try:
+            import rasterio
+        except ImportError:
+            raise ImportError("Reading GeoTIFFs requires rasterio (pip install rasterio)")
+        with rasterio.open(source) as src:
+            shape = (src.count, src.height, src.width)
+    else:
+        shape = np.shape(source)
+
+    partials = _mapChunks(lambda chunk: _covariancePartial(chunk[0]), _readBandChunks(source, chunkRows), nprocs)
+    empty = (0, np.zeros(shape[0]), np.zeros((shape[0], shape[0])))
+    count, mean, comoment = reduce(_mergeCovariance, partials, empty)
+    if count < 2:
+        raise ValueError("Fewer than two pixels with values in all bands in %s" % source)
+    covariance = comoment / (count - 1)
+    eigenValues, eigenVectors = np.linalg.eigh(covariance)
+    order = np.argsort(eigenValues)[::-1]
+    eigenValues, eigenVectors = eigenValues[order], eigenVectors[:, order].T
+    sd = np.sqrt(np.clip(eigenValues, 0, None))
+    sd[sd == 0] = np.nan
+
+    if output is None:
+        output = tempfile.NamedTemporaryFile(suffix=".npy", delete=False).name
+    pc = np.lib.format.open_memmap(output, mode="w+", dtype="float32", shape=shape)
+
+    def project(chunk):
+        block, start = chunk
+        pixels = block.reshape(shape[0], -1) - mean[:, None]
+        pc[:, start:start + block.shape[1]] = ((eigenVectors @ pixels) / sd[:, None]).reshape(block.shape)
+
+    for _ in _mapChunks(project, _readBandChunks(source, chunkRows), nprocs):
+        pass
+    pc.flush()
+    return {
+        "pc": pc,
+        "bandNames": getNewBandNames("pc", range(shape[0])),
+        "eigenValues": eigenValues,
+        "eigenVectors": eigenVectors,
+        "mean": mean,
+    }
+
+
 def createConfusionMatixFigure(testAccuracy, label=""):
     fig, ax = plt.subplots(figsize=(9, 6))
     df_confusion_test = pd.DataFrame(testAccuracy.getInfo(), index=list(land_classes.keys()), columns=list(land_classes.keys()))
@@ -172,8 +416,188 @@ def createConfusionMatixFigure(testAccuracy, label=""):
     plt.savefig(os.path.join(figures_save_location,label + "_ConfMatrix"))
     
     
-def exportEarthEngineImage(image, desc, imageName, region,scale=3, saveLocation="GoogleDrive"):
-    import time
+class EarthEngineTaskClient:
+    """
+    Starts Earth Engine export tasks and reads the states of the active
+    ones with one request (ee.data.getTaskStatus).
+    """
+
+    def start(self, task):
+        task.start()
+        return task.id
+
+    def statuses(self, taskIds):
+        """
+        @param taskIds : ids of the tasks to look up
+        @return dictionary of task id : status dictionary ('state', ...)
+        """
+        if not taskIds:
+            return {}
+        return {t["id"]: t for t in ee.data.getTaskStatus(list(taskIds))}
+
+    def cancel(self, taskId):
+        ee.data.cancelTask(taskId)
+
+
+class FakeTaskClient:
+    """
+    Local stand-in for EarthEngineTaskClient for testing. A task is any
+    object, it completes after polls status requests (or fails if its
+    name is in fail).
+    """
+
+    def __init__(self, polls=2, fail=()):
+        self.polls = polls
+        self.fail = set(fail)
+        self.tasks = {}
+
+    def start(self, task):
+        taskId = "FAKE%d" % len(self.tasks)
+        self.tasks[taskId] = {"task": task, "polls": 0, "state": "RUNNING"}
+        return taskId
+
+    def statuses(self, taskIds):
+        result = {}
+        for taskId in taskIds:
+            task = self.tasks[taskId]
+            task["polls"] += 1
+            if task["state"] == "RUNNING" and task["polls"] >= self.polls:
+                task["state"] = "FAILED" if task["task"] in self.fail else "COMPLETED"
+            result[taskId] = {"id": taskId, "state": task["state"], "error_message": "fake failure"}
+        return result
+
+    def cancel(self, taskId):
+        self.tasks[taskId]["state"] = "CANCELLED"
+
+
+class ExportTaskManager:
+    """
+    Submits many export tasks and polls them together in a background
+    thread, so the notebook is not blocked while they run.
+
+    Each submitted task gets a concurrent.futures.Future that resolves
+    to its final status (or raises for failed and cancelled tasks), and
+    events() yields the tasks as they finish. The poll interval grows by
+    backoff while no task changes state, up to maxInterval.
+
+    Example:
+        manager = ExportTaskManager()
+        for name, image in images.items():
+            exportEarthEngineImage(image, name, name, aoi, wait=False, manager=manager)
+        for event in manager.events():
+            print(event["name"], event["state"])
+    """
+
+    DONE = ("COMPLETED", "FAILED", "CANCELLED", "CANCEL_REQUESTED")
+
+    def __init__(self, client=None, interval=3, maxInterval=60, backoff=1.5):
+        """
+        @param client : task client with start, statuses and cancel
+                        (Default = EarthEngineTaskClient())
+        @param interval : first poll interval in seconds (Default = 3)
+        @param maxInterval : longest poll interval in seconds (Default = 60)
+        @param backoff : interval growth while nothing changes (Default = 1.5)
+        """
+        import queue
+        import threading
+        self.client = client or EarthEngineTaskClient()
+        self.interval = interval
+        self.maxInterval = maxInterval
+        self.backoff = backoff
+        self.tasks = {}
+        self.finished = queue.Queue()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+
+    def submit(self, task, name=None):
+        """
+        Starts a task and returns its future.
+        @param task : export task (e.g. ee.batch.Export.image.toDrive(...))
+        @param name : label used in the events (Default = task id)
+        """
+        from concurrent.futures import Future
+        import threading
+        taskId = self.client.start(task)
+        future = Future()
+        future.taskId = taskId
+        with self.lock:
+            self.tasks[taskId] = {"name": name or taskId, "future": future, "state": "READY"}
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._poll, daemon=True)
+                self.thread.start()
+        self.wake.set()
+        print("Started task %s (id: %s)." % (name or taskId, taskId))
+        return future
+
+    def cancel(self, future):
+        self.client.cancel(future.taskId)
+        self.wake.set()
+
+    def _poll(self):
+        interval = self.interval
+        while True:
+            with self.lock:
+                active = [t for t in self.tasks if self.tasks[t]["state"] not in self.DONE]
+                if not active:
+                    # Under the lock, so submit starts a new thread
+                    self.thread = None
+                    return
+            statuses = self.client.statuses(active)
+            changed = False
+            for taskId, status in statuses.items():
+                task = self.tasks[taskId]
+                if status["state"] == task["state"]:
+                    continue
+                changed = True
+                task["state"] = status["state"]
+                if status["state"] not in self.DONE:
+                    continue
+                event = {"name": task["name"], "id": taskId, "state": status["state"], "status": status}
+                if status["state"] == "COMPLETED":
+                    task["future"].set_result(status)
+                else:
+                    task["future"].set_exception(RuntimeError(
+                        "Export %s %s: %s" % (task["name"], status["state"].lower(), status.get("error_message", ""))))
+                self.finished.put(event)
+            interval = self.interval if changed else min(interval * self.backoff, self.maxInterval)
+            self.wake.wait(interval)
+            self.wake.clear()
+
+    def events(self, timeout=None):
+        """
+        Yields a dictionary (name, id, state, status) per task as it
+        finishes, until all submitted tasks are done.
+        """
+        import queue
+        while True:
+            with self.lock:
+                pending = sum(not t["future"].done() for t in self.tasks.values())
+            if not pending and self.finished.empty():
+                return
+            try:
+                yield self.finished.get(timeout=timeout)
+            except queue.Empty:
+                return
+
+    def wait(self):
+        """
+        Blocks until all submitted tasks are done.
+        @return dictionary of task name : final state
+        """
+        from concurrent.futures import wait
+        wait([t["future"] for t in self.tasks.values()])
+        return {t["name"]: t["state"] for t in self.tasks.values()}
+
+
+def exportEarthEngineImage(image, desc, imageName, region,scale=3, saveLocation="GoogleDrive", wait=True, manager=None):
+    """
+    Exports an image to Google Drive, Cloud Storage or an asset.
+    @param wait : block until the export is done (Default = True)
+    @param manager : ExportTaskManager that polls the task, e.g. shared
+                     by many exports with wait=False
+    @return future of the export task (see ExportTaskManager)
+    """
     if (saveLocation == "CloudStorage"):
         imageTask = ee.batch.Export.image.toCloudStorage(
           image=image,
@@ -213,12 +637,13 @@ def exportEarthEngineImage(image, desc, imageName, region,scale=3, saveLocation=
         )
     else:
         print("Unknown Save Location, must be either 'GoogleDrive','CloudStorage', or 'Asset")
-        exit
-        
-    imageTask.start()
-    while imageTask.active():
-        print('Polling for task (id: {}).'.format(imageTask.id))
-        time.sleep(3)
+        return None
+
+    manager = manager or ExportTaskManager()
+    future = manager.submit(imageTask, imageName)
+    if wait:
+        future.result()
+    return future
 
 
 def exportToDrive(image, imageLabel, resolution=30):
@@ -454,3 +879,230 @@ def detectOutlires(image, band, region, scale=3):
 
     # Display the map.
     display(myMap)  
+
+
+def _readChunks(source, chunkRows=1024, halo=0, band=1):
+    """
+    Yields blocks of rows of a 2D array or a GeoTIFF band as float
+    arrays with halo extra rows above and below (where available).
+    block[start:stop] are the rows of the chunk. No data cells are NaN.
+    @param source : 2D NumPy array or GeoTIFF file location
+    @param chunkRows : rows per chunk (Default = 1024)
+    @param halo : extra rows read around each chunk (Default = 0)
+    @param band : GeoTIFF band number (Default = 1)
+    """
+    import numpy as np
+    if isinstance(source, str):
+        try:
+            import rasterio
+            from rasterio.windows import Window
+        except ImportError:
+            raise ImportError("Reading GeoTIFFs requires rasterio (pip install rasterio)")
+        with rasterio.open(source) as src:
+            rows, cols = src.height, src.width
+            for r in range(0, rows, chunkRows):
+                r0, r1 = max(0, r - halo), min(rows, r + chunkRows + halo)
+                block = src.read(band, window=Window(0, r0, cols, r1 - r0), masked=True)
+                yield block.astype("float64").filled(np.nan), r - r0, min(rows, r + chunkRows) - r0
+    else:
+        array = np.asarray(source)
+        rows = array.shape[0]
+        for r in range(0, rows, chunkRows):
+            r0, r1 = max(0, r - halo), min(rows, r + chunkRows + halo)
+            yield array[r0:r1].astype("float64"), r - r0, min(rows, r + chunkRows) - r0
+
+
+def _boxSum(a, radius):
+    """
+    Sum of the (2 radius + 1) square window around each cell from an
+    integral image, cells outside the array count as 0.
+    """
+    import numpy as np
+    size = 2 * radius + 1
+    integral = np.pad(a, radius).cumsum(0).cumsum(1)
+    integral = np.pad(integral, ((1, 0), (1, 0)))
+    return (integral[size:, size:] - integral[:-size, size:]
+            - integral[size:, :-size] + integral[:-size, :-size])
+
+
+def _gearysC(block, kernelSize=9):
+    """
+    Local Geary's C of each cell, the sum of the squared differences to
+    the cells of the kernelSize x kernelSize window divided by
+    kernelSize**2, as in detectOutlires.
+
+    The sum is expanded to n x**2 - 2 x S1 + S2 with the window count n,
+    sum S1 and sum of squares S2 taken from box filters, so the window
+    is never expanded into kernelSize**2 bands.
+    """
+    import numpy as np
+    radius = kernelSize // 2
+    valid = ~np.isnan(block)
+    # Differences do not change with a shift, which keeps the squares small
+    shift = block[valid].mean() if valid.any() else 0.0
+    x = np.where(valid, block - shift, 0.0)
+    n = _boxSum(valid.astype("float64"), radius)
+    s1 = _boxSum(x, radius)
+    s2 = _boxSum(x * x, radius)
+    gearys = (n * x * x - 2 * x * s1 + s2) / kernelSize**2
+    return np.where(valid, gearys, np.nan)
+
+
+def _weightedPercentile(values, weights, q):
+    """
+    Percentile q (0-100) of values with weights (e.g. histogram bin
+    centers and counts).
+    """
+    import numpy as np
+    order = np.argsort(values)
+    cumulative = np.cumsum(weights[order])
+    if cumulative[-1] == 0:
+        return float("nan")
+    index = np.searchsorted(cumulative, q / 100.0 * cumulative[-1])
+    return float(values[order][min(index, len(values) - 1)])
+
+
+def _zScoreModLocal(values, stats):
+    """
+    Modified z-score of values from the statistics of
+    detectOutliresLocal. When more than half of the cells share one
+    value the median absolute deviation is 0 and 1.253314 times the
+    mean absolute deviation is used instead; when that is 0 too (a
+    constant image) the score is undefined (NaN, never an outlier).
+    """
+    import numpy as np
+    values = np.asarray(values, dtype="float64")
+    if stats["medianMedAbsDev"] > 0:
+        scale = stats["medianMedAbsDev"] / 0.6745
+    elif stats.get("meanAbsDev", 0) > 0:
+        scale = 1.253314 * stats["meanAbsDev"]
+    else:
+        return np.full(values.shape, np.nan)
+    return np.abs(values - stats["mean"]) / scale
+
+
+def detectOutliresLocal(source, band=1, chunkRows=1024, bins=65536, kernelSize=9):
+    """
+    Local version of detectOutlires for a 2D NumPy array or a GeoTIFF
+    (needs rasterio). Computes the Tukey fences, z-score, modified
+    z-score and Geary's C statistics and the outlier area percentages
+    in two chunked passes without Earth Engine:
+        1. moments and ranges of the values and of Geary's C
+        2. histograms of the values and of Geary's C
+    Percentiles, the median absolute deviation and the areas are read
+    from the histograms (to 1/bins of the value range).
+    @param source : 2D NumPy array or GeoTIFF file location
+    @param band : GeoTIFF band number (Default = 1)
+    @param chunkRows : rows read at a time (Default = 1024)
+    @param bins : histogram bins (Default = 65536)
+    @param kernelSize : Geary's C window size (Default = 9)
+    @return dictionary of the statistics, use with outlierLayersLocal
+    """
+    import numpy as np
+    halo = kernelSize // 2
+    count, mean, m2 = 0, 0.0, 0.0
+    low, high = np.inf, -np.inf
+    gearysLow, gearysHigh = np.inf, -np.inf
+    for block, start, stop in _readChunks(source, chunkRows, halo, band):
+        gearys = _gearysC(block, kernelSize)[start:stop]
+        values = block[start:stop][~np.isnan(block[start:stop])]
+        if not values.size:
+            continue
+        # Merge the chunk moments (Chan et al.)
+        n, chunkMean = values.size, values.mean()
+        delta = chunkMean - mean
+        m2 += ((values - chunkMean)**2).sum() + delta**2 * count * n / (count + n)
+        mean += delta * n / (count + n)
+        count += n
+        low, high = min(low, values.min()), max(high, values.max())
+        gearysLow = min(gearysLow, np.nanmin(gearys))
+        gearysHigh = max(gearysHigh, np.nanmax(gearys))
+    if not count:
+        raise ValueError("No valid cells in %s" % source)
+
+    edges = np.linspace(low, high if high > low else low + 1, bins + 1)
+    gearysEdges = np.linspace(gearysLow, gearysHigh if gearysHigh > gearysLow else gearysLow + 1, bins + 1)
+    counts = np.zeros(bins)
+    gearysCounts = np.zeros(bins)
+    for block, start, stop in _readChunks(source, chunkRows, halo, band):
+        gearys = _gearysC(block, kernelSize)[start:stop]
+        values = block[start:stop]
+        counts += np.histogram(values[~np.isnan(values)], edges)[0]
+        gearysCounts += np.histogram(gearys[~np.isnan(gearys)], gearysEdges)[0]
+
+    centers = (edges[:-1] + edges[1:]) / 2
+    gearysCenters = (gearysEdges[:-1] + gearysEdges[1:]) / 2
+    stats = {"totalArea": count, "mean": mean, "stdDev": np.sqrt(m2 / count)}
+    for q in [10, 25, 50, 75, 90]:
+        stats["raw%d" % q] = _weightedPercentile(centers, counts, q)
+    stats["lowerQuartile"], stats["median"], stats["upperQuartile"] = stats["raw25"], stats["raw50"], stats["raw75"]
+    stats["IQR"] = stats["upperQuartile"] - stats["lowerQuartile"]
+    stats["lowerFence"] = stats["lowerQuartile"] - 1.5 * stats["IQR"]
+    stats["upperFence"] = stats["upperQuartile"] + 1.5 * stats["IQR"]
+    absDev = np.abs(centers - stats["median"])
+    stats["medianMedAbsDev"] = _weightedPercentile(absDev, counts, 50)
+    stats["meanAbsDev"] = float((absDev * counts).sum() / counts.sum())
+
+    zScore = (centers - mean) / stats["stdDev"]
+    zScoreMod = _zScoreModLocal(centers, stats)
+    for q in [10, 90]:
+        stats["zScore%d" % q] = _weightedPercentile(zScore, counts, q)
+        stats["zScoreMod%d" % q] = float("nan") if np.isnan(zScoreMod).all() else _weightedPercentile(zScoreMod, counts, q)
+    for q in [10, 25, 75, 90]:
+        stats["gearys%d" % q] = _weightedPercentile(gearysCenters, gearysCounts, q)
+    stats["gearysLowerQuartile"], stats["gearysUpperQuartile"] = stats["gearys25"], stats["gearys75"]
+    stats["gearysUpperFence"] = stats["gearys75"] + 1.5 * (stats["gearys75"] - stats["gearys25"])
+
+    # Area percentages of the outlier classes
+    lower = centers <= stats["lowerFence"]
+    upper = centers > stats["upperFence"]
+    modified = zScoreMod > 3.5
+    def percent(mask, weights=counts):
+        return round(100.0 * weights[mask].sum() / count, 2)
+    stats["lfmzArea"] = percent(lower & modified)
+    stats["ufmzArea"] = percent(upper & modified)
+    stats["lfArea"] = percent(lower)
+    stats["ufArea"] = percent(upper)
+    stats["mzArea"] = percent(modified)
+    stats["lteZeroArea"] = percent(centers <= 0)
+    stats["gearysArea"] = percent(gearysCenters > stats["gearysUpperFence"], gearysCounts)
+    return stats
+
+
+def outlierLayersLocal(array, stats, kernelSize=9):
+    """
+    Outlier layers of a 2D NumPy array from the statistics of
+    detectOutliresLocal, with the codes of detectOutlires (NaN where a
+    layer is masked).
+    @param array : 2D NumPy array
+    @param stats : dictionary from detectOutliresLocal
+    @param kernelSize : Geary's C window size (Default = 9)
+    @return dictionary of arrays: quartile, fence, zscore, zscore_mod,
+            zmod_outlier, gearys, spatial_outlier, combined_outliers,
+            lte_zero
+    """
+    import numpy as np
+    image = np.asarray(array, dtype="float64")
+    valid = ~np.isnan(image)
+    quartile = 1 + (image > stats["lowerQuartile"]).astype(int) + (image > stats["median"]) + (image > stats["upperQuartile"])
+    fence = np.where(image <= stats["lowerFence"], 1, np.where(image > stats["upperFence"], 2, 0))
+    zScoreMod = _zScoreModLocal(image, stats)
+    modified = zScoreMod > 3.5
+    # 1 = lower fence + modified z-score, 2 = upper fence + modified
+    # z-score, 3 = lower fence, 4 = upper fence, 5 = modified z-score
+    combined = np.select(
+        [modified & (fence == 1), modified & (fence == 2), fence == 1, fence == 2, modified],
+        [1, 2, 3, 4, 5], 0)
+    gearys = _gearysC(image, kernelSize)
+    masked = lambda layer, keep: np.where(valid & keep, layer, np.nan)
+    return {
+        "quartile": masked(quartile, True),
+        "fence": masked(fence, fence != 0),
+        "zscore": (image - stats["mean"]) / stats["stdDev"],
+        "zscore_mod": zScoreMod,
+        "zmod_outlier": masked(3, modified),
+        "gearys": gearys,
+        "spatial_outlier": masked(1, gearys > stats["gearysUpperFence"]),
+        "combined_outliers": masked(combined, combined != 0),
+        "lte_zero": masked(1, image <= 0),
+    }
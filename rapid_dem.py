@@ -3,6 +3,27 @@ rapid_dem
 """
 
 # ============ Packages ================
+import functools
+import hashlib
+import inspect
+import json
+import multiprocessing
+import os
+import re
+import resource
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, Future
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import wait as futures_wait
+from contextlib import contextmanager
+
 import matplotlib.pyplot as plt
 import matplotlib.lines as mlines
 import pandas as pd
@@ -10,82 +31,1357 @@ import seaborn as sns
 import numpy as np
 import grass.script as gs
 import grass.jupyter as gj
+from grass.pygrass.gis.region import Region
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.raster.buffer import Buffer
+
+# ============ Functions ===============
+
+# Value GRASS uses for null cells in integer (CELL) rasters
+NULL_CELL = -2147483648
+# Bytes per cell for each GRASS raster type
+CELL_BYTES = {"CELL": 4, "FCELL": 4, "DCELL": 8}
+
+
+def _set_raster_region():
+    """
+    Sets the window of the raster library in this process (pygrass
+    reads and writes) to the current computational region. libgis reads
+    the region only once per process, so it does not see later g.region
+    calls or WIND_OVERRIDE changes (see <temp_region>) otherwise.
+
+    The window is only set when it changed: GRASS does not allow it to
+    change while a raster is open for writing.
+    """
+    current = gs.region()
+    window = {
+        "north": float(current["n"]),
+        "south": float(current["s"]),
+        "east": float(current["e"]),
+        "west": float(current["w"]),
+        "nsres": float(current["nsres"]),
+        "ewres": float(current["ewres"]),
+        "rows": int(current["rows"]),
+        "cols": int(current["cols"]),
+    }
+    region = Region()
+    if all(
+        abs(getattr(region, key) - value) <= 1e-9 * max(1.0, abs(value))
+        for key, value in window.items()
+    ):
+        return
+    for key, value in window.items():
+        setattr(region, key, value)
+    region.set_raster_region()
+
+
+def _raster_chunks(rasters, chunk_rows=512, report=None):
+    """
+    Reads rasters in blocks of rows over the current computational region.
+
+    Parameters
+    ==========
+    rasters (list): Names of the input rasters.
+    chunk_rows (int): (optional) Number of rows read per block.
+    report (dict): (optional) Dictionary updated with the number of
+                   raster passes and bytes read.
+
+    Returns
+    =======
+    Generator of (first_row, [block, ...]) where each block is a
+    float64 array with null cells set to NaN.
+    """
+    _set_raster_region()
+    maps = [RasterRow(rast) for rast in rasters]
+    for rast in maps:
+        rast.open("r")
+    rows, cols = maps[0]._rows, maps[0]._cols
+    if report is not None:
+        report["passes"] = report.get("passes", 0) + 1
+    try:
+        for start in range(0, rows, chunk_rows):
+            stop = min(start + chunk_rows, rows)
+            blocks = []
+            for rast in maps:
+                block = np.empty((stop - start, cols), dtype=np.float64)
+                for i in range(start, stop):
+                    block[i - start] = rast[i]
+                if rast.mtype == "CELL":
+                    block[block == NULL_CELL] = np.nan
+                blocks.append(block)
+                if report is not None:
+                    report["bytes_read"] = report.get("bytes_read", 0) + (
+                        block.size * CELL_BYTES[rast.mtype]
+                    )
+            yield start, blocks
+    finally:
+        for rast in maps:
+            rast.close()
+
+
+def _raster_windows(rasters, chunk_rows=512, halo=0, report=None):
+    """
+    Reads rasters in blocks of rows like <_raster_chunks>, adding up to
+    halo rows of the neighbouring blocks above and below.
+
+    Returns
+    =======
+    Generator of ([block, ...], start, stop) where rows start:stop of
+    each block are the rows of the chunk.
+    """
+    chunk_rows = max(chunk_rows, halo, 1)
+
+    def window(previous, current, following):
+        top = 0
+        if previous is not None and halo:
+            top = min(halo, previous[0].shape[0])
+        blocks = []
+        for k in range(len(rasters)):
+            parts = [current[k]]
+            if top:
+                parts.insert(0, previous[k][-top:])
+            if following is not None and halo:
+                parts.append(following[k][:halo])
+            blocks.append(np.vstack(parts) if len(parts) > 1 else parts[0])
+        return blocks, top, top + current[0].shape[0]
+
+    previous, current = None, None
+    for _, blocks in _raster_chunks(rasters, chunk_rows, report):
+        if current is not None:
+            yield window(previous, current, blocks)
+        previous, current = current, blocks
+    if current is not None:
+        yield window(previous, current, None)
+
+
+def _write_chunks(output, chunks, mtype="DCELL", overwrite=True):
+    """
+    Writes blocks of rows to a new raster in the current region.
+
+    Parameters
+    ==========
+    output (str): Name of the output raster.
+    chunks (iterable): Float arrays of rows in region order,
+                       NaN cells are written as null.
+    mtype (str): (optional) GRASS raster type (CELL, FCELL, DCELL).
+    overwrite (bool): (optional) Overwrite an existing raster.
+
+    Returns
+    =======
+    output
+    """
+    _set_raster_region()
+    rast = RasterRow(output, overwrite=overwrite)
+    rast.open("w", mtype=mtype)
+    try:
+        for block in chunks:
+            _put_rows(rast, block)
+    finally:
+        rast.close()
+    return output
+
+
+def _put_rows(rast, block):
+    """
+    Appends a block of rows to a raster opened for writing.
+    """
+    for row in block:
+        buffer = Buffer((row.size,), mtype=rast.mtype)
+        if rast.mtype == "CELL":
+            buffer[:] = np.where(np.isnan(row), NULL_CELL, row)
+        else:
+            buffer[:] = row
+        rast.put_row(buffer)
+
+
+def raster_disk_usage(raster):
+    """
+    Calculates the disk space (bytes) used by a raster in the current
+    mapset.
+
+    Parameters
+    ==========
+    raster (str): Name of the raster.
+
+    Returns
+    =======
+    size (int)
+    """
+    env = gs.gisenv()
+    mapset = os.path.join(
+        env["GISDBASE"], env["LOCATION_NAME"], env["MAPSET"]
+    )
+    size = 0
+    for element in ["cell", "fcell", "cellhd", "cats", "colr", "hist"]:
+        path = os.path.join(mapset, element, raster)
+        if os.path.isfile(path):
+            size += os.path.getsize(path)
+    misc = os.path.join(mapset, "cell_misc", raster)
+    if os.path.isdir(misc):
+        for name in os.listdir(misc):
+            size += os.path.getsize(os.path.join(misc, name))
+    return size
+
+
+class TemporaryMaps:
+    """
+    Registry of temporary rasters that are named uniquely per run
+    and removed when the context exits.
+
+    Example
+    =======
+    with TemporaryMaps("fusion") as tmp:
+        resampled = tmp.name("resampled", stage="resample")
+        ...
+    """
+
+    def __init__(self, prefix="tmp", keep=False):
+        """
+        Parameters
+        ==========
+        prefix (str): (optional) Prefix of the temporary raster names.
+        keep (bool): (optional) Keep the rasters on exit (debugging).
+        """
+        self.prefix = prefix
+        self.keep = keep
+        self.run_id = f"{os.getpid()}_{os.urandom(3).hex()}"
+        self.maps = {}
+
+    def name(self, base, stage=None):
+        """
+        Creates and registers a unique temporary raster name.
+
+        Parameters
+        ==========
+        base (str): Short description of the raster, e.g. resampled.
+        stage (str): (optional) Pipeline stage the raster belongs to,
+                     defaults to base.
+
+        Returns
+        =======
+        name (str)
+        """
+        name = f"{self.prefix}_{base}_{self.run_id}"
+        self.maps[name] = stage or base
+        return name
+
+    def add(self, name, stage=None):
+        """
+        Registers an existing raster name for removal.
+        """
+        self.maps[name] = stage or name
+        return name
+
+    def disk_usage(self):
+        """
+        Reports the disk space used by the temporary rasters per stage.
+
+        Returns
+        =======
+        DataFrame with stage, rasters, and bytes columns.
+        """
+        rows = [
+            {"stage": stage, "raster": name, "bytes": raster_disk_usage(name)}
+            for name, stage in self.maps.items()
+        ]
+        df = pd.DataFrame(rows, columns=["stage", "raster", "bytes"])
+        return (
+            df.groupby("stage", sort=False)
+            .agg(rasters=("raster", "count"), bytes=("bytes", "sum"))
+            .reset_index()
+        )
+
+    def remove(self):
+        """
+        Removes all registered temporary rasters.
+        """
+        if self.maps:
+            gs.run_command(
+                "g.remove",
+                type="raster",
+                name=list(self.maps),
+                flags="f",
+                quiet=True,
+            )
+        self.maps = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        usage = self.disk_usage()
+        if not usage.empty:
+            print(f"Temporary Rasters ({self.prefix}):")
+            print(usage.to_string(index=False))
+        if not self.keep:
+            self.remove()
+        return False
+
+
+@contextmanager
+def temp_region():
+    """
+    Temporary computational region that can be nested, e.g. inside
+    <fusion>. gs.use_temp_region names the region by process and
+    removes it on gs.del_temp_region, so an inner call drops the
+    region of the outer one.
+
+    Example
+    =======
+    with temp_region():
+        gs.run_command("g.region", raster=uas)
+        ...
+    """
+    previous = os.environ.get("WIND_OVERRIDE")
+    name = f"tmp_region_{os.getpid()}_{os.urandom(3).hex()}"
+    gs.run_command("g.region", save=name, overwrite=True)
+    os.environ["WIND_OVERRIDE"] = name
+    try:
+        yield name
+    finally:
+        if previous is None:
+            os.environ.pop("WIND_OVERRIDE", None)
+        else:
+            os.environ["WIND_OVERRIDE"] = previous
+        gs.run_command(
+            "g.remove", type="region", name=name, flags="f", quiet=True
+        )
+
+
+"""
+Instrumentation
+=================
+"""
+
+# Active RunTrace (see <trace_run>), None when tracing is off
+_TRACE = None
+# grass.script module, gs is replaced by a proxy (see <_GrassProxy>)
+_GRASS_SCRIPT = gs
+
+
+class RunTrace:
+    """
+    Records timing of every GRASS module call made by this module.
+
+    For each call it keeps the module, key parameters, region cell
+    count, wall time, CPU time of the child process, and the peak
+    resident memory (RSS) of child processes. CPU time and RSS come
+    from getrusage(RUSAGE_CHILDREN): the RSS is only reported when the
+    call raised the high-water mark of all children so far, and calls
+    running at the same time in threads share the counters.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.progress = []
+        self.start = time.perf_counter()
+        self._local = threading.local()
+        self._region_cells = {}
+
+    def stages(self):
+        """
+        Stack of stage names of the current thread.
+        """
+        if not hasattr(self._local, "stages"):
+            self._local.stages = []
+        return self._local.stages
+
+    def _cells(self, params):
+        """
+        Number of cells in the region of a call, that of its env when
+        it has one, cached until the region changes.
+        """
+        env = params.get("env")
+        source = os.environ if env is None else env
+        key = (source.get("GISRC"), source.get("WIND_OVERRIDE"))
+        if key not in self._region_cells:
+            region = _GRASS_SCRIPT.region(env=env)
+            self._region_cells[key] = int(region["cells"])
+        return self._region_cells[key]
+
+    def call(self, kind, module, params, func, *args, **kwargs):
+        """
+        Runs func(*args, **kwargs) and records it as a module call.
+        """
+        cells = self._cells(params)
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            wall = time.perf_counter() - start
+            after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            if module == "g.region" and kind == "run_command":
+                self._region_cells = {}
+            self.events.append(
+                {
+                    "stage": "/".join(self.stages()) or "main",
+                    "kind": kind,
+                    "module": module,
+                    "params": _trace_params(params),
+                    "cells": cells,
+                    "start": start - self.start,
+                    "wall": wall,
+                    "cpu": (after.ru_utime - before.ru_utime)
+                    + (after.ru_stime - before.ru_stime),
+                    # ru_maxrss is in kilobytes on Linux
+                    "peak_rss_kb": (
+                        after.ru_maxrss
+                        if after.ru_maxrss > before.ru_maxrss
+                        else None
+                    ),
+                    "tid": threading.get_ident(),
+                }
+            )
+
+    def summary(self):
+        """
+        Aggregates the calls per stage and module.
+
+        Returns
+        =======
+        DataFrame with calls, wall, cpu, cells, and peak RSS per stage
+        and module sorted by wall time.
+        """
+        df = pd.DataFrame(self.events)
+        if df.empty:
+            return df
+        return (
+            df.groupby(["stage", "module"])
+            .agg(
+                calls=("module", "count"),
+                wall=("wall", "sum"),
+                cpu=("cpu", "sum"),
+                cells=("cells", "sum"),
+                peak_rss_kb=("peak_rss_kb", "max"),
+            )
+            .sort_values("wall", ascending=False)
+            .reset_index()
+        )
+
+    def to_chrome_trace(self):
+        """
+        Converts the calls to Chrome trace events (chrome://tracing,
+        https://ui.perfetto.dev).
+        """
+        events = []
+        for event in self.events:
+            events.append(
+                {
+                    "name": event["module"],
+                    "cat": event["stage"],
+                    "ph": "X",
+                    "ts": event["start"] * 1e6,
+                    "dur": event["wall"] * 1e6,
+                    "pid": os.getpid(),
+                    "tid": event["tid"],
+                    "args": {
+                        k: event[k]
+                        for k in ["kind", "params", "cells", "cpu",
+                                  "peak_rss_kb"]
+                    },
+                }
+            )
+        for event in self.progress:
+            events.append(
+                {
+                    "name": f"{event['module']} progress",
+                    "cat": event["stage"],
+                    "ph": "C",
+                    "ts": event["time"] * 1e6,
+                    "pid": os.getpid(),
+                    "tid": event["tid"],
+                    "args": {"percent": event["percent"]},
+                }
+            )
+        return {
+            "traceEvents": events,
+            "otherData": {
+                "summary": self.summary().to_dict(orient="records")
+            },
+        }
+
+    def save(self, path):
+        """
+        Writes the Chrome trace (.json) of the run.
+        """
+        with open(path, "w") as f:
+            json.dump(self.to_chrome_trace(), f, default=str)
+        return path
+
+
+def _trace_params(params):
+    """
+    Keeps the parameters of a call that are useful in a trace.
+    """
+    kept = {}
+    for key, value in params.items():
+        if key in ("env", "stdin", "stdout", "stderr"):
+            continue
+        if isinstance(value, (list, tuple)):
+            value = ",".join(str(v) for v in value)
+        value = str(value)
+        kept[key] = value if len(value) <= 200 else value[:200] + "..."
+    return kept
+
+
+class ComputeBudget:
+    """
+    Cores and memory (MB) that the GRASS module calls of this module
+    may use together.
+
+    Module calls that do not set nprocs or memory get the budget, when
+    the module has the option (see <_module_options>). Calls running at
+    the same time (threads, e.g. <fill_gaps>) share it equally. Jobs
+    (see <JobQueue>) and batch processes get an equal share each.
+    """
+
+    def __init__(self, nprocs=None, memory=None):
+        """
+        Parameters
+        ==========
+        nprocs (int): (optional) Number of cores, defaults to all.
+        memory (int): (optional) Memory in MB, defaults to half of the
+                      physical memory.
+        """
+        self.nprocs = nprocs or os.cpu_count() or 1
+        self.memory = memory or _physical_memory() // 2
+        self.active = 0
+        self.lock = threading.Lock()
+
+    def share(self, parts):
+        """
+        Budget of one of parts processes running at the same time.
+
+        Returns
+        =======
+        nprocs, memory
+        """
+        parts = max(1, parts)
+        return max(1, self.nprocs // parts), max(100, self.memory // parts)
+
+    @contextmanager
+    def use(self):
+        """
+        Counts a module call as running for the duration of the context.
+        """
+        with self.lock:
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def fill(self, module, kwargs):
+        """
+        Adds nprocs and memory to the parameters of a module call,
+        unless set, divided by the number of calls running.
+        """
+        options = _module_options(module)
+        with self.lock:
+            nprocs, memory = self.share(self.active)
+        kwargs = dict(kwargs)
+        if "nprocs" in options and kwargs.get("nprocs") is None:
+            kwargs["nprocs"] = nprocs
+        if "memory" in options and kwargs.get("memory") is None:
+            kwargs["memory"] = memory
+        return kwargs
+
+    def __repr__(self):
+        return f"<ComputeBudget {self.nprocs} cores, {self.memory} MB>"
+
+
+# Session compute budget (see <set_compute_budget>)
+_BUDGET = None
+
+
+def _physical_memory():
+    """
+    Physical memory in MB.
+    """
+    return (
+        os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 2**20
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _module_options(module):
+    """
+    Names of the options of a GRASS module (--interface-description),
+    empty if the module cannot be described.
+    """
+    try:
+        process = _GRASS_SCRIPT.Popen(
+            [module, "--interface-description"],
+            stdout=_GRASS_SCRIPT.PIPE,
+            stderr=_GRASS_SCRIPT.PIPE,
+        )
+        description, _ = process.communicate()
+    except OSError:
+        return frozenset()
+    if isinstance(description, bytes):
+        description = description.decode(errors="replace")
+    return frozenset(re.findall(r'<parameter name="([^"]+)"', description))
+
+
+@functools.lru_cache(maxsize=None)
+def _mapcalc_takes_nprocs():
+    """
+    Whether gs.mapcalc has an nprocs parameter (GRASS 8.4 and later).
+    """
+    return "nprocs" in inspect.signature(_GRASS_SCRIPT.mapcalc).parameters
+
+
+def set_compute_budget(nprocs=None, memory=None):
+    """
+    Sets the cores and memory used by the GRASS modules of this module
+    for the session, e.g. to the resources of the node.
+
+    Parameters
+    ==========
+    nprocs (int): (optional) Number of cores, defaults to all.
+    memory (int): (optional) Memory in MB, defaults to half of the
+                  physical memory.
+
+    Returns
+    =======
+    ComputeBudget
+    """
+    global _BUDGET
+    _BUDGET = ComputeBudget(nprocs, memory)
+    print(f"Compute Budget: {_BUDGET.nprocs} cores, {_BUDGET.memory} MB")
+    return _BUDGET
+
+
+def compute_budget():
+    """
+    Returns the session ComputeBudget (all cores and half of the memory
+    unless set with <set_compute_budget>).
+    """
+    global _BUDGET
+    if _BUDGET is None:
+        _BUDGET = ComputeBudget()
+    return _BUDGET
+
+
+class _GrassProxy:
+    """
+    Stands in for grass.script in this module. run_command,
+    read_command, write_command, parse_command and mapcalc get nprocs
+    and memory from the compute budget (see <ComputeBudget>), and are
+    timed with region while a trace is active (see <trace_run>).
+    Everything else is passed through.
+    """
+
+    def __getattr__(self, name):
+        return getattr(_GRASS_SCRIPT, name)
+
+    def _call(self, kind, module, params, func, *args, **kwargs):
+        if _TRACE is None:
+            return func(*args, **kwargs)
+        return _TRACE.call(kind, module, params, func, *args, **kwargs)
+
+    def _command(self, kind, module, kwargs):
+        budget = compute_budget()
+        with budget.use():
+            kwargs = budget.fill(module, kwargs)
+            func = getattr(_GRASS_SCRIPT, kind)
+            return self._call(kind, module, kwargs, func, module, **kwargs)
+
+    def run_command(self, module, **kwargs):
+        return self._command("run_command", module, kwargs)
+
+    def read_command(self, module, **kwargs):
+        return self._command("read_command", module, kwargs)
+
+    def write_command(self, module, **kwargs):
+        return self._command("write_command", module, kwargs)
+
+    def parse_command(self, module, **kwargs):
+        return self._command("parse_command", module, kwargs)
+
+    def mapcalc(self, exp, **kwargs):
+        budget = compute_budget()
+        with budget.use():
+            # Older gs.mapcalc takes other keywords as template variables
+            if _mapcalc_takes_nprocs() and kwargs.get("nprocs") is None:
+                filled = budget.fill("r.mapcalc", {})
+                kwargs["nprocs"] = filled.get("nprocs")
+            return self._call(
+                "mapcalc", "r.mapcalc", dict(kwargs, expression=exp),
+                _GRASS_SCRIPT.mapcalc, exp, **kwargs
+            )
+
+    def region(self, *args, **kwargs):
+        return self._call(
+            "region", "g.region", kwargs, _GRASS_SCRIPT.region, *args, **kwargs
+        )
+
+
+gs = _GrassProxy()
+
+
+@contextmanager
+def trace_run(path=None):
+    """
+    Traces the GRASS module calls made by this module.
+
+    Parameters
+    ==========
+    path (str): (optional) Chrome trace (.json) file written on exit.
+
+    Returns
+    =======
+    RunTrace
+
+    Example
+    =======
+    with trace_run("output/fusion_trace.json") as trace:
+        fusion(...)
+    trace.summary()
+    """
+    global _TRACE
+    trace = RunTrace()
+    previous = _TRACE
+    _TRACE = trace
+    try:
+        yield trace
+    finally:
+        _TRACE = previous
+        if path:
+            trace.save(path)
+            print(f"Trace Save Location: {path}")
+
+
+@contextmanager
+def trace_stage(name):
+    """
+    Groups the module calls made inside the context under a stage name
+    when a trace is active.
+    """
+    if _TRACE is None:
+        yield
+        return
+    stages = _TRACE.stages()
+    stages.append(name)
+    try:
+        yield
+    finally:
+        stages.pop()
+
+
+def traced_stage(func):
+    """
+    Decorator recording the module calls of a function under its name.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with trace_stage(func.__name__):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+# Progress report of a GRASS module call (see <run_with_progress>),
+# eta in seconds and throughput in region cells per second
+ProgressEvent = namedtuple(
+    "ProgressEvent",
+    ["stage", "module", "percent", "elapsed", "eta", "cells_per_second"],
+)
+# Callbacks receiving the ProgressEvents (see <progress_listener>)
+_PROGRESS_LISTENERS = []
+
+
+def add_progress_listener(callback):
+    """
+    Registers a callback receiving a ProgressEvent each time a module
+    run with <run_with_progress> reports progress.
+    """
+    _PROGRESS_LISTENERS.append(callback)
+    return callback
+
+
+def remove_progress_listener(callback):
+    if callback in _PROGRESS_LISTENERS:
+        _PROGRESS_LISTENERS.remove(callback)
+
+
+@contextmanager
+def progress_listener(callback):
+    """
+    Registers a progress callback for the duration of the context.
+
+    Example
+    =======
+    with progress_listener(tqdm_progress()):
+        simwe(...)
+    """
+    add_progress_listener(callback)
+    try:
+        yield callback
+    finally:
+        remove_progress_listener(callback)
+
+
+def _emit_progress(event):
+    if _TRACE is not None:
+        _TRACE.progress.append(
+            dict(
+                event._asdict(),
+                time=time.perf_counter() - _TRACE.start,
+                tid=threading.get_ident(),
+            )
+        )
+    for callback in list(_PROGRESS_LISTENERS):
+        try:
+            callback(event)
+        except Exception as e:
+            print(f"Progress listener failed: {e}")
+
+
+def run_with_progress(module, stage=None, **kwargs):
+    """
+    Runs a GRASS module like gs.run_command and emits ProgressEvents
+    (see <add_progress_listener>) while it runs.
+
+    The module reports its percentages in the GUI message format
+    (GRASS_MESSAGE_FORMAT=gui) on stderr, which is read in a thread.
+    Its messages, warnings and errors are printed as usual.
+
+    Parameters
+    ==========
+    module (str): Name of the GRASS module.
+    stage (str): (optional) Stage name of the events, defaults to the
+                 traced stage (see <trace_stage>) or the module.
+    **kwargs: Module parameters, as for gs.run_command.
+    """
+    budget = compute_budget()
+    with budget.use():
+        kwargs = budget.fill(module, kwargs)
+        if _TRACE is not None:
+            return _TRACE.call(
+                "run_command", module, kwargs, _run_with_progress, module,
+                stage, kwargs
+            )
+        return _run_with_progress(module, stage, kwargs)
+
+
+def _run_with_progress(module, stage, kwargs):
+    if stage is None:
+        stages = _TRACE.stages() if _TRACE is not None else []
+        stage = "/".join(stages) or module
+    env = dict(kwargs.pop("env", None) or os.environ)
+    env["GRASS_MESSAGE_FORMAT"] = "gui"
+    region = _GRASS_SCRIPT.region(env=env)
+    cells = int(region["rows"]) * int(region["cols"])
+    errors = []
+    start = time.perf_counter()
+    process = _GRASS_SCRIPT.start_command(
+        module, stderr=_GRASS_SCRIPT.PIPE, env=env, **kwargs
+    )
+
+    def read():
+        last = None
+        for line in process.stderr:
+            if isinstance(line, bytes):
+                line = line.decode(errors="replace")
+            line = line.strip()
+            if line.startswith("GRASS_INFO_PERCENT:"):
+                percent = int(line.split(":")[1])
+                if percent == last:
+                    continue
+                last = percent
+                elapsed = time.perf_counter() - start
+                _emit_progress(
+                    ProgressEvent(
+                        stage,
+                        module,
+                        percent,
+                        elapsed,
+                        elapsed * (100 - percent) / percent
+                        if percent
+                        else None,
+                        cells * percent / 100 / elapsed if elapsed else None,
+                    )
+                )
+            elif line.startswith("GRASS_INFO_END") or not line:
+                continue
+            elif line.startswith("GRASS_INFO_"):
+                kind, _, text = line.partition(": ")
+                if kind.startswith("GRASS_INFO_ERROR"):
+                    errors.append(text)
+                    print(f"ERROR: {text}")
+                elif kind.startswith("GRASS_INFO_WARNING"):
+                    print(f"WARNING: {text}")
+                else:
+                    print(text)
+            else:
+                print(line)
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    returncode = process.wait()
+    reader.join()
+    if returncode:
+        raise _GRASS_SCRIPT.CalledModuleError(
+            module, kwargs, returncode, errors="\n".join(errors)
+        )
+
+
+def tqdm_progress():
+    """
+    Progress callback showing a progress bar (tqdm) per module call
+    with the throughput in cells per second.
+
+    Example
+    =======
+    with progress_listener(tqdm_progress()):
+        fusion(...)
+    """
+    from tqdm.auto import tqdm
+
+    bars = {}
+
+    def update(event):
+        key = (event.stage, event.module, threading.get_ident())
+        if key not in bars:
+            bars[key] = tqdm(
+                total=100, desc=f"{event.stage}: {event.module}", unit="%"
+            )
+        bar = bars[key]
+        bar.n = event.percent
+        if event.cells_per_second:
+            bar.set_postfix(cells_s=f"{event.cells_per_second:.3g}")
+        bar.refresh()
+        if event.percent >= 100:
+            bar.close()
+            del bars[key]
+
+    return update
+
+
+def u16bitTou8bit(band, output):
+    """
+    Cover 16-bit PlanetScope red, blue, green, nir band to 8-bit
+
+    Parameters
+    ==========
+    band (str): Name of raster containing PlantScope band.
+    output (str): Name of output raster.
+
+    Returns
+    =======
+    output
+
+    """
+    univar = gs.parse_command("r.univar", map=band, flags="ge")
+    min_val = float(univar["min"])
+    max_val = float(univar["max"])
+    gs.mapcalc(
+        f"""{output} = (
+            ({band} - {min_val}) * 255) /
+            ({max_val} - {min_val}) + 0
+        """
+    )
+    gs.run_command("r.colors", map=output, color="grey255", flags="e")
+    return output
+
+
+def _band_histogram(band, nsteps=65536):
+    """
+    Counts the cells of each value of an integer band with r.stats.
+    Floating point bands are split into nsteps equal ranges counted at
+    their midpoints.
+    """
+    values, counts = [], []
+    if gs.raster_info(band)["datatype"] == "CELL":
+        stats = gs.read_command("r.stats", input=band, flags="cn")
+    else:
+        stats = gs.read_command(
+            "r.stats", input=band, flags="cnA", nsteps=nsteps
+        )
+    for line in stats.splitlines():
+        value, count = line.split()
+        values.append(float(value))
+        counts.append(int(count))
+    return np.array(values), np.array(counts)
+
+
+def _histogram_stretch(values, counts, percentiles=None):
+    """
+    Gets the (low, high) stretch limits of a histogram, either the
+    min and max or the given (lower, upper) percentiles.
+    """
+    if percentiles is None:
+        return float(values[0]), float(values[-1])
+    cumulative = np.cumsum(counts) / counts.sum() * 100
+    index = np.searchsorted(cumulative, percentiles).clip(0, values.size - 1)
+    return float(values[index[0]]), float(values[index[1]])
+
+
+@traced_stage
+def u16bitTou8bitBatch(
+    bands,
+    outputs,
+    percentiles=None,
+    shared=False,
+    stretch=None,
+    stretch_file=None,
+    nprocs=4,
+):
+    """
+    Converts several 16-bit PlanetScope bands (red, blue, green, nir)
+    to 8-bit integer rasters concurrently.
+
+    Parameters
+    ==========
+    bands (list): Names of rasters containing PlanetScope bands.
+    outputs (list): Names of output rasters (same order as bands).
+    percentiles (tuple): (optional) Lower and upper percentile used to
+                         clip the stretch, e.g. (2, 98). Default uses
+                         the min and max.
+    shared (bool): (optional) Use one histogram of all bands so every
+                   band gets the same stretch. Default stretches each
+                   band on its own like <u16bitTou8bit>.
+    stretch (list): (optional) (low, high) per band from a previous
+                    run, skips scanning the bands.
+    stretch_file (str): (optional) JSON file to read the stretch from
+                        if it exists, otherwise it is written there.
+    nprocs (int): (optional) Number of bands processed at once.
+
+    Returns
+    =======
+    stretch (list): (low, high) per band.
+    """
+    if stretch is None and stretch_file and os.path.exists(stretch_file):
+        with open(stretch_file) as f:
+            stretch = [tuple(s) for s in json.load(f)["stretch"]]
+        print(f"Using stretch from {stretch_file}")
+    if stretch is not None and len(stretch) != len(bands):
+        raise ValueError(
+            f"Stretch has {len(stretch)} bands but {len(bands)} bands "
+            "were given"
+            + (f" (from {stretch_file})" if stretch_file else "")
+        )
+
+    with ThreadPoolExecutor(max_workers=nprocs) as executor:
+        if stretch is None:
+            histograms = list(executor.map(_band_histogram, bands))
+            if shared:
+                values = np.unique(np.concatenate([h[0] for h in histograms]))
+                counts = np.zeros(values.size, dtype=np.int64)
+                for band_values, band_counts in histograms:
+                    counts[np.searchsorted(values, band_values)] += band_counts
+                stretch = [_histogram_stretch(values, counts, percentiles)]
+                stretch = stretch * len(bands)
+            else:
+                stretch = [
+                    _histogram_stretch(v, c, percentiles)
+                    for v, c in histograms
+                ]
+            if stretch_file:
+                with open(stretch_file, "w") as f:
+                    json.dump({"bands": bands, "stretch": stretch}, f)
+                print(f"Stretch saved to {stretch_file}")
+
+        def convert(band, output, low, high):
+            scale = 255.0 / max(high - low, 1)
+            gs.mapcalc(
+                f"""{output} = int(
+                    max(0, min(255, round(({band} - {low}) * {scale})))
+                )
+                """
+            )
+            gs.run_command("r.colors", map=output, color="grey255")
+            return output
+
+        lows, highs = zip(*stretch)
+        list(executor.map(convert, bands, outputs, lows, highs))
+
+    for band, (low, high) in zip(bands, stretch):
+        print(f"{band}: {low} - {high}")
+    return stretch
+
+
+@traced_stage
+def binary_change(
+    before,
+    after,
+    binary_change="binary_change",
+    binary_change_mask="binary_change_mask",
+    thres=-2.5,
+):
+    """
+    Calculates a binary change mask between two images with a
+    thershold set at -2.5 times the std dev.
+
+    Parameters
+    ==========
+    before (str): A string name of the before image raster.
+    after (str): A string name of the after image raster.
+    binary_change (str): (optional) A string name of the output
+                         binary change raster.
+    binary_change_mask (str): (optional) A string name of
+                              the output binary change mask.
+    thres (float): (optional) Value used to scale the change
+                   threshold by multiplying the standard deviation.
+
+    Returns
+    =======
+    binary_change, binary_change_mask
+    """
+    gs.mapcalc(f"{binary_change} = {before} - {after}")
+    gs.run_command(
+        "r.colors",
+        map=binary_change,
+        color="differences",
+        flags=""
+    )
+    univar = gs.parse_command("r.univar", map=binary_change, flags="ge")
+    mean = float(univar["mean"])
+    print(f"Mean: {mean}")
+    stddev = float(univar["stddev"])
+    print(f"Std: {stddev}")
+    threshold = (
+        mean + (stddev * thres) if thres < 0 else mean - (stddev * thres)
+    )
+    print(f"Change Threshold: {threshold}")
+    gs.mapcalc(
+        f"{binary_change_mask} = if({binary_change} <= {threshold}, 1, null())"
+    )
+
+
+def _merge_moments(moments, values):
+    """
+    Merges the count, mean, and sum of squared deviations of values
+    into running moments (Chan et al. parallel variance).
+
+    Parameters
+    ==========
+    moments (dict): Running moments with n, mean, m2, min, and max.
+    values (ndarray): Values to add, NaN values are ignored.
+
+    Returns
+    =======
+    moments
+    """
+    values = values[~np.isnan(values)]
+    n_b = values.size
+    if n_b == 0:
+        return moments
+    mean_b = values.mean()
+    m2_b = ((values - mean_b) ** 2).sum()
+    n_a = moments["n"]
+    n = n_a + n_b
+    delta = mean_b - moments["mean"]
+    moments["mean"] += delta * n_b / n
+    moments["m2"] += m2_b + delta**2 * n_a * n_b / n
+    moments["n"] = n
+    moments["min"] = min(moments["min"], values.min())
+    moments["max"] = max(moments["max"], values.max())
+    return moments
+
+
+def _empty_moments():
+    """
+    Returns empty running moments for <_merge_moments>.
+    """
+    return {"n": 0, "mean": 0.0, "m2": 0.0, "min": np.inf, "max": -np.inf}
+
+
+@traced_stage
+def binary_change_stream(
+    before,
+    after,
+    binary_change_mask="binary_change_mask",
+    binary_change=None,
+    thres=-2.5,
+    chunk_rows=512,
+):
+    """
+    Calculates the same binary change mask as <binary_change> in two
+    chunked passes over the inputs without an intermediate difference
+    raster. The first pass collects the difference statistics and the
+    second pass writes the threshold mask.
+
+    Parameters
+    ==========
+    before (str): A string name of the before image raster.
+    after (str): A string name of the after image raster.
+    binary_change_mask (str): (optional) A string name of
+                              the output binary change mask.
+    binary_change (str): (optional) A string name of the output
+                         difference raster, only written when set.
+    thres (float): (optional) Value used to scale the change
+                   threshold by multiplying the standard deviation.
+    chunk_rows (int): (optional) Number of rows read per block.
+
+    Returns
+    =======
+    report (dict): Mean, std, threshold, raster passes, and bytes read.
+    """
+    report = {"passes": 0, "bytes_read": 0}
+    moments = _empty_moments()
+    for _, (b, a) in _raster_chunks([before, after], chunk_rows, report):
+        _merge_moments(moments, b - a)
+
+    mean = moments["mean"]
+    stddev = np.sqrt(moments["m2"] / moments["n"]) if moments["n"] else 0.0
+    print(f"Mean: {mean}")
+    print(f"Std: {stddev}")
+    threshold = change_threshold(mean, stddev, thres)
+    print(f"Change Threshold: {threshold}")
+
+    mask = RasterRow(binary_change_mask, overwrite=True)
+    mask.open("w", mtype="CELL")
+    diff = None
+    if binary_change:
+        diff = RasterRow(binary_change, overwrite=True)
+        diff.open("w", mtype="DCELL")
+    try:
+        for _, (b, a) in _raster_chunks([before, after], chunk_rows, report):
+            delta = b - a
+            with np.errstate(invalid="ignore"):
+                _put_rows(mask, np.where(delta <= threshold, 1.0, np.nan))
+            if diff is not None:
+                _put_rows(diff, delta)
+    finally:
+        mask.close()
+        if diff is not None:
+            diff.close()
+
+    if binary_change:
+        gs.run_command("r.colors", map=binary_change, color="differences")
+
+    report.update(mean=mean, stddev=stddev, threshold=threshold)
+    print(
+        f"Raster Passes: {report['passes']}, "
+        f"Bytes Read: {report['bytes_read']}"
+    )
+    return report
+
+
+def change_threshold(mean, stddev, thres):
+    """
+    Converts a standard deviation multiplier into the change threshold
+    used by <binary_change>.
+    """
+    return mean + (stddev * thres) if thres < 0 else mean - (stddev * thres)
+
+
+@traced_stage
+def change_histogram(before, after, bins=10000, chunk_rows=512):
+    """
+    Builds a fine-grained histogram of the difference (before - after)
+    in a single chunked pass. The bin range is taken from the input
+    raster ranges so no extra pass is needed to find it.
+
+    Parameters
+    ==========
+    before (str): A string name of the before image raster.
+    after (str): A string name of the after image raster.
+    bins (int): (optional) Number of histogram bins.
+    chunk_rows (int): (optional) Number of rows read per block.
 
-# ============ Functions ===============
+    Returns
+    =======
+    histogram (dict): Bin edges, counts, mean, stddev, and cell area
+                      used by <change_threshold_curve>.
+    """
+    before_info = gs.raster_info(before)
+    after_info = gs.raster_info(after)
+    low = float(before_info["min"]) - float(after_info["max"])
+    high = float(before_info["max"]) - float(after_info["min"])
+    if high <= low:
+        high = low + 1
+    edges = np.linspace(low, high, bins + 1)
+    counts = np.zeros(bins, dtype=np.int64)
+    moments = _empty_moments()
+    report = {"passes": 0, "bytes_read": 0}
+    for _, (b, a) in _raster_chunks([before, after], chunk_rows, report):
+        delta = b - a
+        _merge_moments(moments, delta)
+        counts += np.histogram(delta[~np.isnan(delta)], bins=edges)[0]
+
+    region = gs.region()
+    stddev = np.sqrt(moments["m2"] / moments["n"]) if moments["n"] else 0.0
+    return {
+        "edges": edges,
+        "counts": counts,
+        "n": moments["n"],
+        "mean": moments["mean"],
+        "stddev": stddev,
+        "cell_area": float(region["nsres"]) * float(region["ewres"]),
+        "report": report,
+    }
 
 
-def u16bitTou8bit(band, output):
+def change_threshold_curve(histogram, multipliers=None, thresholds=None):
     """
-    Cover 16-bit PlanetScope red, blue, green, nir band to 8-bit
+    Calculates the changed area for a set of thresholds from a
+    <change_histogram> without reading the rasters again. Cells
+    within a bin are assumed to be evenly spread across the bin.
 
     Parameters
     ==========
-    band (str): Name of raster containing PlantScope band.
-    output (str): Name of output raster.
+    histogram (dict): Output of <change_histogram>.
+    multipliers (list): (optional) Standard deviation multipliers
+                        (same meaning as thres in <binary_change>).
+    thresholds (list): (optional) Absolute difference thresholds.
 
     Returns
     =======
-    output
-
+    DataFrame with multiplier, threshold, cells, area, and percent
+    columns.
     """
-    univar = gs.parse_command("r.univar", map=band, flags="ge")
-    min_val = float(univar["min"])
-    max_val = float(univar["max"])
-    gs.mapcalc(
-        f"""{output} = (
-            ({band} - {min_val}) * 255) /
-            ({max_val} - {min_val}) + 0
-        """
-    )
-    gs.run_command("r.colors", map=output, color="grey255", flags="e")
-    return output
+    if multipliers is None and thresholds is None:
+        multipliers = np.arange(-4, -0.75, 0.25)
+    rows = []
+    for thres in [] if multipliers is None else multipliers:
+        threshold = change_threshold(
+            histogram["mean"], histogram["stddev"], thres
+        )
+        rows.append({"multiplier": thres, "threshold": threshold})
+    for threshold in [] if thresholds is None else thresholds:
+        rows.append({"multiplier": np.nan, "threshold": threshold})
+
+    edges = histogram["edges"]
+    cumulative = np.concatenate([[0], np.cumsum(histogram["counts"])])
+    df = pd.DataFrame(rows)
+    # Changed cells are all cells with a difference <= threshold
+    df["cells"] = np.interp(df["threshold"], edges, cumulative)
+    df["area"] = df["cells"] * histogram["cell_area"]
+    df["percent"] = df["cells"] / max(histogram["n"], 1) * 100
+    return df
 
 
-def binary_change(
-    before,
-    after,
-    binary_change="binary_change",
-    binary_change_mask="binary_change_mask",
-    thres=-2.5,
-):
+def write_change_mask(before, after, threshold, output, chunk_rows=512):
     """
-    Calculates a binary change mask between two images with a
-    thershold set at -2.5 times the std dev.
+    Writes a binary change mask (1 where before - after <= threshold)
+    in a single pass, e.g. for a threshold picked from
+    <change_threshold_curve>.
 
     Parameters
     ==========
     before (str): A string name of the before image raster.
     after (str): A string name of the after image raster.
-    binary_change (str): (optional) A string name of the output
-                         binary change raster.
-    binary_change_mask (str): (optional) A string name of
-                              the output binary change mask.
-    thres (float): (optional) Value used to scale the change
-                   threshold by multiplying the standard deviation.
+    threshold (float): Absolute difference threshold.
+    output (str): Name of the output binary change mask.
+    chunk_rows (int): (optional) Number of rows read per block.
 
     Returns
     =======
-    binary_change, binary_change_mask
+    output
     """
-    gs.mapcalc(f"{binary_change} = {before} - {after}")
-    gs.run_command(
-        "r.colors",
-        map=binary_change,
-        color="differences",
-        flags=""
-    )
-    univar = gs.parse_command("r.univar", map=binary_change, flags="ge")
-    mean = float(univar["mean"])
-    print(f"Mean: {mean}")
-    stddev = float(univar["stddev"])
-    print(f"Std: {stddev}")
-    threshold = (
-        mean + (stddev * thres) if thres < 0 else mean - (stddev * thres)
-    )
-    print(f"Change Threshold: {threshold}")
-    gs.mapcalc(
-        f"{binary_change_mask} = if({binary_change} <= {threshold}, 1, null())"
-    )
+
+    def masks():
+        for _, (b, a) in _raster_chunks([before, after], chunk_rows):
+            with np.errstate(invalid="ignore"):
+                yield np.where(b - a <= threshold, 1.0, np.nan)
+
+    return _write_chunks(output, masks(), mtype="CELL")
 
 
 def calc_bsi(red, green, blue, nir, output):
@@ -148,12 +1444,13 @@ def zscore(rast, output, log=False):
     output
     """
     if log:
-        tmp_log = "tmp_log"
-        gs.mapcalc(f"{tmp_log} = log({rast})")
-        univar = gs.parse_command("r.univar", map=tmp_log, flags="ge")
-        mean = float(univar["mean"])
-        stddev = float(univar["stddev"])
-        gs.mapcalc(f"{output} = ({tmp_log} - {mean}) / {stddev}")
+        with TemporaryMaps("zscore") as tmp:
+            tmp_log = tmp.name("log")
+            gs.mapcalc(f"{tmp_log} = log({rast})")
+            univar = gs.parse_command("r.univar", map=tmp_log, flags="ge")
+            mean = float(univar["mean"])
+            stddev = float(univar["stddev"])
+            gs.mapcalc(f"{output} = ({tmp_log} - {mean}) / {stddev}")
     else:
         univar = gs.parse_command("r.univar", map=rast, flags="ge")
         mean = float(univar["mean"])
@@ -202,6 +1499,7 @@ def shadedRelief(elevation, relief, output, shade_only=False):
         )
 
 
+@traced_stage
 def generate_elevation_figure(elev, filename):
     """
     Generates a shade png image of an elevation (DTM, DSM)
@@ -236,6 +1534,7 @@ def generate_elevation_figure(elev, filename):
     return elev_map.show()
 
 
+@traced_stage
 def generate_uas_elevation_figures(elev, filename):
     """
     Generates a shade png image of an elevation (DTM, DSM)
@@ -275,6 +1574,7 @@ def generate_uas_elevation_figures(elev, filename):
     return elev_map.show()
 
 
+@traced_stage
 def generate_fusion_elevation_figure(elev, filename):
     """
     Generates a shade png image of an elevation (DTM, DSM)
@@ -384,12 +1684,385 @@ def create_flight_figure(
     return plt.savefig(output, bbox_inches="tight", dpi=300)
 
 
+"""
+Land Cover Classification
+=================
+"""
+
+# Classes of grass_config/classified_reclass.txt
+LAND_CLASSES = [
+    "road", "building", "barren", "forest", "grass", "water", "developed"
+]
+
+
+def confusion_matrix(reference, predicted, n_classes):
+    """
+    Confusion matrix of two integer class arrays from one bincount of
+    the composite key reference * n_classes + predicted.
+
+    Returns
+    =======
+    Array (n_classes, n_classes), rows are reference classes and
+    columns predicted classes.
+    """
+    reference = reference.astype(np.int64)
+    predicted = predicted.astype(np.int64)
+    valid = (
+        (reference >= 0) & (reference < n_classes)
+        & (predicted >= 0) & (predicted < n_classes)
+    )
+    key = reference[valid] * n_classes + predicted[valid]
+    return np.bincount(key, minlength=n_classes**2).reshape(
+        n_classes, n_classes
+    )
+
+
+@traced_stage
+def training_samples(features, samples, column="landclass", chunk_rows=512):
+    """
+    Extracts the feature values of the labelled cells.
+
+    Parameters
+    ==========
+    features (list): Names of the feature rasters (bands and indices).
+    samples (str): Raster of class labels (null where unlabelled), or a
+                   vector map of labelled points or areas.
+    column (str): (optional) Class column of a vector map.
+    chunk_rows (int): (optional) Number of rows read per block.
+
+    Returns
+    =======
+    X (array of cells x features), y (array of class labels)
+    """
+    with TemporaryMaps("tmp_samples") as tmp:
+        if gs.find_file(samples, element="vector")["name"]:
+            labels = tmp.name("labels", stage="training_samples")
+            gs.run_command(
+                "v.to.rast",
+                input=samples,
+                output=labels,
+                use="attr",
+                attribute_column=column,
+            )
+        else:
+            labels = samples
+        X, y = [], []
+        for _, blocks in _raster_chunks([labels] + features, chunk_rows):
+            stack = np.stack([block.ravel() for block in blocks], axis=1)
+            stack = stack[~np.isnan(stack).any(axis=1)]
+            X.append(stack[:, 1:])
+            y.append(stack[:, 0].astype(np.int64))
+    X, y = np.concatenate(X), np.concatenate(y)
+    print(f"Training Samples: {len(y)}")
+    return X, y
+
+
+@traced_stage
+def train_landcover_classifier(
+    features, samples, column="landclass", trees=100, test_size=0.3,
+    seed=1, nprocs=4, classes=None
+):
+    """
+    Trains a random forest land cover classifier (scikit-learn) on
+    labelled samples and assesses it on held out samples, the local
+    equivalent of ee.Classifier.smileRandomForest.
+
+    Parameters
+    ==========
+    features (list): Names of the feature rasters (bands and indices).
+    samples (str): Labelled raster or vector map (see
+                   <training_samples>).
+    column (str): (optional) Class column of a vector map.
+    trees (int): (optional) Number of trees.
+    test_size (float): (optional) Share of samples held out.
+    seed (int): (optional) Random seed.
+    nprocs (int): (optional) Number of parallel processes.
+    classes (list): (optional) Class names, defaults to LAND_CLASSES.
+
+    Returns
+    =======
+    classifier, importance (DataFrame of feature importance, largest
+    first), confusion (DataFrame of the held out confusion matrix)
+    """
+    try:
+        from sklearn.ensemble import RandomForestClassifier
+    except ImportError:
+        raise ImportError(
+            "Local classification requires scikit-learn "
+            "(pip install scikit-learn)"
+        )
+    classes = classes or LAND_CLASSES
+    X, y = training_samples(features, samples, column)
+    rng = np.random.default_rng(seed)
+    test = rng.random(len(y)) < test_size
+    classifier = RandomForestClassifier(
+        n_estimators=trees, n_jobs=nprocs, random_state=seed
+    )
+    classifier.fit(X[~test], y[~test])
+
+    importance = pd.DataFrame(
+        {"feature": features, "value": classifier.feature_importances_}
+    ).sort_values("value", ascending=False)
+    predicted = classifier.predict(X[test])
+    confusion = pd.DataFrame(
+        confusion_matrix(y[test], predicted, len(classes)),
+        index=classes,
+        columns=classes,
+    )
+    accuracy = np.trace(confusion.values) / max(confusion.values.sum(), 1)
+    print(f"Held Out Accuracy: {accuracy:.3f} ({test.sum()} samples)")
+    return classifier, importance, confusion
+
+
+@traced_stage
+def classify_landcover(
+    features, classifier, output, chunk_rows=512, nprocs=4, classes=None
+):
+    """
+    Predicts the land cover class of each cell in blocks of rows, with
+    nprocs blocks predicted at once, and writes it as a CELL raster
+    with the classified colors and labels.
+
+    Parameters
+    ==========
+    features (list): Names of the feature rasters, in training order.
+    classifier: Trained classifier (see <train_landcover_classifier>).
+    output (str): Name of the classified raster.
+    chunk_rows (int): (optional) Number of rows read per block.
+    nprocs (int): (optional) Number of blocks predicted at once.
+    classes (list): (optional) Class names of values 0 to n - 1 the
+                    classifier was trained with, defaults to
+                    LAND_CLASSES.
+
+    Returns
+    =======
+    output
+    """
+    classes = classes or LAND_CLASSES
+    # Parallelize over blocks instead of over trees
+    classifier.set_params(n_jobs=1)
+
+    def predict(item):
+        _, blocks = item
+        stack = np.stack([block.ravel() for block in blocks], axis=1)
+        valid = ~np.isnan(stack).any(axis=1)
+        classes = np.full(stack.shape[0], np.nan)
+        if valid.any():
+            classes[valid] = classifier.predict(stack[valid])
+        return classes.reshape(blocks[0].shape)
+
+    def predicted():
+        chunks = _raster_chunks(features, chunk_rows)
+        with ThreadPoolExecutor(max_workers=nprocs) as executor:
+            pending = []
+            for item in chunks:
+                pending.append(executor.submit(predict, item))
+                if len(pending) > nprocs:
+                    yield pending.pop(0).result()
+            for future in pending:
+                yield future.result()
+
+    print(f"Classifying: {output}")
+    _write_chunks(output, predicted(), mtype="CELL")
+    gs.run_command(
+        "r.colors", map=output, rules="grass_config/classified_colors.txt"
+    )
+    gs.write_command(
+        "r.category",
+        map=output,
+        separator=":",
+        rules="-",
+        stdin="\n".join(f"{i}:{name}" for i, name in enumerate(classes)),
+    )
+    return output
+
+
+@traced_stage
+def classify_before_after(
+    before_features,
+    after_features,
+    samples,
+    before_output="classified_before_30m",
+    after_output="classified_after_30m",
+    res=30,
+    column="landclass",
+    trees=100,
+    nprocs=4,
+    classes=None,
+):
+    """
+    Classifies the before and after feature stacks with one locally
+    trained random forest and writes the classified rasters (and their
+    _recl reclass maps) used by <land_change_action> and
+    <priority_change_calc>. The feature importance chart and confusion
+    matrix figure are saved to output/.
+
+    Parameters
+    ==========
+    before_features (list): Before feature rasters (bands and indices).
+    after_features (list): After feature rasters, in the same order.
+    samples (str): Labelled raster or vector map (see
+                   <training_samples>), labelled on the before date.
+    before_output (str): (optional) Before classified raster.
+    after_output (str): (optional) After classified raster.
+    res (float): (optional) Output resolution.
+    column (str): (optional) Class column of a vector map.
+    trees (int): (optional) Number of trees.
+    nprocs (int): (optional) Number of parallel processes.
+    classes (list): (optional) Class names of values 0 to n - 1,
+                    defaults to LAND_CLASSES.
+
+    Returns
+    =======
+    importance, confusion (see <train_landcover_classifier>)
+    """
+    print(("#" * 25) + " Land Cover Classification " + ("#" * 25))
+    with temp_region():
+        gs.run_command("g.region", raster=before_features[0], res=res)
+        # Training and prediction read the features in-process, on the
+        # res grid the classified rasters are written on
+        _set_raster_region()
+        classifier, importance, confusion = train_landcover_classifier(
+            before_features, samples, column, trees=trees, nprocs=nprocs,
+            classes=classes
+        )
+        for features, output in [
+            (before_features, before_output),
+            (after_features, after_output),
+        ]:
+            classify_landcover(
+                features, classifier, output, nprocs=nprocs, classes=classes
+            )
+            gs.run_command(
+                "r.reclass",
+                input=output,
+                output=f"{output}_recl",
+                rules="grass_config/classified_reclass.txt",
+                overwrite=True,
+            )
+
+    fig, ax = plt.subplots(1, 2, figsize=(18, 6))
+    sns.barplot(x="value", y="feature", data=importance, color="b", ax=ax[0])
+    ax[0].set_title("Feature Importance", fontsize=14)
+    sns.heatmap(
+        confusion, annot=True, fmt="d", linewidths=0.5, cmap="Blues",
+        ax=ax[1]
+    )
+    ax[1].set_title("Confusion Matrix (Held Out)", fontsize=14)
+    plt.tight_layout()
+    plt.savefig("output/classification_assessment.png", bbox_inches="tight")
+    return importance, confusion
+
+
+@traced_stage
+def accuracy_assessment(reference, classified, classes=None, chunk_rows=1024):
+    """
+    Assesses a classified raster against a reference raster in one
+    chunked pass (a bincount of the composite key per block).
+
+    The reference can be a full map or sparse validation samples (null
+    elsewhere). Besides the sample based accuracy, the area-weighted
+    estimates of Olofsson et al. (2014) use the share of each mapped
+    class over the whole classified raster as strata weights.
+
+    Parameters
+    ==========
+    reference (str): Reference (validation) class raster.
+    classified (str): Classified raster.
+    classes (list): (optional) Class names of values 0 to n - 1,
+                    defaults to LAND_CLASSES.
+    chunk_rows (int): (optional) Number of rows read per block.
+
+    Returns
+    =======
+    assessment (dict):
+        matrix: Confusion matrix DataFrame (rows reference, columns map)
+        classes: DataFrame of producer and user accuracy, mapped area,
+                 area-weighted producer accuracy, estimated area and
+                 its standard error per class (areas in map units)
+        overall, kappa: Sample overall accuracy and kappa
+        overall_weighted, overall_weighted_se: Area-weighted overall
+                 accuracy and standard error
+    """
+    print(("#" * 25) + " Accuracy Assessment " + ("#" * 25))
+    classes = classes or LAND_CLASSES
+    n = len(classes)
+    matrix = np.zeros((n, n), dtype=np.int64)
+    mapped = np.zeros(n, dtype=np.int64)
+    for _, (ref, cls) in _raster_chunks([reference, classified], chunk_rows):
+        valid_map = ~np.isnan(cls) & (cls >= 0) & (cls < n)
+        mapped += np.bincount(cls[valid_map].astype(np.int64), minlength=n)
+        valid = valid_map & ~np.isnan(ref)
+        matrix += confusion_matrix(ref[valid], cls[valid], n)
+    region = gs.region()
+    cell_area = float(region["nsres"]) * float(region["ewres"])
+
+    total = matrix.sum()
+    diagonal = np.diag(matrix)
+    ref_totals, map_totals = matrix.sum(axis=1), matrix.sum(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        overall = diagonal.sum() / total
+        chance = (ref_totals * map_totals).sum() / total**2
+        kappa = (overall - chance) / (1 - chance)
+        producer = diagonal / ref_totals
+        user = diagonal / map_totals
+
+        # Estimated area proportions p_ij = W_j n_ij / n_.j
+        weights = mapped / mapped.sum()
+        share = matrix / map_totals
+        proportions = np.nan_to_num(share * weights)
+        estimated = proportions.sum(axis=1)
+        producer_weighted = np.diag(proportions) / estimated
+        area_se = np.sqrt(
+            np.nansum(
+                weights**2 * share * (1 - share) / (map_totals - 1), axis=1
+            )
+        )
+        overall_weighted = np.trace(proportions)
+        overall_se = np.sqrt(
+            np.nansum(
+                weights**2 * user * (1 - user) / (map_totals - 1)
+            )
+        )
+    total_area = mapped.sum() * cell_area
+    summary = pd.DataFrame(
+        {
+            "class": classes,
+            "reference_samples": ref_totals,
+            "map_samples": map_totals,
+            "producer_accuracy": producer,
+            "user_accuracy": user,
+            "mapped_area": mapped * cell_area,
+            "producer_accuracy_weighted": producer_weighted,
+            "estimated_area": estimated * total_area,
+            "estimated_area_se": area_se * total_area,
+        }
+    )
+    print(
+        f"""
+        Overall Accuracy: {overall:.3f} ({total} samples)
+        Kappa: {kappa:.3f}
+        Overall Accuracy (Area Weighted): {overall_weighted:.3f}
+            +/- {1.96 * overall_se:.3f}
+        """
+    )
+    return {
+        "matrix": pd.DataFrame(matrix, index=classes, columns=classes),
+        "classes": summary,
+        "overall": overall,
+        "kappa": kappa,
+        "overall_weighted": overall_weighted,
+        "overall_weighted_se": overall_se,
+    }
+
+
 """
 Priority Queue Functions
 =================
 """
 
 
+@traced_stage
 def land_change_action(output):
     """
     X0 - primary class
@@ -885,6 +2558,7 @@ def land_change_action(output):
     )
 
 
+@traced_stage
 def priority_change_calc(before_landcover, after_landcover, output):
     """
     Maps Thematic Land Cover Maps into the priority change map.
@@ -946,45 +2620,533 @@ def priority_change_calc(before_landcover, after_landcover, output):
         "developed to forest": 3,
     }
 
-    def expression_builder(from_val, to_val, priority):
-        return f"""if(
-            {before_landcover} == {from_val} &&
-            {after_landcover} == {to_val},
-            {priority},
-            """
+    def expression_builder(from_val, to_val, priority):
+        return f"""if(
+            {before_landcover} == {from_val} &&
+            {after_landcover} == {to_val},
+            {priority},
+            """
+
+    class_list = range(0, 7)
+    classnames = [
+        "road",
+        "building",
+        "barren",
+        "forest",
+        "grass",
+        "water",
+        "developed"
+    ]
+
+    expression = ""
+    closing = ""
+    for fc in class_list:
+        for tc in class_list:
+            if fc != tc:
+                change_key = f"{classnames[fc]} to {classnames[tc]}"
+                change_value = change_priority[change_key]
+                expression += expression_builder(fc, tc, change_value)
+                closing += ")"
+    expression += "0"
+    expression += closing
+    gs.mapcalc(f"{output} = {expression}")
+    gs.run_command("r.colors", map=output, color="plasma")
+
+
+def _raster_labels(raster):
+    """
+    Category labels of a raster (r.category), {value: label}.
+    """
+    labels = {}
+    categories = gs.read_command("r.category", map=raster, separator="|")
+    for line in categories.splitlines():
+        value, _, label = line.partition("|")
+        if value.strip() and label.strip():
+            labels[int(float(value))] = label.strip()
+    return labels
+
+
+@traced_stage
+def zonal_crosstab(zones, values, labels=None, chunk_rows=1024):
+    """
+    Cross-tabulates a zone raster (e.g. basins from
+    <analyze_hydrology>, priority objects or UAS footprints) against a
+    class raster (e.g. land change actions or priorities) in one
+    chunked pass, instead of running r.univar or r.stats per zone.
+
+    Each block is counted with one bincount of the composite key
+    zone * classes + class (np.unique when the key range is too large).
+
+    Parameters
+    ==========
+    zones (str): Integer zone raster.
+    values (str): Integer class raster.
+    labels (dict): (optional) Class labels {value: label}, defaults to
+                   the categories of the class raster.
+    chunk_rows (int): (optional) Number of rows read per block.
+
+    Returns
+    =======
+    DataFrame with one row per zone and class: zone, class, label,
+    cells, area (map units), share (of the zone area), and dominant
+    (True for the most common class of the zone).
+    """
+    zone_info = gs.raster_info(zones)
+    value_info = gs.raster_info(values)
+    zone_min, zone_max = int(zone_info["min"]), int(zone_info["max"])
+    value_min, value_max = int(value_info["min"]), int(value_info["max"])
+    n_values = value_max - value_min + 1
+    size = (zone_max - zone_min + 1) * n_values
+    dense = size <= 2**26
+    counts = np.zeros(size, dtype=np.int64) if dense else {}
+    for _, (zone, value) in _raster_chunks([zones, values], chunk_rows):
+        valid = ~np.isnan(zone) & ~np.isnan(value)
+        key = (zone[valid].astype(np.int64) - zone_min) * n_values + (
+            value[valid].astype(np.int64) - value_min
+        )
+        if dense:
+            counts += np.bincount(key, minlength=size)
+        else:
+            for k, c in zip(*np.unique(key, return_counts=True)):
+                counts[k] = counts.get(k, 0) + c
+    if dense:
+        keys = np.flatnonzero(counts)
+        cells = counts[keys]
+    else:
+        keys = np.array(sorted(counts), dtype=np.int64)
+        cells = np.array([counts[k] for k in keys], dtype=np.int64)
+
+    region = gs.region()
+    cell_area = float(region["nsres"]) * float(region["ewres"])
+    labels = _raster_labels(values) if labels is None else labels
+    df = pd.DataFrame(
+        {
+            "zone": keys // n_values + zone_min,
+            "class": keys % n_values + value_min,
+            "cells": cells,
+        }
+    )
+    df["label"] = df["class"].map(labels)
+    df["area"] = df["cells"] * cell_area
+    zone_cells = df.groupby("zone")["cells"].transform("sum")
+    df["share"] = df["cells"] / zone_cells
+    df["dominant"] = df["cells"] == df.groupby("zone")["cells"].transform(
+        "max"
+    )
+    return df[
+        ["zone", "class", "label", "cells", "area", "share", "dominant"]
+    ]
+
+
+def zonal_dominant(crosstab):
+    """
+    Dominant class of each zone of a <zonal_crosstab> table (ties go
+    to the lowest class value).
+
+    Returns
+    =======
+    DataFrame with one row per zone: zone, cells, area, dominant class,
+    its label and share.
+    """
+    totals = crosstab.groupby("zone")[["cells", "area"]].sum()
+    dominant = (
+        crosstab[crosstab["dominant"]]
+        .sort_values(["zone", "class"])
+        .drop_duplicates("zone")
+        .set_index("zone")[["class", "label", "share"]]
+    )
+    return totals.join(dominant).reset_index()
+
+
+"""
+Import UAS Data
+=================
+"""
+
+
+def _tile_regions(rows, cols, nprocs, overlap=0, cores=False):
+    """
+    Splits the current region into about nprocs row and column tiles
+    with overlap cells of buffer, saved as named regions.
+
+    Returns
+    =======
+    List of saved region names, or with cores set, of (name, core)
+    where core is ((first row, end row), (first col, end col)) of the
+    tile without its buffer, relative to the tile.
+    """
+    region = gs.region()
+    nsres, ewres = float(region["nsres"]), float(region["ewres"])
+    ny = max(1, int(np.floor(np.sqrt(nprocs))))
+    nx = max(1, int(np.ceil(nprocs / ny)))
+    names = []
+    run_id = f"{os.getpid()}_{os.urandom(3).hex()}"
+    for i in range(ny):
+        for j in range(nx):
+            r0 = max(0, i * rows // ny - overlap)
+            r1 = min(rows, (i + 1) * rows // ny + overlap)
+            c0 = max(0, j * cols // nx - overlap)
+            c1 = min(cols, (j + 1) * cols // nx + overlap)
+            name = f"tmp_tile_{run_id}_{i}_{j}"
+            gs.run_command(
+                "g.region",
+                n=region["n"] - r0 * nsres,
+                s=region["n"] - r1 * nsres,
+                w=region["w"] + c0 * ewres,
+                e=region["w"] + c1 * ewres,
+                save=name,
+                flags="u",
+            )
+            if cores:
+                core = (
+                    (i * rows // ny - r0, (i + 1) * rows // ny - r0),
+                    (j * cols // nx - c0, (j + 1) * cols // nx - c0),
+                )
+                names.append((name, core))
+            else:
+                names.append(name)
+    return names
+
+
+@traced_stage
+def fill_gaps(raster, output, nprocs=4, overlap=50):
+    """
+    Fills null cells of a raster by bilinear spline interpolation
+    (r.resamp.bspline -n) in overlapping tiles run in parallel. Cells
+    with values are kept as they are.
+
+    Parameters
+    ==========
+    raster (str): Name of the raster with gaps.
+    output (str): Name of the filled raster.
+    nprocs (int): (optional) Number of tiles interpolated at once.
+    overlap (int): (optional) Buffer of each tile in cells.
+
+    Returns
+    =======
+    output
+    """
+    region = gs.region()
+    tiles = _tile_regions(region["rows"], region["cols"], nprocs, overlap)
+    with TemporaryMaps(f"tmp_{output}") as tmp:
+        filled = [tmp.name(f"fill_{k}", stage="fill_gaps")
+                  for k in range(len(tiles))]
+
+        def fill(tile, tile_output):
+            env = os.environ.copy()
+            env["WIND_OVERRIDE"] = tile
+            gs.run_command(
+                "r.resamp.bspline",
+                input=raster,
+                output=tile_output,
+                method="bilinear",
+                flags="n",
+                env=env,
+                quiet=True,
+            )
+
+        with ThreadPoolExecutor(max_workers=nprocs) as executor:
+            list(executor.map(fill, tiles, filled))
+        gs.run_command(
+            "g.remove", type="region", name=tiles, flags="f", quiet=True
+        )
+        patched = tmp.name("patched", stage="fill_gaps")
+        gs.run_command("r.patch", input=filled, output=patched)
+        gs.mapcalc(f"{output} = if(isnull({raster}), {patched}, {raster})")
+    return output
+
+
+@traced_stage
+def rasterize_point_cloud(
+    laz_input, output, res=0.5, nprocs=4, fill=True, overwrite=False,
+    stats=()
+):
+    """
+    Bins a point cloud straight into rasters with r.in.pdal, without
+    importing the points as a vector map. Each binning method is one
+    pass over the points, so the statistics besides the highest point
+    are only binned when requested (in parallel passes).
+
+    Outputs
+    =======
+    <output>_max: Highest point per cell (DSM)
+    <output>_min: Lowest point per cell, if "min" is in stats
+    <output>_count: Number of points per cell, if "count" is in stats
+    <output>_density: Points per square map unit, if "count" is in
+                      stats
+    <output>: DSM with the empty cells interpolated (<fill_gaps>) if
+              fill is set, otherwise the highest point per cell
+
+    Parameters
+    ==========
+    laz_input (str): Point cloud file (.laz, .las).
+    output (str): Name (prefix) of the output rasters.
+    res (float): (optional) Cell size in map units.
+    nprocs (int): (optional) Number of parallel processes.
+    fill (bool): (optional) Interpolate the empty cells of the DSM.
+    overwrite (bool): (optional) Overwrite existing rasters.
+    stats (list): (optional) Extra statistics to bin, "min" and/or
+                  "count".
+
+    Returns
+    =======
+    output
+    """
+    methods = {"max": "max", "min": "min", "count": "n"}
+    unknown = set(stats) - {"min", "count"}
+    if unknown:
+        raise ValueError(f"Unknown point cloud statistics: {unknown}")
+    with temp_region():
+        # r.in.pdal -g prints the extent on one line
+        extent = gs.parse_command(
+            "r.in.pdal",
+            input=laz_input,
+            flags="g",
+            parse=(gs.parse_key_val, {"vsep": " "}),
+        )
+        gs.run_command(
+            "g.region",
+            n=extent["n"],
+            s=extent["s"],
+            e=extent["e"],
+            w=extent["w"],
+            res=res,
+            flags="a",
+        )
+
+        def rasterize(name):
+            gs.run_command(
+                "r.in.pdal",
+                input=laz_input,
+                output=f"{output}_{name}",
+                method=methods[name],
+                overwrite=overwrite,
+                quiet=True,
+            )
 
-    class_list = range(0, 7)
-    classnames = [
-        "road",
-        "building",
-        "barren",
-        "forest",
-        "grass",
-        "water",
-        "developed"
-    ]
+        print(f"Binning Point Cloud: {laz_input}")
+        with ThreadPoolExecutor(max_workers=nprocs) as executor:
+            list(executor.map(rasterize, ["max"] + list(stats)))
+        if "count" in stats:
+            gs.mapcalc(
+                f"{output}_density = {output}_count / (nsres() * ewres())",
+                overwrite=overwrite,
+            )
+        if fill:
+            print(f"Filling DSM Gaps: {output}")
+            fill_gaps(f"{output}_max", output, nprocs=nprocs)
+        else:
+            gs.mapcalc(f"{output} = {output}_max", overwrite=overwrite)
+        gs.run_command("r.colors", map=output, color="elevation", flags="e")
+    return output
 
-    expression = ""
-    closing = ""
-    for fc in class_list:
-        for tc in class_list:
-            if fc != tc:
-                change_key = f"{classnames[fc]} to {classnames[tc]}"
-                change_value = change_priority[change_key]
-                expression += expression_builder(fc, tc, change_value)
-                closing += ")"
-    expression += "0"
-    expression += closing
-    gs.mapcalc(f"{output} = {expression}")
-    gs.run_command("r.colors", map=output, color="plasma")
+
+def _window_extreme(z, radius, func):
+    """
+    Minimum or maximum (func) of the (2 radius + 1) square window
+    around each cell, computed separably along rows and columns.
+    """
+    if radius < 1:
+        return z
+    view = np.lib.stride_tricks.sliding_window_view
+    padded = np.pad(z, radius, mode="edge")
+    rows = func(view(padded, 2 * radius + 1, axis=0), axis=-1)
+    return func(view(rows, 2 * radius + 1, axis=1), axis=-1)
 
 
-"""
-Import UAS Data
-=================
-"""
+def _progressive_morphological_filter(
+    z, cell, max_window=20, slope=0.15, initial_distance=0.15,
+    max_distance=2.5
+):
+    """
+    Progressive morphological filter (Zhang et al. 2003) of a gridded
+    lowest point surface. Opens the surface with windows doubling in
+    size up to max_window (map units) and drops cells where the opening
+    lowers the surface of the previous window by more than the slope
+    dependent height threshold of the window.
+
+    Returns
+    =======
+    Boolean array, True for ground cells.
+    """
+    ground = np.ones(z.shape, dtype=bool)
+    surface = z
+    previous = 1
+    radius = 1
+    while (2 * radius + 1) * cell <= max_window:
+        window = 2 * radius + 1
+        eroded = _window_extreme(surface, radius, np.min)
+        opened = _window_extreme(eroded, radius, np.max)
+        threshold = min(
+            initial_distance + slope * (window - previous) * cell,
+            max_distance,
+        )
+        # Height above the opening of the previous window
+        ground &= (surface - opened) <= threshold
+        surface = opened
+        previous = window
+        radius *= 2
+    return ground
+
+
+def _ground_tile(args):
+    """
+    Runs the morphological filter on one buffered tile and returns
+    the ground mask of the tile core.
+    """
+    surface, core, params = args
+    (r0, r1), (c0, c1) = core
+    return _progressive_morphological_filter(surface, **params)[r0:r1, c0:c1]
+
+
+@traced_stage
+def classify_ground(
+    laz_input,
+    output,
+    points=None,
+    res=0.5,
+    nprocs=4,
+    max_window=20,
+    slope=0.15,
+    initial_distance=0.15,
+    max_distance=2.5,
+    tile_size=1024,
+    overwrite=False,
+    lowest=None,
+):
+    """
+    Separates ground from vegetation and buildings in a point cloud
+    with a progressive morphological filter and interpolates a bare
+    earth DTM from the ground cells.
+
+    The filter runs on the lowest point of each res cell. The grid is
+    split into tiles with a buffer of max_window (see <_tile_regions>)
+    that are read one at a time and filtered in parallel processes.
+
+    Parameters
+    ==========
+    laz_input (str): Point cloud file (.laz, .las).
+    output (str): Name of the output DTM raster.
+    points (str): (optional) Name of the output vector map of bare
+                  earth points (lowest ground point per cell, 3D).
+    res (float): (optional) Cell size in map units.
+    nprocs (int): (optional) Number of parallel processes.
+    max_window (float): (optional) Largest window in map units, about
+                        the width of the largest building.
+    slope (float): (optional) Terrain slope (rise over run).
+    initial_distance (float): (optional) Height threshold of the
+                              smallest window in map units.
+    max_distance (float): (optional) Largest height threshold in map
+                          units.
+    tile_size (int): (optional) Rows and columns of a tile.
+    overwrite (bool): (optional) Overwrite existing outputs.
+    lowest (str): (optional) Raster of the lowest point per cell
+                  already binned from laz_input, e.g. <output>_min of
+                  <rasterize_point_cloud>. Its grid is used instead of
+                  res and the point cloud is not read again.
+
+    Returns
+    =======
+    output
+    """
+    with TemporaryMaps(f"tmp_{output}") as tmp, temp_region():
+        if lowest is None:
+            binned = tmp.name("binned", stage="classify_ground")
+            rasterize_point_cloud(
+                laz_input, binned, res=res, nprocs=nprocs, fill=False,
+                stats=["min"]
+            )
+            for name in ["max", "min"]:
+                tmp.add(f"{binned}_{name}", stage="classify_ground")
+            lowest = f"{binned}_min"
+        gs.run_command("g.region", raster=lowest)
+        region = gs.region()
+        res = float(region["nsres"])
+        params = {
+            "cell": res,
+            "max_window": max_window,
+            "slope": slope,
+            "initial_distance": initial_distance,
+            "max_distance": max_distance,
+        }
+        buffer = int(np.ceil(max_window / res))
+        # Empty cells take interpolated values so they do not open
+        # holes in the morphological surface
+        filled = tmp.name("lowest", stage="classify_ground")
+        fill_gaps(lowest, filled, nprocs=nprocs)
+
+        print(f"Classifying Ground: {lowest}")
+        rows, cols = int(region["rows"]), int(region["cols"])
+        n_tiles = int(np.ceil(rows / tile_size) * np.ceil(cols / tile_size))
+        tiles = _tile_regions(rows, cols, n_tiles, buffer, cores=True)
+        ground_tiles = [
+            tmp.name(f"ground_{k}", stage="classify_ground")
+            for k in range(len(tiles))
+        ]
+        counts = [0, 0]
+
+        def write_tile(tile, core, z, name, mask):
+            # Only the core of the tile, the buffer is filtered with
+            # less context
+            (r0, r1), (c0, c1) = core
+            empty = np.isnan(z[r0:r1, c0:c1])
+            mask &= ~empty
+            counts[0] += mask.sum()
+            counts[1] += (~empty).sum()
+            gs.run_command("g.region", region=tile)
+            box = gs.region()
+            nsres, ewres = float(box["nsres"]), float(box["ewres"])
+            gs.run_command(
+                "g.region",
+                n=box["n"] - r0 * nsres,
+                s=box["n"] - r1 * nsres,
+                w=box["w"] + c0 * ewres,
+                e=box["w"] + c1 * ewres,
+            )
+            _write_chunks(name, [np.where(mask, z[r0:r1, c0:c1], np.nan)])
+
+        # The tiles are read and written one at a time while up to
+        # nprocs of them are filtered in parallel processes
+        with ProcessPoolExecutor(max_workers=nprocs) as executor:
+            pending = deque()
+            for (tile, core), name in zip(tiles, ground_tiles):
+                gs.run_command("g.region", region=tile)
+                surface, z = _read_raster(filled), _read_raster(lowest)
+                future = executor.submit(
+                    _ground_tile, (surface, core, params)
+                )
+                pending.append(((tile, core, z, name), future))
+                if len(pending) >= nprocs:
+                    args, future = pending.popleft()
+                    write_tile(*args, future.result())
+            while pending:
+                args, future = pending.popleft()
+                write_tile(*args, future.result())
+        gs.run_command(
+            "g.remove", type="region", name=[t for t, _ in tiles],
+            flags="f", quiet=True
+        )
+        print(f"Ground Cells: {counts[0]} of {counts[1]}")
+
+        gs.run_command("g.region", raster=lowest)
+        ground_z = tmp.name("ground", stage="classify_ground")
+        gs.run_command("r.patch", input=ground_tiles, output=ground_z)
+        if points:
+            gs.run_command(
+                "r.to.vect",
+                input=ground_z,
+                output=points,
+                type="point",
+                flags="z",
+                overwrite=overwrite,
+            )
+        print(f"Generating DTM: {output}")
+        fill_gaps(ground_z, output, nprocs=nprocs)
+        gs.run_command("r.colors", map=output, color="elevation", flags="e")
+    return output
 
 
+@traced_stage
 def import_uas_data(
     dtm_input,
     dtm_output,
@@ -997,9 +3159,11 @@ def import_uas_data(
     laz_output,
     laz_dsm,
     res=0.5,
-    memory=300,
-    nprocs=1,
+    memory=None,
+    nprocs=None,
     overwrite=False,
+    laz_be_pc=None,
+    laz_dem=None,
 ):
     """
     Imports DSM, DTM, Ortho, and point cloud data from WebDOM.
@@ -1010,24 +3174,29 @@ def import_uas_data(
     @param ortho_input : string : file location (.tif)
     @param ortho_output : string : Output file name
     @param ortho_composite: string :  Output file name of composite image
-    @param laz_input : string : file location (.laz)
-    @param laz_output : string : Output file name
+    @param laz_input : string : file location (.laz), skipped if None
+    @param laz_output : string : Output name (prefix) of the binned point
+                        cloud rasters (_max, and _min with laz_dem)
     @param laz_dsm : Output file name of point cloud derived DSM
-    @param laz_be_pc : DOES NOT WORK Output file name of bare earth point cloud
-    @param laz_dem : DOES NOT WORK Output file name of point cloud derived DEM
+    @param laz_be_pc : Output name of bare earth point cloud (vector)
+    @param laz_dem : Output file name of point cloud derived DEM
+                     (bare earth, see classify_ground)
     @param res : The the import resolution (Dfault = 0.5)
-    @param memory : Allocate memeory for import steps (Default = 300)
-    @param nprocs : Total processes used during interpolation (Default = 1)
+    @param memory : Allocate memeory for import steps
+                    (Default = compute budget, see ComputeBudget)
+    @param nprocs : Total processes used during interpolation
+                    (Default = compute budget, see ComputeBudget)
     @param overwrite : Overwrite existing files (Default = False)
 
     """
+    nprocs = nprocs or compute_budget().nprocs
     print("*" * 100)
     print("Starting UAS Import")
     print(f"Setting Region with {res} resolution")
     gs.run_command("g.region", res=res, flags="ap")
 
     print(f"Importing DTM: {dtm_output}")
-    gs.run_command(
+    run_with_progress(
         "r.import",
         input=dtm_input,
         memory=memory,
@@ -1039,7 +3208,7 @@ def import_uas_data(
     gs.run_command("r.colors", map=dtm_output, color="elevation", flags="e")
 
     print(f"Importing DSM: {dsm_output}")
-    gs.run_command(
+    run_with_progress(
         "r.import",
         input=dsm_input,
         memory=memory,
@@ -1049,7 +3218,7 @@ def import_uas_data(
     )
 
     print(f"Importing Ortho: {ortho_output}")
-    gs.run_command(
+    run_with_progress(
         "r.import",
         input=ortho_input,
         memory=memory,
@@ -1069,40 +3238,31 @@ def import_uas_data(
         output=ortho_composite,
         overwrite=overwrite,
     )
-    #     print(f"Importing Point Cloud (DSM): {laz_output}")
-    #     gs.run_command("v.in.pdal",
-    #                  input=laz_input,
-    #                  output=laz_output,
-    #                  flags="w",
-    #                  # input_srs="EPSG:4326",
-    #                  overwrite=overwrite
-    #               )
-    #     # Set  computaional region to imported raster data
-    #     gs.run_command(
-    #        "g.region",
-    #        raster=ortho_composite,
-    #        res=res,
-    #        flags="ap"
-    #     )
-
-    #     print(f"Generating DSM: {laz_output}")
-    #     gs.run_command("v.surf.rst",
-    #                  input=laz_output,
-    #                  elevation=laz_dsm,
-    #                  npmin=120,
-    #                  segmax=25,
-    #                  tension=100,
-    #                  smooth=0.5,
-    #                  dmin=1,
-    #                  mask=ortho_composite,
-    #                  nprocs=nprocs,
-    #                  overwrite=overwrite
-    #               )
+    if laz_input:
+        print(f"Importing Point Cloud (DSM): {laz_output}")
+        with temp_region():
+            rasterize_point_cloud(
+                laz_input, laz_output, res=res, nprocs=nprocs, fill=False,
+                overwrite=overwrite, stats=["min"] if laz_dem else []
+            )
+            gs.run_command("g.region", raster=f"{laz_output}_max")
+            print(f"Generating DSM: {laz_dsm}")
+            fill_gaps(f"{laz_output}_max", laz_dsm, nprocs=nprocs)
+            gs.run_command(
+                "r.colors", map=laz_dsm, color="elevation", flags="e"
+            )
+        if laz_dem:
+            print(f"Generating DEM: {laz_dem}")
+            classify_ground(
+                laz_input, laz_dem, points=laz_be_pc, res=res, nprocs=nprocs,
+                overwrite=overwrite, lowest=f"{laz_output}_min"
+            )
 
     print("Import Complete")
     print("*" * 100)
 
 
+@traced_stage
 def resample_uas_data(
     dtm,
     dtm_output,
@@ -1416,20 +3576,312 @@ def rmse(df, predictions, targets):
     return np.sqrt(((df[predictions] - df[targets]) ** 2).mean())
 
 
+"""
+Raster Expressions
+=================
+"""
+
+
+def _shift_array(array, rows, cols):
+    """
+    Returns array[i + rows, j + cols] with NaN outside the array, the
+    NumPy equivalent of the r.mapcalc modifier map[rows,cols].
+    """
+    if not rows and not cols:
+        return array
+    out = np.full(array.shape, np.nan)
+    n, m = array.shape
+    if abs(rows) >= n or abs(cols) >= m:
+        return out
+    dst_r = slice(max(-rows, 0), n - max(rows, 0))
+    src_r = slice(max(rows, 0), n - max(-rows, 0))
+    dst_c = slice(max(-cols, 0), m - max(cols, 0))
+    src_c = slice(max(cols, 0), m - max(-cols, 0))
+    out[dst_r, dst_c] = array[src_r, src_c]
+    return out
+
+
+class RasterExpr:
+    """
+    Lazy raster expression. Shifts, offsets, differences and masks
+    compose into one expression that is only computed when it is
+    materialized, either as a single r.mapcalc expression or as one
+    chunked NumPy pass.
+
+    str(expr) returns the r.mapcalc expression, so an expression can be
+    used wherever a raster name is put into an r.mapcalc expression.
+
+    Example
+    =======
+    uas = RasterExpr.map("uas").shift(-5, -1)
+    diff = (uas - 0.3 - RasterExpr.map("dem")).mask(uas >= 0)
+    diff.materialize("uas_diff")
+    """
+
+    _NUMPY_OPS = {
+        "+": np.add,
+        "-": np.subtract,
+        "*": np.multiply,
+        "/": np.divide,
+        ">": np.greater,
+        ">=": np.greater_equal,
+        "<": np.less,
+        "<=": np.less_equal,
+    }
+
+    def __init__(self, kind, *args):
+        self.kind = kind
+        self.args = args
+
+    @classmethod
+    def map(cls, name):
+        """
+        Expression of an existing raster.
+        """
+        return cls("map", name)
+
+    @classmethod
+    def wrap(cls, value):
+        """
+        Converts raster names and numbers to expressions.
+        """
+        if isinstance(value, RasterExpr):
+            return value
+        if isinstance(value, str):
+            return cls.map(value)
+        return cls("const", float(value))
+
+    def _binary(self, op, other, reverse=False):
+        other = RasterExpr.wrap(other)
+        if reverse:
+            return RasterExpr("op", op, other, self)
+        return RasterExpr("op", op, self, other)
+
+    def __add__(self, other):
+        return self._binary("+", other)
+
+    def __radd__(self, other):
+        return self._binary("+", other, reverse=True)
+
+    def __sub__(self, other):
+        return self._binary("-", other)
+
+    def __rsub__(self, other):
+        return self._binary("-", other, reverse=True)
+
+    def __mul__(self, other):
+        return self._binary("*", other)
+
+    def __rmul__(self, other):
+        return self._binary("*", other, reverse=True)
+
+    def __truediv__(self, other):
+        return self._binary("/", other)
+
+    def __gt__(self, other):
+        return self._binary(">", other)
+
+    def __ge__(self, other):
+        return self._binary(">=", other)
+
+    def __lt__(self, other):
+        return self._binary("<", other)
+
+    def __le__(self, other):
+        return self._binary("<=", other)
+
+    def shift(self, rows, cols):
+        """
+        Shifts the expression by rows and columns (the r.mapcalc
+        modifier map[rows,cols]). The shift is pushed down to the
+        rasters, so chained shifts add up.
+        """
+        return RasterExpr("shift", self, int(rows), int(cols))
+
+    def subpixel_shift(self, rows, cols):
+        """
+        Shifts the expression by fractional rows and columns with
+        bilinear interpolation of the four surrounding integer shifts.
+        """
+        r0, c0 = int(np.floor(rows)), int(np.floor(cols))
+        fr, fc = rows - r0, cols - c0
+        if not fr and not fc:
+            return self.shift(r0, c0)
+        result = None
+        for dr, wr in ((0, 1 - fr), (1, fr)):
+            for dc, wc in ((0, 1 - fc), (1, fc)):
+                if wr * wc == 0:
+                    continue
+                term = self.shift(r0 + dr, c0 + dc) * (wr * wc)
+                result = term if result is None else result + term
+        return result
+
+    def mask(self, condition):
+        """
+        Keeps the values where condition is true, null elsewhere.
+        """
+        return RasterExpr("if", RasterExpr.wrap(condition), self)
+
+    def maps(self):
+        """
+        Names of the rasters used by the expression.
+        """
+        if self.kind == "map":
+            return [self.args[0]]
+        names = []
+        for arg in self.args:
+            if isinstance(arg, RasterExpr):
+                names += [n for n in arg.maps() if n not in names]
+        return names
+
+    def max_row_shift(self, rows=0):
+        """
+        Largest number of rows the expression reads away from a cell.
+        """
+        if self.kind == "map":
+            return abs(rows)
+        if self.kind == "shift":
+            return self.args[0].max_row_shift(rows + self.args[1])
+        return max(
+            [0]
+            + [
+                arg.max_row_shift(rows)
+                for arg in self.args
+                if isinstance(arg, RasterExpr)
+            ]
+        )
+
+    def to_mapcalc(self, rows=0, cols=0):
+        """
+        Builds the r.mapcalc expression.
+        """
+        if self.kind == "map":
+            name = self.args[0]
+            return f"{name}[{rows},{cols}]" if rows or cols else name
+        if self.kind == "const":
+            return repr(self.args[0])
+        if self.kind == "shift":
+            expr, r, c = self.args
+            return expr.to_mapcalc(rows + r, cols + c)
+        if self.kind == "op":
+            op, left, right = self.args
+            return (
+                f"({left.to_mapcalc(rows, cols)} {op} "
+                f"{right.to_mapcalc(rows, cols)})"
+            )
+        condition, value = self.args
+        return (
+            f"if({condition.to_mapcalc(rows, cols)}, "
+            f"{value.to_mapcalc(rows, cols)}, null())"
+        )
+
+    def __str__(self):
+        return self.to_mapcalc()
+
+    def evaluate(self, arrays, rows=0, cols=0):
+        """
+        Evaluates the expression on NumPy arrays (NaN is null).
+
+        Parameters
+        ==========
+        arrays (dict): Raster name to 2D array, all of the same shape.
+
+        Returns
+        =======
+        ndarray
+        """
+        if self.kind == "map":
+            return _shift_array(arrays[self.args[0]], rows, cols)
+        if self.kind == "const":
+            return self.args[0]
+        if self.kind == "shift":
+            expr, r, c = self.args
+            return expr.evaluate(arrays, rows + r, cols + c)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            if self.kind == "op":
+                op, left, right = self.args
+                a = left.evaluate(arrays, rows, cols)
+                b = right.evaluate(arrays, rows, cols)
+                result = RasterExpr._NUMPY_OPS[op](a, b)
+                if op in ("+", "-", "*", "/"):
+                    return result
+                # Comparisons with null are null, as in r.mapcalc
+                return np.where(
+                    np.isnan(a) | np.isnan(b), np.nan, result.astype(float)
+                )
+            condition, value = self.args
+            c = condition.evaluate(arrays, rows, cols)
+            v = value.evaluate(arrays, rows, cols)
+            return np.where(np.isnan(c) | (c == 0), np.nan, v)
+
+    def chunks(self, chunk_rows=512, report=None):
+        """
+        Evaluates the expression in one chunked pass over the current
+        region. Rows of the neighbouring chunks are kept in memory so
+        row shifts can read across chunk boundaries.
+
+        Returns
+        =======
+        Generator of evaluated blocks of rows.
+        """
+        names = self.maps()
+        windows = _raster_windows(
+            names, chunk_rows, self.max_row_shift(), report
+        )
+        for blocks, start, stop in windows:
+            arrays = dict(zip(names, blocks))
+            shape = blocks[0].shape
+            result = np.broadcast_to(self.evaluate(arrays), shape)
+            yield np.asarray(result, dtype=np.float64)[start:stop]
+
+    def materialize(self, output, engine="mapcalc", mtype="DCELL"):
+        """
+        Writes the expression to a raster in the current region.
+
+        Parameters
+        ==========
+        output (str): Name of the output raster.
+        engine (str): (optional) "mapcalc" for one r.mapcalc
+                      expression, "numpy" for one chunked NumPy pass.
+        mtype (str): (optional) Raster type of the NumPy output.
+
+        Returns
+        =======
+        output
+        """
+        if engine == "numpy":
+            return _write_chunks(output, self.chunks(), mtype=mtype)
+        gs.mapcalc(f"{output} = {self}")
+        return output
+
+
+def _region_map(raster):
+    """
+    Name of a raster that can set the region for a raster or
+    <RasterExpr>.
+    """
+    if isinstance(raster, RasterExpr):
+        return raster.maps()[0]
+    return raster
+
+
 """
 Fusion
 =================
 """
 
 
-def geographic_correct_dem(dem, output, row_shift=0, column_shift=0):
+@traced_stage
+def geographic_correct_dem(dem, output=None, row_shift=0, column_shift=0):
     """
     Geographic Registration
     @param dem string Input raster name
-    @param output string Output raster name
-    @param row_shift int (default=-5)
+    @param output string Output raster name, if None the shift is
+                  returned as a lazy RasterExpr and nothing is written
+    @param row_shift int (default=-5), fractional shifts (e.g. from
+                     coregister_dem) are interpolated bilinearly
     @param column_shift int (default=-1)
-    @return output Shifted raster name
+    @return output Shifted raster name (or RasterExpr)
     """
     print(("#" * 25) + " Geographic Shift " + ("#" * 25))
     print(
@@ -1441,28 +3893,430 @@ def geographic_correct_dem(dem, output, row_shift=0, column_shift=0):
         """
     )
 
-    gs.mapcalc(
-        f"{output} = if({dem} >= 0, {dem}[{row_shift},{column_shift}], null())"
+    source = RasterExpr.map(dem)
+    shifted = source.subpixel_shift(row_shift, column_shift).mask(source >= 0)
+    if output is None:
+        return shifted
+    return shifted.materialize(output)
+
+
+def _read_raster(raster):
+    """
+    Reads a raster over the current region into a float array (null
+    cells are NaN).
+    """
+    return np.vstack([blocks[0] for _, blocks in _raster_chunks([raster])])
+
+
+def _slope_surface(elevation, nsres, ewres):
+    """
+    Slope (rise over run) of an elevation array, NaN cells set to 0.
+    """
+    dy, dx = np.gradient(elevation, nsres, ewres)
+    slope = np.hypot(dx, dy)
+    return np.nan_to_num(slope, nan=0.0)
+
+
+def _phase_correlation(a, b):
+    """
+    Estimates the (rows, cols) displacement d with a(x) = b(x - d) by
+    FFT phase correlation with a parabolic sub-pixel peak fit.
+
+    Returns
+    =======
+    rows, cols, peak (height of the correlation peak, 0-1)
+    """
+    window = np.outer(np.hanning(a.shape[0]), np.hanning(a.shape[1]))
+    fa = np.fft.fft2((a - a.mean()) * window)
+    fb = np.fft.fft2((b - b.mean()) * window)
+    cross = fa * np.conj(fb)
+    cross /= np.abs(cross) + 1e-12
+    corr = np.fft.ifft2(cross).real
+    peak = np.unravel_index(np.argmax(corr), corr.shape)
+    shift = []
+    for axis, index in enumerate(peak):
+        size = corr.shape[axis]
+        before = list(peak)
+        after = list(peak)
+        before[axis] = (index - 1) % size
+        after[axis] = (index + 1) % size
+        c0, c1, c2 = corr[tuple(before)], corr[peak], corr[tuple(after)]
+        denominator = c0 - 2 * c1 + c2
+        offset = 0.5 * (c0 - c2) / denominator if denominator else 0.0
+        value = index + offset
+        # Wrap to signed shifts
+        if value > size / 2:
+            value -= size
+        shift.append(value)
+    return shift[0], shift[1], float(corr[peak])
+
+
+@traced_stage
+def coregister_dem(uas, dem, max_size=2048, surface="slope"):
+    """
+    Estimates the sub-pixel horizontal offset between UAS data and a
+    reference DEM with FFT phase correlation, replacing a manual
+    row/column shift search.
+
+    Parameters
+    ==========
+    uas (str): Name of the UAS raster.
+    dem (str): Name of the reference DEM.
+    max_size (int): (optional) Largest number of rows or columns used,
+                    coarser cells are read for larger rasters.
+    surface (str): (optional) "slope" or "elevation" surface to match.
+                   Slope is not affected by a vertical offset.
+
+    Returns
+    =======
+    shift (dict): row_shift and column_shift (UAS cells) to pass to
+                  <geographic_correct_dem>, dx/dy in map units, and the
+                  correlation peak.
+    """
+    print(("#" * 25) + " Co-registration " + ("#" * 25))
+    with temp_region():
+        gs.run_command("g.region", raster=uas)
+        region = gs.region()
+        factor = max(
+            1, int(np.ceil(max(region["rows"], region["cols"]) / max_size))
+        )
+        if factor > 1:
+            gs.run_command(
+                "g.region", nsres=region["nsres"] * factor,
+                ewres=region["ewres"] * factor
+            )
+        coarse = gs.region()
+        nsres, ewres = float(coarse["nsres"]), float(coarse["ewres"])
+        # Read on the coarsened grid (see <_set_raster_region>)
+        uas_array = _read_raster(uas)
+        dem_array = _read_raster(dem)
+
+    valid = ~np.isnan(uas_array) & ~np.isnan(dem_array)
+    if surface == "slope":
+        a = _slope_surface(uas_array, nsres, ewres)
+        b = _slope_surface(dem_array, nsres, ewres)
+    else:
+        a = np.nan_to_num(uas_array - np.nanmean(uas_array))
+        b = np.nan_to_num(dem_array - np.nanmean(dem_array))
+    a[~valid] = 0
+    b[~valid] = 0
+    rows, cols, peak = _phase_correlation(a, b)
+    # g.region may round the coarse resolution, so scale by the actual
+    # ratio rather than by factor
+    shift = {
+        "row_shift": rows * nsres / float(region["nsres"]),
+        "column_shift": cols * ewres / float(region["ewres"]),
+        "dx": cols * ewres,
+        "dy": -rows * nsres,
+        "peak": peak,
+    }
+    print(
+        f"""
+        Row Shift: {shift['row_shift']:.2f}
+        Column Shift: {shift['column_shift']:.2f}
+        Offset (x, y): {shift['dx']:.2f}m, {shift['dy']:.2f}m
+        Correlation Peak: {peak:.3f}
+        """
+    )
+    return shift
+
+
+@traced_stage
+def build_pyramid(raster, levels=3, factor=2, tmp=None):
+    """
+    Builds a resolution pyramid of a raster over the current region.
+    Each level averages factor x factor cells of the level below
+    (r.resamp.stats -w).
+
+    Parameters
+    ==========
+    raster (str): Name of the raster (level 0).
+    levels (int): (optional) Number of coarser levels.
+    factor (int): (optional) Resolution step between levels.
+    tmp (TemporaryMaps): (optional) Registry used to name the levels.
+
+    Returns
+    =======
+    pyramid (list): Raster names from level 0 (raster) to the coarsest
+                    level.
+    """
+    region = gs.region()
+    base = raster.split("@")[0]
+    pyramid = [raster]
+    with temp_region():
+        for level in range(1, levels + 1):
+            name = (
+                tmp.name(f"{base}_level{level}", stage="pyramid")
+                if tmp
+                else f"{base}_level{level}"
+            )
+            gs.run_command(
+                "g.region",
+                nsres=region["nsres"] * factor**level,
+                ewres=region["ewres"] * factor**level,
+            )
+            gs.run_command(
+                "r.resamp.stats",
+                input=pyramid[-1],
+                output=name,
+                method="average",
+                flags="w",
+                overwrite=True,
+            )
+            pyramid.append(name)
+    return pyramid
+
+
+def _align_levels(read_level, levels, factor):
+    """
+    Coarse-to-fine shift and offset search of <align_pyramid>.
+
+    Parameters
+    ==========
+    read_level (function): Returns the UAS and DEM arrays of a level
+                           (0 is the finest) on the same grid and the
+                           nsres and ewres of that level.
+    levels (int): Number of coarser levels.
+    factor (int): Resolution step between levels.
+
+    Returns
+    =======
+    rows, cols (shift in level 0 cells, see <_shift_array>), offset
+    (UAS - DEM), peak (correlation peak of the finest level)
+    """
+    rows, cols, offset, peak = 0.0, 0.0, None, 0.0
+    for level in reversed(range(levels + 1)):
+        scale = factor**level
+        uas, dem, nsres, ewres = read_level(level)
+        r0, c0 = int(round(rows / scale)), int(round(cols / scale))
+        a = _shift_array(uas, r0, c0)
+        valid = ~np.isnan(a) & ~np.isnan(dem)
+        sa = _slope_surface(a, nsres, ewres)
+        sb = _slope_surface(dem, nsres, ewres)
+        sa[~valid] = 0
+        sb[~valid] = 0
+        dr, dc, peak = _phase_correlation(sa, sb)
+        if level < levels:
+            # Refine near the solution of the coarser level only
+            dr = float(np.clip(dr, -factor, factor))
+            dc = float(np.clip(dc, -factor, factor))
+        rows, cols = (r0 + dr) * scale, (c0 + dc) * scale
+        aligned = _shift_array(
+            uas, int(round(rows / scale)), int(round(cols / scale))
+        )
+        diff = (aligned - dem)[~np.isnan(aligned) & ~np.isnan(dem)]
+        if diff.size:
+            if offset is not None:
+                # Ground cells: within 3 robust deviations of the
+                # offset of the coarser level
+                mad = 1.4826 * np.median(np.abs(diff - offset))
+                near = np.abs(diff - offset) <= 3 * max(mad, 0.01)
+                diff = diff[near] if near.any() else diff
+            offset = float(np.median(diff))
+        print(
+            f"Level {level} ({a.shape[0]}x{a.shape[1]}): "
+            f"shift {rows:.2f}, {cols:.2f} cells, offset {offset}"
+        )
+    return rows, cols, offset or 0.0, peak
+
+
+@traced_stage
+def align_pyramid(uas, dem, levels=3, factor=2, window=512, tmp=None):
+    """
+    Estimates the horizontal shift and the vertical offset of UAS data
+    against a DEM on the same grid from coarse to fine.
+
+    The coarsest level is matched as a whole (phase correlation of
+    slope, median difference). Each finer level only refines the
+    solution within one cell of the level above, on a window of at
+    most window x window cells around the center, so most of the work
+    is done on rasters factor**(2 * level) times smaller.
+
+    Parameters
+    ==========
+    uas (str): Name of the UAS raster.
+    dem (str): Name of the DEM resampled to the UAS grid
+               (see <resample>).
+    levels (int): (optional) Number of coarser levels.
+    factor (int): (optional) Resolution step between levels.
+    window (int): (optional) Rows and columns read at the finer levels.
+    tmp (TemporaryMaps): (optional) Registry used to name the levels.
+
+    Returns
+    =======
+    shift (dict): row_shift and column_shift (UAS cells) to pass to
+                  <geographic_correct_dem>, offset (UAS - DEM) to pass
+                  to <vertically_corrected_uas>, dx/dy in map units,
+                  and the correlation peak of the finest level.
+    """
+    print(("#" * 25) + " Pyramid Alignment " + ("#" * 25))
+    with temp_region():
+        gs.run_command("g.region", raster=uas)
+        base = gs.region()
+        uas_levels = build_pyramid(uas, levels, factor, tmp=tmp)
+        dem_levels = build_pyramid(dem, levels, factor, tmp=tmp)
+        cy = (base["n"] + base["s"]) / 2
+        cx = (base["e"] + base["w"]) / 2
+
+        def read_level(level):
+            nsres = base["nsres"] * factor**level
+            ewres = base["ewres"] * factor**level
+            if level == levels:
+                gs.run_command(
+                    "g.region", raster=uas, nsres=nsres, ewres=ewres,
+                    flags="a"
+                )
+            else:
+                half_ns = min(window / 2 * nsres, (base["n"] - cy))
+                half_ew = min(window / 2 * ewres, (base["e"] - cx))
+                gs.run_command(
+                    "g.region",
+                    n=cy + half_ns,
+                    s=cy - half_ns,
+                    e=cx + half_ew,
+                    w=cx - half_ew,
+                    align=uas_levels[level],
+                )
+            return (
+                _read_raster(uas_levels[level]),
+                _read_raster(dem_levels[level]),
+                nsres,
+                ewres,
+            )
+
+        rows, cols, offset, peak = _align_levels(read_level, levels, factor)
+    shift = {
+        "row_shift": rows,
+        "column_shift": cols,
+        "offset": offset,
+        "dx": cols * base["ewres"],
+        "dy": -rows * base["nsres"],
+        "peak": peak,
+    }
+    print(
+        f"""
+        Row Shift: {shift['row_shift']:.2f}
+        Column Shift: {shift['column_shift']:.2f}
+        Vertical Offset: {shift['offset']:.3f}
+        Correlation Peak: {peak:.3f}
+        """
+    )
+    return shift
+
+
+@traced_stage
+def import_dsm(output, output_dir, input_srs, resolution, nprocs):
+    gs.run_command(
+        "r.in.usgs",
+        product="lidar",
+        output_name=output,
+        output_directory=output_dir,
+        input_srs=input_srs,
+        resolution=resolution,
+        nprocs=nprocs,
+        flags="k",
     )
+
+
+def _edge_distance_keep(valid, distance, nsres, ewres):
+    """
+    Tests which cells are more than distance (map units) away from the
+    nearest invalid cell. Cells outside the array count as invalid.
+
+    The squared Euclidean distance is the minimum over the column
+    offsets within distance of the horizontal distance plus the
+    distance to the nearest invalid cell in that column (the second
+    phase of the Meijster/Saito distance transform), capped at
+    distance.
+    """
+    rr = int(np.ceil(distance / nsres))
+    rc = int(np.ceil(distance / ewres))
+    invalid = np.pad(~valid, ((rr, rr), (rc, rc)), constant_values=True)
+    n = invalid.shape[0]
+    index = np.arange(n)[:, None]
+    above = np.maximum.accumulate(np.where(invalid, index, -n), axis=0)
+    below = np.minimum.accumulate(
+        np.where(invalid, index, 2 * n)[::-1], axis=0
+    )[::-1]
+    # Row distance to the nearest invalid cell of each column
+    rows = np.minimum(np.minimum(index - above, below - index), rr + 1)
+    column_d2 = (rows * nsres) ** 2
+    d2 = np.full(valid.shape, np.inf)
+    cols = valid.shape[1]
+    for dx in range(-rc, rc + 1):
+        shifted = column_d2[rr:-rr or None, rc + dx:rc + dx + cols]
+        d2 = np.minimum(d2, shifted + (dx * ewres) ** 2)
+    return valid & (d2 > distance**2)
+
+
+@traced_stage
+def edge_mask_distance(uas, distance, output=None, chunk_rows=1024):
+    """
+    Thins UAS data by removing all cells within distance (map units)
+    of a null cell or the edge of the data, on all sides, in one tiled
+    pass of a Euclidean distance transform. No mask rasters are
+    written.
+
+    Parameters
+    ==========
+    uas (str): Name of the UAS raster.
+    distance (float): Erosion distance in map units.
+    output (str): (optional) Name of the thinned UAS raster,
+                  default is <uas>_thin.
+    chunk_rows (int): (optional) Number of rows per tile.
+
+    Returns
+    =======
+    output
+    """
+    print(("#" * 25) + " Edge Mask (Distance) " + ("#" * 25))
+    output = output or f"{uas.split('@')[0]}_thin"
+    with temp_region():
+        gs.run_command("g.region", raster=uas)
+        region = gs.region()
+        nsres, ewres = float(region["nsres"]), float(region["ewres"])
+        halo = int(np.ceil(distance / nsres))
+
+        def thinned():
+            for (block,), start, stop in _raster_windows(
+                [uas], chunk_rows, halo
+            ):
+                valid = ~np.isnan(block) & (block != 0)
+                # Pad the rows missing at the edges of the region
+                top = halo - start
+                bottom = halo - (block.shape[0] - stop)
+                valid = np.pad(valid, ((top, bottom), (0, 0)))
+                keep = _edge_distance_keep(valid, distance, nsres, ewres)
+                keep = keep[top + start:top + stop]
+                yield np.where(keep, block[start:stop], np.nan)
+
+        _write_chunks(output, thinned(), mtype="DCELL")
+    print(f"Thin UAS: {output}")
     return output
 
 
-def import_dsm(output, output_dir, input_srs, resolution, nprocs):
-    gs.run_command(
-        "r.in.usgs",
-        product="lidar",
-        output_name=output,
-        output_directory=output_dir,
-        input_srs=input_srs,
-        resolution=resolution,
-        nprocs=nprocs,
-        flags="k",
-    )
+@traced_stage
+def edge_mask(uas, thres=-1, e=None, tmp=None, distance=None):
+    """
+    Thins the edges of UAS data.
 
+    Parameters
+    ==========
+    uas (str): Name of the UAS raster.
+    thres (int): (optional) Negative r.grow radius in cells.
+    e (float): (optional) Only trim the east edge by e map units.
+    tmp (TemporaryMaps): (optional) Registry used to name the masks.
+    distance (float): (optional) Erode all sides by distance map units
+                      with <edge_mask_distance> instead of r.grow.
 
-def edge_mask(uas, thres=-1, e=None):
+    Returns
+    =======
+    uas_thin
+    """
+    if distance is not None:
+        return edge_mask_distance(uas, distance)
     print(("#" * 25) + " Edge Mask " + ("#" * 25))
-    mask = f"{uas}_mask"
+    mask = tmp.name("mask", stage="edge_mask") if tmp else f"{uas}_mask"
     print(f"UAS Mask: {mask}")
     gs.mapcalc(f"{mask} = if({uas}, 1, null())")
     uas_thin = f"{uas}_thin"
@@ -1475,7 +4329,8 @@ def edge_mask(uas, thres=-1, e=None):
         # gs.run_command("g.region", n=n, e=e, s=s, w=w)
         gs.mapcalc(f"{uas_thin} = if({uas}, {uas}, null())")
     else:
-        thin = f"{mask}_thin"  # The thinned mask
+        # The thinned mask
+        thin = tmp.name("mask_thin", "edge_mask") if tmp else f"{mask}_thin"
         print(f"Thin UAS Mask: {thin}")
         gs.run_command(
             "r.grow", overwrite=True, input=mask, output=thin, radius=thres
@@ -1487,18 +4342,19 @@ def edge_mask(uas, thres=-1, e=None):
     return uas_thin
 
 
-def ground_dem(uas, uas_vert_c, dem, thres=0.1):
+@traced_stage
+def ground_dem(uas, uas_vert_c, dem, thres=0.1, tmp=None):
     """
     @param uas : UAS Data
     @param uas_vert_c : Vert Correct UAS
     @param dem : DEM Data
+    @param tmp : TemporaryMaps registry used to name the outputs
     @return ground:
     """
     print(("#" * 25) + " Ground DEM " + ("#" * 25))
-    ground_dem = "ground_dem"
-    gs.mapcalc(
-        f"{ground_dem} = if({uas_vert_c} - {dem} <= {thres}, {uas}, null())"
-    )
+    ground_dem = tmp.name("ground_dem") if tmp else "ground_dem"
+    vert_diff = RasterExpr.wrap(uas_vert_c) - dem
+    RasterExpr.wrap(uas).mask(vert_diff <= thres).materialize(ground_dem)
     print(
         f"""
             Output:
@@ -1506,7 +4362,11 @@ def ground_dem(uas, uas_vert_c, dem, thres=0.1):
                     {ground_dem}
         """
     )
-    ground_dem_point_sample = "ground_dem_point_sample"
+    ground_dem_point_sample = (
+        tmp.name("point_sample", stage="ground_dem")
+        if tmp
+        else "ground_dem_point_sample"
+    )
     gs.run_command(
         "r.random",
         flags="d",
@@ -1538,7 +4398,28 @@ def report_diff_stats(raster):
     return univar
 
 
-def import_dem(output, output_dir, nprocs):
+@traced_stage
+def import_dem(output, output_dir, nprocs=None, cache=None):
+    """
+    Imports the USGS NED 1/9 arc-second DEM for the current region.
+
+    Parameters
+    ==========
+    output (str): Name of the output DEM raster.
+    output_dir (str): Download directory used by r.in.usgs.
+    nprocs (int): (optional) Number of parallel downloads, defaults to
+                  the compute budget (see <ComputeBudget>).
+    cache (TileCache): (optional) Local tile cache, tiles already in
+                       the cache are not downloaded or imported again.
+
+    Returns
+    =======
+    output
+    """
+    if cache is not None:
+        return cache.mosaic(
+            output, nprocs=nprocs or compute_budget().nprocs
+        )
     gs.run_command(
         "r.in.usgs",
         product="ned",
@@ -1547,39 +4428,327 @@ def import_dem(output, output_dir, nprocs):
         output_directory=output_dir,
         nprocs=nprocs,
     )
+    return output
+
+
+def _bbox_intersects(a, b):
+    """
+    Tests if two (west, south, east, north) boxes overlap.
+    """
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def _bbox_contains(a, b):
+    """
+    Tests if box a contains box b.
+    """
+    return a[0] <= b[0] and a[1] <= b[1] and a[2] >= b[2] and a[3] >= b[3]
+
+
+class UsgsTileSource:
+    """
+    Lists and downloads DEM tiles from the USGS TNM Access API (the
+    service r.in.usgs uses).
+    """
+
+    API = "https://tnmaccess.nationalmap.gov/api/v1/products"
+
+    def __init__(
+        self,
+        dataset="National Elevation Dataset (NED) 1/9 arc-second",
+        prod_format="IMG",
+    ):
+        self.dataset = dataset
+        self.prod_format = prod_format
+
+    def list_tiles(self, bbox):
+        """
+        Lists the tiles intersecting a (west, south, east, north)
+        lat/lon box.
+
+        Returns
+        =======
+        List of {"id", "bbox", "url"} dictionaries.
+        """
+        from urllib.parse import urlencode
+        from urllib.request import urlopen
+
+        query = urlencode(
+            {
+                "datasets": self.dataset,
+                "bbox": ",".join(str(v) for v in bbox),
+                "prodFormats": self.prod_format,
+                "outputFormat": "JSON",
+                "max": 1000,
+            }
+        )
+        with urlopen(f"{self.API}?{query}") as response:
+            items = json.load(response)["items"]
+        return [
+            {
+                "id": item["sourceId"],
+                "bbox": [
+                    item["boundingBox"]["minX"],
+                    item["boundingBox"]["minY"],
+                    item["boundingBox"]["maxX"],
+                    item["boundingBox"]["maxY"],
+                ],
+                "url": item["downloadURL"],
+            }
+            for item in items
+        ]
+
+    def fetch(self, tile, directory):
+        """
+        Downloads a tile into directory, zip files are extracted.
+
+        Returns
+        =======
+        Path of the tile raster file.
+        """
+        import zipfile
+        from urllib.request import urlopen
+
+        path = os.path.join(directory, os.path.basename(tile["url"]))
+        with urlopen(tile["url"]) as response, open(path, "wb") as f:
+            shutil.copyfileobj(response, f)
+        if not zipfile.is_zipfile(path):
+            return path
+        with zipfile.ZipFile(path) as archive:
+            rasters = [
+                name
+                for name in archive.namelist()
+                if name.lower().endswith((".img", ".tif", ".tiff"))
+            ]
+            if rasters:
+                archive.extractall(directory)
+        os.remove(path)
+        if not rasters:
+            raise ValueError(
+                f"No raster (.img, .tif) in tile {tile['id']}: {tile['url']}"
+            )
+        return os.path.join(directory, rasters[0])
+
+
+class DirectoryTileSource:
+    """
+    Local directory standing in for the USGS service, e.g. to use the
+    tile cache offline or in tests. The directory holds the tile files
+    and a tiles.json listing them:
+
+    [{"id": "n36w079", "bbox": [west, south, east, north],
+      "file": "n36w079.tif"}, ...]
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "tiles.json")) as f:
+            self.tiles = json.load(f)
+
+    def list_tiles(self, bbox):
+        return [t for t in self.tiles if _bbox_intersects(t["bbox"], bbox)]
+
+    def fetch(self, tile, directory):
+        path = os.path.join(directory, os.path.basename(tile["file"]))
+        shutil.copy(os.path.join(self.directory, tile["file"]), path)
+        return path
 
 
-def resample(uas, dem, match_uas=True):
+class TileCache:
+    """
+    Persistent local cache of DEM tiles with a spatial index of the
+    tiles already fetched. Tiles are downloaded once, and any requested
+    region is mosaicked from the cached tiles (see <mosaic>).
+
+    The index (index.json in the cache directory) keeps the lat/lon
+    box and file of each tile, and the boxes already listed from the
+    source so a region that was covered before needs no service call.
+    """
+
+    # Size (degrees) of the grid cells of the spatial index
+    GRID = 0.25
+
+    def __init__(self, directory, source=None):
+        """
+        Parameters
+        ==========
+        directory (str): Cache directory, created if missing.
+        source (object): (optional) Tile source with list_tiles and
+                         fetch methods, default <UsgsTileSource>.
+        """
+        self.directory = directory
+        self.source = source if source is not None else UsgsTileSource()
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, "index.json")
+        self.index = {"tiles": {}, "listed": []}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        self._lock = threading.Lock()
+        self._build_grid()
+
+    def _grid_keys(self, bbox):
+        x0, y0, x1, y1 = (int(np.floor(v / self.GRID)) for v in bbox)
+        return [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+    def _build_grid(self):
+        self.grid = {}
+        for tile_id, tile in self.index["tiles"].items():
+            for key in self._grid_keys(tile["bbox"]):
+                self.grid.setdefault(key, set()).add(tile_id)
+
+    def _add(self, tile, path):
+        with self._lock:
+            self.index["tiles"][tile["id"]] = {
+                "bbox": tile["bbox"],
+                "file": os.path.relpath(path, self.directory),
+            }
+            for key in self._grid_keys(tile["bbox"]):
+                self.grid.setdefault(key, set()).add(tile["id"])
+            self._save()
+
+    def _save(self):
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f, indent=1)
+        os.replace(tmp_path, self.index_path)
+
+    def cached_tiles(self, bbox):
+        """
+        IDs of the cached tiles intersecting a lat/lon box.
+        """
+        ids = set()
+        for key in self._grid_keys(bbox):
+            ids |= self.grid.get(key, set())
+        return sorted(
+            tile_id
+            for tile_id in ids
+            if _bbox_intersects(self.index["tiles"][tile_id]["bbox"], bbox)
+        )
+
+    def fetch(self, bbox, nprocs=4):
+        """
+        Makes sure all tiles intersecting a (west, south, east, north)
+        lat/lon box are in the cache.
+
+        Returns
+        =======
+        List of the tile IDs.
+        """
+        listed = self.index["listed"]
+        if any(_bbox_contains(box, bbox) for box in listed):
+            return self.cached_tiles(bbox)
+        tiles = self.source.list_tiles(bbox)
+        missing = [t for t in tiles if t["id"] not in self.index["tiles"]]
+        print(f"Tiles: {len(tiles)}, Cached: {len(tiles) - len(missing)}")
+
+        def fetch_tile(tile):
+            tile_dir = os.path.join(self.directory, tile["id"])
+            os.makedirs(tile_dir, exist_ok=True)
+            self._add(tile, self.source.fetch(tile, tile_dir))
+
+        with ThreadPoolExecutor(max_workers=nprocs) as executor:
+            list(executor.map(fetch_tile, missing))
+        with self._lock:
+            self.index["listed"].append(list(bbox))
+            self._save()
+        return sorted(t["id"] for t in tiles)
+
+    def mosaic(self, output, nprocs=4):
+        """
+        Mosaics the cached tiles covering the current region into a
+        raster. Each tile is imported into the mapset clipped to the
+        region at the region resolution, once per source, region and
+        resolution, and reused by later calls for the same region.
+
+        Parameters
+        ==========
+        output (str): Name of the output raster.
+        nprocs (int): (optional) Number of parallel downloads.
+
+        Returns
+        =======
+        output
+        """
+        ll = gs.parse_command("g.region", flags="bg")
+        bbox = [
+            float(ll["ll_w"]),
+            float(ll["ll_s"]),
+            float(ll["ll_e"]),
+            float(ll["ll_n"]),
+        ]
+        region = gs.region()
+        res = float(region["nsres"])
+        # Imported tiles depend on the product, region and resolution
+        key = hashlib.sha256(
+            json.dumps(
+                [
+                    os.path.abspath(self.directory),
+                    getattr(self.source, "dataset", None),
+                    [region[k] for k in ("n", "s", "e", "w")],
+                    res,
+                ]
+            ).encode()
+        ).hexdigest()[:10]
+        maps = []
+        for tile_id in self.fetch(bbox, nprocs=nprocs):
+            name = f"tile_{tile_id}_{key}"
+            name = "".join(c if c.isalnum() else "_" for c in name)
+            if not gs.find_file(name, element="cell")["name"]:
+                run_with_progress(
+                    "r.import",
+                    input=os.path.join(
+                        self.directory, self.index["tiles"][tile_id]["file"]
+                    ),
+                    output=name,
+                    resample="bilinear",
+                    extent="region",
+                    resolution="region",
+                )
+            maps.append(name)
+        print(f"Mosaic {output} from {len(maps)} cached tiles")
+        if len(maps) == 1:
+            gs.mapcalc(f"{output} = {maps[0]}")
+        else:
+            gs.run_command("r.patch", input=maps, output=output)
+        return output
+
+
+@traced_stage
+def resample(uas, dem, match_uas=True, tmp=None):
     # resample uas to match lidar, or the other way round?
     print(("#" * 25) + " Resample " + ("#" * 25))
 
-    resampled = "tmp_resampled"
+    resampled = tmp.name("resampled") if tmp else "tmp_resampled"
     uas_ = uas
     dem_ = dem
 
     if not match_uas:
         print(f"Output Raster: Resampled to Match DEM: {resampled}")
+        if isinstance(uas, RasterExpr):
+            uas = uas.materialize(
+                tmp.name("uas", stage="resample") if tmp else "tmp_uas"
+            )
         gs.run_command("g.region", raster=uas, align=dem)
         gs.run_command("r.resamp.interp", input=uas, output=resampled)
         uas_ = resampled
     else:
         print(f"Output Raster: Resampled to Match UAS: {resampled}")
-        gs.run_command("g.region", raster=dem, align=uas)
+        gs.run_command("g.region", raster=dem, align=_region_map(uas))
         gs.run_command("r.resamp.interp", input=dem, output=resampled)
         dem_ = resampled
 
-    # TMP_RAST.append(resampled)
     return uas_, dem_
 
 
-def get_diff(uas, dem, mean_thr, output):
+@traced_stage
+def get_diff(uas, dem, mean_thr, output, tmp=None):
     # compute difference
     print(("#" * 25) + " Get Diff " + ("#" * 25))
-    diff = f"{output}_diff"
-    gs.run_command("g.region", raster=uas)
-    gs.mapcalc(diff + " = " + uas + " - " + dem)
+    diff = tmp.name("diff", stage="get_diff") if tmp else f"{output}_diff"
+    gs.run_command("g.region", raster=_region_map(uas))
+    (RasterExpr.wrap(uas) - dem).materialize(diff)
     print(f"Output Raster: Difference (UAS - DEM): {diff}")
-    # TMP_RAST.append(diff)
     univar = gs.parse_command("r.univar", map=diff, flags="ge")
     mean = float(univar["mean"])
     median = float(univar["median"])
@@ -1594,16 +4763,21 @@ def get_diff(uas, dem, mean_thr, output):
     return diff, median
 
 
-def vertically_corrected_uas(uas, dem, shift, output):
+@traced_stage
+def vertically_corrected_uas(uas, dem, shift, output, tmp=None, lazy=False):
     """
     Vertically Corrects UAS data by a given offset.
 
     Parameters
     ==========
-    uas (str): Name of UAS DEM.
+    uas (str): Name of UAS DEM (or RasterExpr).
     dem (str): Name of DEM UAS is shifting too.
     shift (float): Value to shift UAS data.
     output (str): Name of shifted uas data.
+    tmp (TemporaryMaps): (optional) Registry used to name the
+                         difference raster.
+    lazy (bool): (optional) Return the corrected UAS as a RasterExpr
+                 without writing it or the difference raster.
     Returns
     =======
     output
@@ -1611,9 +4785,15 @@ def vertically_corrected_uas(uas, dem, shift, output):
 
     print(("#" * 25) + " Vertical Correction " + ("#" * 25))
     print(f"Shifting {uas} by {shift}m")
+    if lazy:
+        return RasterExpr.wrap(uas) - shift, None
     new = f"{output}_vertically_corrected_uas"
-    diff = f"{output}_diff_corrected"
-    gs.mapcalc(f"{new} = {uas} - {shift}")
+    diff = (
+        tmp.name("diff_corrected", stage="vertical_correction")
+        if tmp
+        else f"{output}_diff_corrected"
+    )
+    (RasterExpr.wrap(uas) - shift).materialize(new)
     print(f"Output: Vertically Corrected UAS (UAS - Shift): {new}")
     univar = gs.parse_command("r.univar", map=new, flags="ge")
     mean = float(univar["mean"])
@@ -1628,8 +4808,7 @@ def vertically_corrected_uas(uas, dem, shift, output):
         """
     )
     # report_diff_stats(new)
-    # TMP_RAST.append(new)
-    gs.mapcalc(diff + " = " + new + " - " + dem)
+    (RasterExpr.map(new) - dem).materialize(diff)
     print(f"Output: Difference (Vertically Corrected UAS - DEM): {diff}")
     univar = gs.parse_command("r.univar", map=diff, flags="ge")
     mean = float(univar["mean"])
@@ -1643,11 +4822,11 @@ def vertically_corrected_uas(uas, dem, shift, output):
             Median: {median}
         """
     )
-    # TMP_RAST.append(diff)
 
     return new, diff
 
 
+@traced_stage
 def patch(uas, dem, output, ps, ta, dr):
     print(("#" * 25) + " Patch " + ("#" * 25))
     print(
@@ -1655,7 +4834,7 @@ def patch(uas, dem, output, ps, ta, dr):
     )
     overlap = f"{output}_overlap"
     gs.run_command("g.region", raster=dem)
-    gs.run_command(
+    run_with_progress(
         "r.patch.smooth",
         input_a=uas,
         input_b=dem,
@@ -1678,41 +4857,319 @@ def patch(uas, dem, output, ps, ta, dr):
     gs.run_command("r.colors", map=[output, dem, uas], color="elevation")
 
 
-def fusion(dem, uas, output, ps=5, ta=2, dr=3, offset_value=0, usgs=True):
+def _buffered_bounds(uas, buffer=0.5):
+    """
+    Bounds of the UAS raster grown on each side by buffer times its
+    average width and height (the area <fusion> works in).
 
-    buffer = 0.5
-    gs.run_command("g.region", raster=uas)
-    uas_reg = gs.region(uas)
-    avg_wh = (
-        (
-            (uas_reg["n"] - uas_reg["s"]) + (uas_reg["e"] - uas_reg["w"])
-        ) / 2.0
-    )
-    n = uas_reg["n"] + avg_wh * buffer
-    s = uas_reg["s"] - avg_wh * buffer
-    e = uas_reg["e"] + avg_wh * buffer
-    w = uas_reg["w"] - avg_wh * buffer
-    gs.run_command("g.region", n=n, e=e, s=s, w=w)
-    if usgs:
-        # import_dsm(
-        #   dem, output_dir='/tmp', input_srs='EPSG:2264', resolution=3
-        # )
-        import_dem(dem, "/tmp", 5)
-    gs.use_temp_region()
-    uas = geographic_correct_dem(uas, "geo_correct_uas")
-
-    uas, dem = resample(uas, dem, True)
-    diff, univar_shift = get_diff(uas, dem, 2, output)
-    uas_vert_c, diff = vertically_corrected_uas(uas, dem, univar_shift, output)
-    # Reshift to improve vert overap accuracy
-    ground = ground_dem(uas, uas_vert_c, dem)
-    diff, univar_shift = get_diff(ground, dem, 2, output)
-    if abs(offset_value) > 0:
-        print(f"Setting Offset Manaully: {offset_value}")
-        univar_shift = offset_value
-    uas, diff = vertically_corrected_uas(uas, dem, univar_shift, output)
-    patch(uas, dem, output, ps, ta, dr)
-    gs.del_temp_region()
+    Parameters
+    ==========
+    uas (str): Name of the UAS raster.
+    buffer (float): (optional) Buffer as a fraction of the UAS size.
+
+    Returns
+    =======
+    dict (n, s, e, w)
+    """
+    uas_reg = gs.parse_command("r.info", map=uas, flags="g")
+    n, s = float(uas_reg["north"]), float(uas_reg["south"])
+    e, w = float(uas_reg["east"]), float(uas_reg["west"])
+    avg_wh = ((n - s) + (e - w)) / 2.0
+    return {
+        "n": n + avg_wh * buffer,
+        "s": s - avg_wh * buffer,
+        "e": e + avg_wh * buffer,
+        "w": w - avg_wh * buffer,
+    }
+
+
+@traced_stage
+def fusion(
+    dem,
+    uas,
+    output,
+    ps=5,
+    ta=2,
+    dr=3,
+    offset_value=0,
+    usgs=True,
+    keep_intermediate=False,
+    tile_cache=None,
+    row_shift=0,
+    column_shift=0,
+    coregister=False,
+    align=None,
+    levels=3,
+):
+    """
+    Fuses UAS data with a DEM.
+
+    The UAS data is shifted by row_shift and column_shift, or by the
+    offset estimated with <coregister_dem> when coregister is set.
+
+    With align="pyramid" the horizontal shift and vertical offset are
+    estimated coarse-to-fine on a resolution pyramid of levels levels
+    (see <align_pyramid>) instead of at the full UAS resolution, and
+    only the vertical correction and <patch> run at full resolution.
+
+    With usgs set, the DEM is imported for the region around the UAS
+    data, from tile_cache (<TileCache>) when given.
+
+    Intermediate rasters are named uniquely per run and removed at the
+    end (see <TemporaryMaps>) unless keep_intermediate is set.
+
+    Returns
+    =======
+    correction (dict): row_shift and column_shift (UAS cells) and the
+                       vertical offset (UAS - DEM) applied to the UAS
+                       data.
+    """
+    # Use a temporary region so concurrent runs do not change each
+    # others region
+    with temp_region():
+        gs.run_command("g.region", **_buffered_bounds(uas))
+        if usgs:
+            # import_dsm(
+            #   dem, output_dir='/tmp', input_srs='EPSG:2264', resolution=3
+            # )
+            import_dem(dem, "/tmp", cache=tile_cache)
+        with TemporaryMaps(f"tmp_{output}", keep=keep_intermediate) as tmp:
+            if align == "pyramid":
+                _, dem = resample(uas, dem, True, tmp=tmp)
+                shift = align_pyramid(uas, dem, levels=levels, tmp=tmp)
+                row_shift = shift["row_shift"]
+                column_shift = shift["column_shift"]
+                uas = geographic_correct_dem(
+                    uas, row_shift=row_shift, column_shift=column_shift
+                )
+                univar_shift = shift["offset"]
+                # resample left the region at the DEM extent; write the
+                # corrected UAS over its own extent as get_diff does
+                gs.run_command("g.region", raster=_region_map(uas))
+            else:
+                # The shift and the first vertical correction stay lazy and
+                # are folded into the expressions that are written
+                if coregister:
+                    shift = coregister_dem(uas, dem)
+                    row_shift = shift["row_shift"]
+                    column_shift = shift["column_shift"]
+                uas = geographic_correct_dem(
+                    uas, row_shift=row_shift, column_shift=column_shift
+                )
+
+                uas, dem = resample(uas, dem, True, tmp=tmp)
+                diff, univar_shift = get_diff(uas, dem, 2, output, tmp=tmp)
+                uas_vert_c, diff = vertically_corrected_uas(
+                    uas, dem, univar_shift, output, lazy=True
+                )
+                # Reshift to improve vert overap accuracy
+                ground = ground_dem(uas, uas_vert_c, dem, tmp=tmp)
+                diff, univar_shift = get_diff(ground, dem, 2, output, tmp=tmp)
+            if abs(offset_value) > 0:
+                print(f"Setting Offset Manaully: {offset_value}")
+                univar_shift = offset_value
+            uas, diff = vertically_corrected_uas(
+                uas, dem, univar_shift, output, tmp=tmp
+            )
+            patch(uas, dem, output, ps, ta, dr)
+    return {
+        "row_shift": row_shift,
+        "column_shift": column_shift,
+        "offset": univar_shift,
+    }
+
+
+def _mapset_env(mapset, create=False):
+    """
+    Creates an environment (GISRC file) for running GRASS modules in
+    another mapset of the current location.
+
+    Parameters
+    ==========
+    mapset (str): Name of the mapset.
+    create (bool): (optional) Create the mapset if it does not exist.
+
+    Returns
+    =======
+    gisrc (str), env (dict)
+    """
+    genv = gs.gisenv()
+    gisrc = gs.tempfile(create=False)
+    with open(gisrc, "w") as f:
+        f.write(f"GISDBASE: {genv['GISDBASE']}\n")
+        f.write(f"LOCATION_NAME: {genv['LOCATION_NAME']}\n")
+        f.write(f"MAPSET: {genv['MAPSET']}\n")
+    env = os.environ.copy()
+    env["GISRC"] = gisrc
+    env.pop("WIND_OVERRIDE", None)
+    try:
+        gs.run_command(
+            "g.mapset", mapset=mapset, flags="c" if create else "",
+            env=env, quiet=True
+        )
+    except Exception:
+        os.remove(gisrc)
+        raise
+    return gisrc, env
+
+
+def _fuse_site(gisrc, main_mapset, dem, site, budget):
+    """
+    Runs <fusion> for one site in its own mapset with its share of the
+    compute budget (process pool task).
+    """
+    set_compute_budget(*budget)
+    os.environ["GISRC"] = gisrc
+    os.environ.pop("WIND_OVERRIDE", None)
+    gs.run_command(
+        "g.mapsets", mapset=main_mapset, operation="add", quiet=True
+    )
+    params = {
+        k: v for k, v in site.items() if k not in ("uas", "name", "priority")
+    }
+    uas = f"{site['uas']}@{main_mapset}"
+    dem = f"{dem}@{main_mapset}"
+    # Clip the DEM to the area around the site so the resampling and
+    # patching do not cover the whole DEM
+    clipped = f"{site['name']}_dem"
+    gs.run_command("g.region", align=dem, **_buffered_bounds(uas))
+    gs.mapcalc(f"{clipped} = {dem}")
+    fusion(
+        dem=clipped,
+        uas=uas,
+        output=site["name"],
+        usgs=False,
+        **params,
+    )
+    return site["name"]
+
+
+@traced_stage
+def fusion_batch(dem, sites, output, overlap="first", nprocs=4,
+                 keep_mapsets=False):
+    """
+    Fuses several UAS sites with a DEM in parallel and mosaics the
+    patched areas into one updated DEM.
+
+    Each site runs <fusion> in its own temporary mapset (and therefore
+    its own region and rasters), so the sites cannot interfere. The
+    DEM is clipped to the area around each site, and the mosaic takes
+    the UAS footprint and the smoothed transition from each site.
+
+    Parameters
+    ==========
+    dem (str): Name of the DEM covering all sites (e.g. the watershed).
+    sites (list): One dictionary per site with the UAS raster ("uas")
+                  and optionally a "name", a "priority" (lower is
+                  more important) and <fusion> parameters (ps, ta, dr,
+                  offset_value).
+    output (str): Name of the updated DEM.
+    overlap (str): (optional) Rule for cells patched by more than one
+                   site: "first" keeps the site with the lowest
+                   priority value (then list order), "mean", "min",
+                   or "max" combine the sites.
+    nprocs (int): (optional) Number of sites fused at once.
+    keep_mapsets (bool): (optional) Keep the site mapsets with the
+                         fused rasters of each site.
+
+    Returns
+    =======
+    output, site mapsets
+    """
+    if overlap not in ("first", "mean", "min", "max"):
+        raise ValueError(f"Unknown overlap rule: {overlap}")
+    genv = gs.gisenv()
+    main_mapset = genv["MAPSET"]
+    run_id = f"{os.getpid()}_{os.urandom(3).hex()}"
+    sites = [
+        dict(site, name=site.get("name") or site["uas"].split("@")[0])
+        for site in sites
+    ]
+    sites = sorted(
+        sites, key=lambda site: site.get("priority", float("inf"))
+    )
+
+    location = os.path.join(genv["GISDBASE"], genv["LOCATION_NAME"])
+    mapsets, gisrcs = [], []
+    try:
+        for k, site in enumerate(sites):
+            mapset = f"fusion_{run_id}_{k}"
+            mapsets.append(mapset)
+            gisrc, _ = _mapset_env(mapset, create=True)
+            gisrcs.append(gisrc)
+
+        print(f"Fusing {len(sites)} sites with {nprocs} processes")
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(
+            max_workers=nprocs, mp_context=context
+        ) as pool:
+            futures = [
+                pool.submit(
+                    _fuse_site, gisrc, main_mapset, dem, site,
+                    compute_budget().share(nprocs),
+                )
+                for gisrc, site in zip(gisrcs, sites)
+            ]
+            try:
+                for future, site in zip(futures, sites):
+                    future.result()
+                    print(f"Fused: {site['name']}")
+            except BaseException:
+                # Do not start the sites still waiting
+                for future in futures:
+                    future.cancel()
+                raise
+
+        with temp_region(), TemporaryMaps(f"tmp_{output}") as tmp:
+            gs.run_command("g.region", raster=dem)
+            patched = []
+            for site, mapset in zip(sites, mapsets):
+                fused = f"{site['name']}@{mapset}"
+                # The shifted and vertically corrected UAS the fusion
+                # patched in (see <vertically_corrected_uas>)
+                uas = f"{site['name']}_vertically_corrected_uas@{mapset}"
+                transition = f"{site['name']}_overlap@{mapset}"
+                area = tmp.name(f"patched_{site['name']}", stage="mosaic")
+                # Keep the UAS footprint and the smoothed transition
+                # around it, including cells where the fusion matches
+                # the DEM
+                gs.mapcalc(
+                    f"{area} = if(!isnull({uas}) || "
+                    f"!isnull({transition}), {fused}, null())"
+                )
+                patched.append(area)
+            if overlap == "first" or len(patched) == 1:
+                gs.run_command(
+                    "r.patch", input=patched + [dem], output=output
+                )
+            else:
+                combined = tmp.name("combined", stage="mosaic")
+                method = {
+                    "mean": "average", "min": "minimum", "max": "maximum"
+                }
+                gs.run_command(
+                    "r.series",
+                    input=patched,
+                    output=combined,
+                    method=method[overlap],
+                )
+                gs.run_command(
+                    "r.patch", input=[combined, dem], output=output
+                )
+        gs.run_command("r.colors", map=output, color="elevation")
+    finally:
+        for gisrc in gisrcs:
+            if os.path.exists(gisrc):
+                os.remove(gisrc)
+        if not keep_mapsets:
+            for mapset in mapsets:
+                shutil.rmtree(
+                    os.path.join(location, mapset), ignore_errors=True
+                )
+    if not keep_mapsets:
+        mapsets = []
+    print(f"Output: Updated DEM {output}")
+    return output, mapsets
 
 
 """
@@ -1721,6 +5178,7 @@ Analyze Hydrology
 """
 
 
+@traced_stage
 def simwe(elev, nlcd, output):
     """
     Run SIMWE with spatially variable parameterization of mannings
@@ -1797,7 +5255,7 @@ def simwe(elev, nlcd, output):
     # C
     # Cf = 1.25
 
-    gs.run_command(
+    run_with_progress(
         "r.sim.water",
         elevation=elev,
         dx=dx,
@@ -1809,7 +5267,6 @@ def simwe(elev, nlcd, output):
         depth=depth,
         disch=discharge,
         nwalk=1000000,
-        nprocs=14,
         output_step=60,  # Time step in minutes
         niterations=60,  # Total time of event in minutes
     )
@@ -1824,6 +5281,7 @@ def simwe(elev, nlcd, output):
     return filtered_depth
 
 
+@traced_stage
 def simweSimple(elev, output):
     """
     Simplified overland flow simulation using constants
@@ -1845,7 +5303,7 @@ def simweSimple(elev, output):
         "r.slope.aspect", elevation=elev, dx=dx, dy=dy, overwrite=True
     )
 
-    gs.run_command(
+    run_with_progress(
         "r.sim.water",
         elevation=elev,
         dx=dx,
@@ -1869,11 +5327,11 @@ def simweSimple(elev, output):
         # error=error,
         # walkers_output=walkers,
         nwalk=100000,  # Set Back to 1m
-        nprocs=14,
         random_seed="1",
     )
 
 
+@traced_stage
 def analyze_hydrology(
     dem,
     uas,
@@ -1883,12 +5341,13 @@ def analyze_hydrology(
     basin,
     accumulation,
     threshold,
-    memory=10000,
+    memory=None,
     overwrite=False,
 ):
     """
     Calculates watersheds, streams, drainage direction,
     flow direction, and runs simplified overland flow model.
+    Memory (MB) defaults to the compute budget (see <ComputeBudget>).
     """
     print("*" * 50)
 
@@ -1903,7 +5362,7 @@ def analyze_hydrology(
     # Need to reset the region to the whole study area
     gs.run_command("g.region", raster=dem, res=3, flags="pa")
     print("Creating Watersheds...")
-    gs.run_command(
+    run_with_progress(
         "r.watershed",
         elevation=fused,
         threshold=threshold,
@@ -1940,6 +5399,7 @@ def analyze_hydrology(
     print("*" * 50)
 
 
+@traced_stage
 def generate_depth_map(depth, flooding, relief, depth_filter=0.075):
     """
     @param depth_filter : float : 0.075m is ~0.25ft
@@ -1963,6 +5423,7 @@ def generate_depth_map(depth, flooding, relief, depth_filter=0.075):
     return flooding_map.show()
 
 
+@traced_stage
 def generate_discharge_map(disch, flooding, relief, disch_filter=0.075):
     """
     @param depth_filter : float : 0.075m is ~0.25ft
@@ -1993,3 +5454,637 @@ def generate_discharge_map(disch, flooding, relief, disch_filter=0.075):
 
     flooding_map.d_barscale(at=(1, 6, 2, 2), units="meters", flags="n")
     return flooding_map.show()
+
+
+"""
+Jobs
+=================
+"""
+
+
+# Prefix of the progress lines in job logs
+_JOB_PROGRESS = "RAPID_DEM_PROGRESS "
+
+
+def _run_job(conn, grouped, log, func, args, kwargs, budget):
+    """
+    Runs a job in a child process (see <JobQueue>), in its own process
+    group and temporary region with its share of the compute budget,
+    with its output written to log. grouped (Event) is set once the
+    process group exists.
+    """
+    # Own process group, so cancelling also stops the GRASS modules
+    os.setsid()
+    grouped.set()
+    fd = os.open(log, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    set_compute_budget(*budget)
+    # Progress of the modules goes to the log for <Job.progress>
+    add_progress_listener(
+        lambda event: print(
+            f"{_JOB_PROGRESS}{json.dumps(event._asdict())}", flush=True
+        )
+    )
+    try:
+        with temp_region():
+            result = func(*args, **kwargs)
+        message = ("done", result)
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}\n{traceback.format_exc()}"
+        message = ("failed", RuntimeError(error))
+    sys.stdout.flush()
+    sys.stderr.flush()
+    conn.send(message)
+    conn.close()
+
+
+class Job:
+    """
+    A function running in a background process of a <JobQueue>.
+
+    Attributes
+    ==========
+    name (str): Name of the job.
+    state (str): pending, running, done, failed or cancelled.
+    future (Future): Resolves to the return value of the function.
+    log (str): File with the output of the job.
+    """
+
+    def __init__(self, func, args, kwargs, name=None):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.name = name or func.__name__
+        self.state = "pending"
+        self.future = Future()
+        self.process = None
+        # Set by the process once it leads its own process group
+        self.grouped = None
+        fd, self.log = tempfile.mkstemp(
+            prefix=f"job_{self.name}_", suffix=".log"
+        )
+        os.close(fd)
+        self.started = None
+        self.finished = None
+
+    def result(self, timeout=None):
+        """
+        Waits for and returns the return value of the function, raises
+        if the job failed or was cancelled.
+        """
+        return self.future.result(timeout)
+
+    def done(self):
+        return self.future.done()
+
+    def runtime(self):
+        """
+        Seconds the job has been running (or ran).
+        """
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def output(self):
+        """
+        Output (prints and GRASS messages) of the job so far.
+        """
+        with open(self.log) as f:
+            return "".join(
+                line for line in f if not line.startswith(_JOB_PROGRESS)
+            )
+
+    def progress(self):
+        """
+        Latest progress of the job (see <ProgressEvent>), None before
+        the first module reports progress.
+        """
+        event = None
+        with open(self.log) as f:
+            for line in f:
+                if line.startswith(_JOB_PROGRESS):
+                    event = line[len(_JOB_PROGRESS):]
+        return ProgressEvent(**json.loads(event)) if event else None
+
+    def cancel(self, grace=5):
+        """
+        Cancels a pending job, or terminates a running job and the GRASS
+        modules it started (SIGTERM, then SIGKILL after grace seconds).
+        A process that has not started its process group yet is
+        terminated on its own. Temporary rasters of a terminated job are
+        left in the mapset.
+        """
+        if self.state == "pending":
+            self.state = "cancelled"
+            self.future.cancel()
+            return
+        if self.state != "running":
+            return
+        self.state = "cancelling"
+        group = self.grouped.wait(grace)
+        for signum, stop in [
+            (signal.SIGTERM, self.process.terminate),
+            (signal.SIGKILL, self.process.kill),
+        ]:
+            try:
+                if group:
+                    os.killpg(self.process.pid, signum)
+                else:
+                    stop()
+            except OSError:
+                stop()
+            self.process.join(grace)
+            if not self.process.is_alive():
+                break
+
+    def status(self):
+        progress = self.progress() if self.state == "running" else None
+        return {
+            "name": self.name,
+            "state": self.state,
+            "runtime": self.runtime(),
+            "module": progress.module if progress else None,
+            "percent": progress.percent if progress else None,
+            "cells_per_second": (
+                progress.cells_per_second if progress else None
+            ),
+            "log": self.log,
+        }
+
+    def __repr__(self):
+        return f"<Job {self.name} {self.state} {self.runtime():.0f}s>"
+
+
+class JobQueue:
+    """
+    Runs long pipeline steps such as <fusion>, <analyze_hydrology> or
+    <simwe> in background processes, so the notebook stays usable.
+
+    Up to max_jobs jobs run at once, each in its own temporary region
+    with an equal share of the compute budget (see <ComputeBudget>),
+    the others wait in order. Functions and arguments are pickled
+    (spawn), so pass module functions, not functions defined in the
+    notebook.
+
+    Example
+    =======
+    queue = JobQueue(max_jobs=2)
+    job = queue.submit(fusion, dem, uas, "fused_site_1", usgs=False)
+    queue.status()
+    job.result()
+    """
+
+    def __init__(self, max_jobs=2):
+        """
+        Parameters
+        ==========
+        max_jobs (int): (optional) Number of jobs run at once.
+        """
+        self.max_jobs = max_jobs
+        self.jobs = []
+        self.pending = deque()
+        self.running = 0
+        self.lock = threading.Lock()
+        self.context = multiprocessing.get_context("spawn")
+
+    def submit(self, func, *args, name=None, **kwargs):
+        """
+        Queues func(*args, **kwargs).
+
+        Returns
+        =======
+        Job
+        """
+        job = Job(func, args, kwargs, name)
+        with self.lock:
+            self.jobs.append(job)
+            self.pending.append(job)
+        self._dispatch()
+        return job
+
+    def _dispatch(self):
+        with self.lock:
+            while self.pending and self.running < self.max_jobs:
+                job = self.pending.popleft()
+                if job.state != "pending":
+                    continue
+                self._start(job)
+
+    def _start(self, job):
+        receiver, sender = self.context.Pipe(duplex=False)
+        job.grouped = self.context.Event()
+        job.process = self.context.Process(
+            target=_run_job,
+            args=(
+                sender, job.grouped, job.log, job.func, job.args,
+                job.kwargs, compute_budget().share(self.max_jobs),
+            ),
+        )
+        job.future.set_running_or_notify_cancel()
+        job.process.start()
+        sender.close()
+        job.state = "running"
+        job.started = time.time()
+        self.running += 1
+        threading.Thread(
+            target=self._watch, args=(job, receiver), daemon=True
+        ).start()
+
+    def _watch(self, job, receiver):
+        try:
+            state, value = receiver.recv()
+        except EOFError:
+            # The process ended without a result (cancelled or killed)
+            state = "cancelled" if job.state == "cancelling" else "failed"
+            value = RuntimeError(
+                f"Job {job.name} exited with code {job.process.exitcode}"
+            )
+        job.process.join()
+        job.finished = time.time()
+        job.state = state
+        if state == "done":
+            job.future.set_result(value)
+        else:
+            job.future.set_exception(value)
+        with self.lock:
+            self.running -= 1
+        self._dispatch()
+
+    def status(self):
+        """
+        Returns
+        =======
+        DataFrame with the name, state, runtime and log of each job.
+        """
+        return pd.DataFrame([job.status() for job in self.jobs])
+
+    def wait(self):
+        """
+        Waits for all jobs to finish.
+        """
+        futures_wait([job.future for job in self.jobs])
+
+    def cancel_all(self):
+        for job in reversed(self.jobs):
+            job.cancel()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.cancel_all()
+        self.wait()
+        return False
+
+
+"""
+Pipeline
+=================
+"""
+
+
+class Stage:
+    """
+    A pipeline step: a function with the rasters (or files) it reads
+    and writes.
+
+    Example
+    =======
+    Stage(
+        "fusion", fusion,
+        inputs=["ned_dem", "uas_dtm"], outputs=["fused_dem"],
+        kwargs={"dem": "ned_dem", "uas": "uas_dtm", "output": "fused_dem"},
+    )
+    """
+
+    def __init__(
+        self, name, func, inputs=(), outputs=(), args=(), kwargs=None
+    ):
+        """
+        Parameters
+        ==========
+        name (str): Unique name of the stage.
+        func (function): Function run by the stage (a module function,
+                         see <JobQueue>).
+        inputs (list): Rasters or file paths read by the stage.
+        outputs (list): Rasters or file paths written by the stage.
+        args (tuple): (optional) Positional arguments of func.
+        kwargs (dict): (optional) Keyword arguments of func.
+        """
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.args = tuple(args)
+        self.kwargs = kwargs or {}
+
+    def params_hash(self):
+        """
+        Hash of the function and its arguments.
+        """
+        text = json.dumps(
+            [self.func.__name__, self.args, self.kwargs],
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def __repr__(self):
+        return f"<Stage {self.name}: {self.inputs} -> {self.outputs}>"
+
+
+class Pipeline:
+    """
+    Runs stages in dependency order. A stage depends on the stages that
+    write its inputs. Independent branches (e.g. figures next to
+    hydrology, or several sites) run at the same time as jobs (see
+    <JobQueue>).
+
+    A stage is skipped when its arguments, the content hashes of its
+    inputs, and its outputs are the same as on its last successful run.
+    The provenance of each run (hashes, times) is kept in a JSON file,
+    so it carries over between sessions.
+
+    Example
+    =======
+    pipeline = Pipeline([
+        Stage("priority", priority_change_calc,
+              inputs=["classified_before_30m", "classified_after_30m"],
+              outputs=["priority_30m"],
+              args=("classified_before_30m", "classified_after_30m",
+                    "priority_30m")),
+        ...
+    ])
+    pipeline.run()
+    """
+
+    def __init__(
+        self, stages, provenance="output/pipeline_provenance.json",
+        max_jobs=2
+    ):
+        """
+        Parameters
+        ==========
+        stages (list): Stages of the pipeline, in any order.
+        provenance (str): (optional) JSON file of the run records.
+        max_jobs (int): (optional) Stages run at once, 0 runs the
+                        stages one by one in this process.
+        """
+        self.stages = {stage.name: stage for stage in stages}
+        if len(self.stages) != len(stages):
+            raise ValueError("Stage names must be unique")
+        self.provenance_path = provenance
+        self.max_jobs = max_jobs
+        self.provenance = {"stages": {}, "files": {}}
+        if os.path.exists(provenance):
+            with open(provenance) as f:
+                self.provenance = json.load(f)
+        self.dependencies = self._dependencies()
+        self.order = self._topological_order()
+
+    def _dependencies(self):
+        writers = {}
+        for stage in self.stages.values():
+            for output in stage.outputs:
+                if output in writers:
+                    raise ValueError(
+                        f"{output} is written by {writers[output]} and "
+                        f"{stage.name}"
+                    )
+                writers[output] = stage.name
+        return {
+            stage.name: sorted(
+                {writers[i] for i in stage.inputs if i in writers}
+            )
+            for stage in self.stages.values()
+        }
+
+    def _topological_order(self):
+        order, remaining = [], dict(self.dependencies)
+        while remaining:
+            ready = [
+                name for name, deps in remaining.items()
+                if all(dep in order for dep in deps)
+            ]
+            if not ready:
+                raise ValueError(f"Stages form a cycle: {list(remaining)}")
+            order += sorted(ready)
+            for name in ready:
+                del remaining[name]
+        return order
+
+    def _file_hash(self, path):
+        """
+        sha256 of a file, cached by path, size and modification time.
+        """
+        info = os.stat(path)
+        key = f"{info.st_size}:{info.st_mtime_ns}"
+        cached = self.provenance["files"].get(path)
+        if cached and cached["key"] == key:
+            return cached["hash"]
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        self.provenance["files"][path] = {
+            "key": key, "hash": digest.hexdigest()
+        }
+        return digest.hexdigest()
+
+    def content_hash(self, name):
+        """
+        Content hash of a file, or of a raster's header, data files and
+        support files (cell_misc, e.g. the null file) in its mapset.
+        The hash of a reclass raster includes the hash of its base
+        raster. None if it does not exist.
+        """
+        if os.path.isfile(name):
+            return self._file_hash(name)
+        found = gs.find_file(name, element="cellhd")
+        if not found["name"]:
+            return None
+        mapset_dir = os.path.dirname(os.path.dirname(found["file"]))
+        base = found["name"]
+        paths = [
+            os.path.join(element, base)
+            for element in ("cellhd", "cell", "fcell")
+        ]
+        misc = os.path.join("cell_misc", base)
+        if os.path.isdir(os.path.join(mapset_dir, misc)):
+            paths += [
+                os.path.join(misc, support)
+                for support in sorted(
+                    os.listdir(os.path.join(mapset_dir, misc))
+                )
+            ]
+        parts = [
+            f"{path}:{self._file_hash(os.path.join(mapset_dir, path))}"
+            for path in paths
+            if os.path.isfile(os.path.join(mapset_dir, path))
+        ]
+        reclass = self._reclass_base(found["file"])
+        if reclass:
+            parts.append(f"{reclass}:{self.content_hash(reclass)}")
+        return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+    @staticmethod
+    def _reclass_base(cellhd):
+        """
+        name@mapset of the base raster if the header cellhd is the
+        header of a reclass raster, otherwise None.
+        """
+        with open(cellhd) as f:
+            header = [f.readline().strip() for _ in range(3)]
+        if header[0] != "reclass":
+            return None
+        fields = dict(
+            line.split(":", 1) for line in header[1:] if ":" in line
+        )
+        return f"{fields['name'].strip()}@{fields['mapset'].strip()}"
+
+    def _hashes(self, names):
+        return {name: self.content_hash(name) for name in names}
+
+    def is_current(self, stage):
+        """
+        Tests whether the stage ran before with the same arguments and
+        inputs and its outputs are unchanged.
+        """
+        record = self.provenance["stages"].get(stage.name)
+        if not record or record["params"] != stage.params_hash():
+            return False
+        if record["inputs"] != self._hashes(stage.inputs):
+            return False
+        outputs = self._hashes(stage.outputs)
+        return None not in outputs.values() and record["outputs"] == outputs
+
+    def _record(self, stage, inputs, started):
+        self.provenance["stages"][stage.name] = {
+            "params": stage.params_hash(),
+            "inputs": inputs,
+            "outputs": self._hashes(stage.outputs),
+            "started": started,
+            "finished": time.time(),
+        }
+        self.save()
+
+    def save(self):
+        """
+        Writes the provenance JSON file (atomically).
+        """
+        directory = os.path.dirname(self.provenance_path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=directory, suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.provenance, f, indent=2)
+        os.replace(path, self.provenance_path)
+
+    def run(self, force=False, dry_run=False):
+        """
+        Runs the stages that are not current, and the stages that depend
+        on them. A failed stage blocks the stages that depend on it,
+        independent branches continue.
+
+        Parameters
+        ==========
+        force (bool): (optional) Run all stages.
+        dry_run (bool): (optional) Only report which stages would run.
+
+        Returns
+        =======
+        DataFrame with the state and runtime of each stage (skipped,
+        done, failed, blocked, or pending in a dry run).
+        """
+        print(("#" * 25) + " Pipeline " + ("#" * 25))
+        states = {}
+        runtimes = {}
+        ran = set()
+
+        def ready(name):
+            return all(
+                states.get(dep) in ("skipped", "done")
+                for dep in self.dependencies[name]
+            )
+
+        def needs_run(stage):
+            deps_ran = any(dep in ran for dep in self.dependencies[stage.name])
+            return force or deps_ran or not self.is_current(stage)
+
+        if dry_run:
+            for name in self.order:
+                stage = self.stages[name]
+                if needs_run(stage):
+                    states[name] = "pending"
+                    ran.add(name)
+                else:
+                    states[name] = "skipped"
+            return pd.DataFrame(
+                {"stage": list(states), "state": list(states.values())}
+            )
+
+        queue = JobQueue(max_jobs=self.max_jobs) if self.max_jobs else None
+        # Job: (stage name, input hashes, start time)
+        running = {}
+        while len(states) < len(self.order):
+            running_names = [item[0] for item in running.values()]
+            for name in self.order:
+                if name in states or name in running_names:
+                    continue
+                if any(
+                    states.get(dep) in ("failed", "blocked")
+                    for dep in self.dependencies[name]
+                ):
+                    states[name] = "blocked"
+                    print(f"Blocked: {name}")
+                    continue
+                if not ready(name):
+                    continue
+                stage = self.stages[name]
+                if not needs_run(stage):
+                    states[name] = "skipped"
+                    print(f"Skipped (unchanged): {name}")
+                    continue
+                inputs = self._hashes(stage.inputs)
+                started = time.time()
+                print(f"Running: {name}")
+                if queue is None:
+                    try:
+                        stage.func(*stage.args, **stage.kwargs)
+                        states[name] = "done"
+                        ran.add(name)
+                        self._record(stage, inputs, started)
+                    except Exception as e:
+                        states[name] = "failed"
+                        print(f"Failed: {name}: {e}")
+                    runtimes[name] = time.time() - started
+                    continue
+                job = queue.submit(
+                    stage.func, *stage.args, name=name, **stage.kwargs
+                )
+                running[job] = (name, inputs, started)
+            if not running:
+                continue
+            done, _ = futures_wait(
+                [job.future for job in running], return_when=FIRST_COMPLETED
+            )
+            for job in [job for job in running if job.future in done]:
+                name, inputs, started = running.pop(job)
+                runtimes[name] = job.runtime()
+                if job.future.exception() is None:
+                    states[name] = "done"
+                    ran.add(name)
+                    self._record(self.stages[name], inputs, started)
+                    print(f"Done: {name} ({runtimes[name]:.1f}s)")
+                else:
+                    states[name] = "failed"
+                    print(f"Failed: {name}, see {job.log}")
+        self.save()
+        return pd.DataFrame(
+            {
+                "stage": self.order,
+                "state": [states[name] for name in self.order],
+                "runtime": [runtimes.get(name) for name in self.order],
+            }
+        )
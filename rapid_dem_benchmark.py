@@ -0,0 +1,392 @@
+"""
+rapid_dem_benchmark
+
+Synthetic-data benchmarks of the rapid_dem priority queue, change
+detection, fusion, hydrology, and figure functions.
+
+Run inside a GRASS session in a projected location, e.g.
+
+    grass /path/to/location/benchmark --exec \
+        python rapid_dem_benchmark.py --sizes 1000 2000 5000
+
+Results are appended to a JSON lines file (one record per benchmark
+and size) so runs of different commits can be compared.
+"""
+
+# ============ Packages ================
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import time
+from datetime import datetime
+
+import pandas as pd
+import grass.script as gs
+
+import rapid_dem as rd
+
+# ============ Functions ===============
+
+RES = 3
+CLASSES = 7
+# Known shift (cells) and vertical offset (m) of the synthetic UAS data
+# and how far the fusion estimate may be off
+UAS_SHIFT = {"row_shift": 3, "column_shift": -2, "offset": 1.5}
+UAS_TOLERANCE = {"row_shift": 0.5, "column_shift": 0.5, "offset": 0.1}
+
+
+def set_region(size, res=RES):
+    """
+    Sets a size x size cell region at res resolution.
+
+    Parameters
+    ==========
+    size (int): Number of rows and columns.
+    res (float): (optional) Cell size in map units.
+
+    Returns
+    =======
+    region (dict)
+    """
+    extent = size * res
+    gs.run_command(
+        "g.region", n=extent, s=0, e=extent, w=0, res=res, flags="a"
+    )
+    return gs.region()
+
+
+def synthetic_landcover(prefix, seed=1, change=0.02):
+    """
+    Generates a before/after pair of land cover rasters with classes
+    0-6 and patches of change covering roughly change * 100 percent
+    of the region.
+
+    Parameters
+    ==========
+    prefix (str): Prefix of the output raster names.
+    seed (int): (optional) Random seed.
+    change (float): (optional) Share of changed cells.
+
+    Returns
+    =======
+    before, after
+    """
+    surface = f"{prefix}_lc_surface"
+    patches = f"{prefix}_lc_patches"
+    before = f"{prefix}_lc_before"
+    after = f"{prefix}_lc_after"
+    gs.run_command(
+        "r.surf.fractal", output=surface, dimension=2.5, seed=seed,
+        overwrite=True
+    )
+    gs.run_command(
+        "r.surf.fractal", output=patches, dimension=2.2, seed=seed + 1,
+        overwrite=True
+    )
+    surface_info = gs.raster_info(surface)
+    low, high = float(surface_info["min"]), float(surface_info["max"])
+    gs.mapcalc(
+        f"""{before} = int(min({CLASSES - 1},
+            ({surface} - {low}) / ({high} - {low}) * {CLASSES}))
+        """,
+        overwrite=True,
+    )
+    # Change the cells in the top change percent of the patch surface
+    percentile = int(round(100 * (1 - change)))
+    univar = gs.parse_command(
+        "r.univar", map=patches, flags="ge", percentile=percentile
+    )
+    cutoff = float(univar[f"percentile_{percentile}"])
+    gs.mapcalc(
+        f"""{after} = if({patches} > {cutoff},
+            ({before} + 1 + int(rand(0, {CLASSES - 1}))) % {CLASSES},
+            {before})
+        """,
+        seed=seed,
+        overwrite=True,
+    )
+    return before, after
+
+
+def synthetic_dem(prefix, seed=1, relief=60, base=80):
+    """
+    Generates a NED-like DEM from a smooth fractal surface.
+
+    Parameters
+    ==========
+    prefix (str): Prefix of the output raster name.
+    seed (int): (optional) Random seed.
+    relief (float): (optional) Elevation range in meters.
+    base (float): (optional) Lowest elevation in meters.
+
+    Returns
+    =======
+    dem
+    """
+    surface = f"{prefix}_dem_surface"
+    dem = f"{prefix}_dem"
+    gs.run_command(
+        "r.surf.fractal", output=surface, dimension=2.05, seed=seed,
+        overwrite=True
+    )
+    info = gs.raster_info(surface)
+    low, high = float(info["min"]), float(info["max"])
+    gs.mapcalc(
+        f"{dem} = {base} + ({surface} - {low}) / ({high} - {low}) * {relief}",
+        overwrite=True,
+    )
+    return dem
+
+
+def synthetic_uas(dem, prefix, row_shift=3, column_shift=-2, offset=1.5,
+                  size=0.2, seed=1):
+    """
+    Generates a UAS-like patch of a DEM in the middle of the region
+    with a known horizontal shift and vertical offset, noise, and a
+    new graded pad, so the fusion result can be checked.
+
+    Parameters
+    ==========
+    dem (str): Name of the DEM raster.
+    prefix (str): Prefix of the output raster name.
+    row_shift (int): (optional) Known row shift of the patch.
+    column_shift (int): (optional) Known column shift of the patch.
+    offset (float): (optional) Known vertical offset in meters.
+    size (float): (optional) Patch width as share of the region.
+    seed (int): (optional) Random seed.
+
+    Returns
+    =======
+    uas
+    """
+    uas = f"{prefix}_uas"
+    region = gs.region()
+    width = (region["e"] - region["w"]) * size
+    height = (region["n"] - region["s"]) * size
+    cx = (region["e"] + region["w"]) / 2
+    cy = (region["n"] + region["s"]) / 2
+    pad = f"abs(x() - {cx}) < {width / 6} && abs(y() - {cy}) < {height / 6}"
+    shifted = f"{dem}[{-row_shift},{-column_shift}]"
+    with rd.temp_region():
+        gs.run_command(
+            "g.region",
+            n=cy + height / 2,
+            s=cy - height / 2,
+            e=cx + width / 2,
+            w=cx - width / 2,
+            align=dem,
+        )
+        gs.mapcalc(
+            f"""{uas} = if({pad}, {dem} - 2, {shifted})
+                + {offset} + rand(-0.05, 0.05)
+            """,
+            seed=seed,
+            overwrite=True,
+        )
+    return uas
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def time_call(name, size, func, *args, **kwargs):
+    """
+    Times one benchmark call and the GRASS modules it runs.
+
+    Parameters
+    ==========
+    name (str): Name of the benchmark.
+    size (int): Number of rows and columns of the region.
+    func (function): Function to time.
+
+    Returns
+    =======
+    record (dict), result of func
+    """
+    print(f"Benchmark: {name} ({size}x{size})")
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    with rd.trace_run() as trace:
+        result = func(*args, **kwargs)
+    wall = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    summary = trace.summary()
+    record = {
+        "benchmark": name,
+        "size": size,
+        "cells": size * size,
+        "wall": wall,
+        "cpu": (after.ru_utime - before.ru_utime)
+        + (after.ru_stime - before.ru_stime),
+        "modules": (
+            summary.groupby("module")["wall"].sum().to_dict()
+            if not summary.empty
+            else {}
+        ),
+        "revision": _git_revision(),
+        "host": platform.node(),
+        "timestamp": datetime.now().isoformat(),
+    }
+    return record, result
+
+
+def check_correction(correction, known=UAS_SHIFT, tolerance=UAS_TOLERANCE):
+    """
+    Compares the shift and offset recovered by <rd.fusion> with the
+    known ones of <synthetic_uas>.
+
+    Parameters
+    ==========
+    correction (dict): row_shift, column_shift and offset returned by
+                       fusion.
+    known (dict): (optional) Known row_shift, column_shift and offset.
+    tolerance (dict): (optional) Largest accepted absolute error of
+                      each.
+
+    Returns
+    =======
+    check (dict): recovered values, their errors, and whether all
+                  errors are within the tolerance.
+    """
+    errors = {
+        key: float(correction[key]) - value for key, value in known.items()
+    }
+    return {
+        "recovered": {key: float(correction[key]) for key in known},
+        "errors": errors,
+        "recovered_ok": all(
+            abs(error) <= tolerance[key] for key, error in errors.items()
+        ),
+    }
+
+
+def run_benchmarks(sizes, benchmarks=None, output=None, seed=1):
+    """
+    Generates the synthetic data and times each benchmark per size.
+
+    Parameters
+    ==========
+    sizes (list): Region sizes (rows = columns), e.g. [1000, 5000].
+    benchmarks (list): (optional) Names of the benchmarks to run,
+                       default runs all.
+    output (str): (optional) JSON lines file the records are
+                  appended to.
+    seed (int): (optional) Random seed.
+
+    Returns
+    =======
+    DataFrame of the records.
+    """
+    records = []
+    for size in sizes:
+        prefix = f"bench_{size}"
+        set_region(size)
+        before, after = synthetic_landcover(prefix, seed=seed)
+        dem = synthetic_dem(prefix, seed=seed)
+        dem_after = f"{prefix}_dem_after"
+        gs.mapcalc(
+            f"{dem_after} = {dem} + if({after} != {before}, -3, 0)",
+            overwrite=True,
+        )
+        uas = synthetic_uas(dem, prefix, seed=seed, **UAS_SHIFT)
+        cases = {
+            "priority_change_calc": (
+                rd.priority_change_calc,
+                [before, after, f"{prefix}_priority"],
+                {},
+            ),
+            "binary_change": (
+                rd.binary_change,
+                [dem, dem_after, f"{prefix}_change", f"{prefix}_mask"],
+                {},
+            ),
+            "binary_change_stream": (
+                rd.binary_change_stream,
+                [dem, dem_after, f"{prefix}_mask_stream"],
+                {},
+            ),
+            "fusion": (
+                rd.fusion,
+                [dem, uas, f"{prefix}_fused"],
+                {"usgs": False, "align": "pyramid"},
+            ),
+            "analyze_hydrology": (
+                rd.analyze_hydrology,
+                [
+                    dem, None, None, f"{prefix}_drainage",
+                    f"{prefix}_stream", f"{prefix}_basin",
+                    f"{prefix}_accum", 1000,
+                ],
+                {"overwrite": True},
+            ),
+            "generate_elevation_figure": (
+                rd.generate_elevation_figure,
+                [dem, f"{prefix}_elevation"],
+                {},
+            ),
+        }
+        for name, (func, args, kwargs) in cases.items():
+            if benchmarks and name not in benchmarks:
+                continue
+            # Functions such as fusion change the region
+            set_region(size)
+            record, result = time_call(name, size, func, *args, **kwargs)
+            if name == "fusion":
+                record.update(check_correction(result))
+                if not record["recovered_ok"]:
+                    print(
+                        f"fusion recovered {record['recovered']}, "
+                        f"expected {UAS_SHIFT}"
+                    )
+            records.append(record)
+            print(f"{name}: {record['wall']:.2f}s")
+            if output:
+                with open(output, "a") as f:
+                    f.write(json.dumps(record) + "\n")
+    return pd.DataFrame(records)
+
+
+def load_results(path):
+    """
+    Loads benchmark records as a scaling table (seconds per benchmark
+    and size for each revision).
+    """
+    df = pd.read_json(path, lines=True)
+    return df.pivot_table(
+        index=["benchmark", "size"], columns="revision", values="wall"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[1000, 2000, 5000],
+        help="Region sizes (rows = columns), 1000 to 20000",
+    )
+    parser.add_argument(
+        "--only", nargs="+", default=None, help="Benchmarks to run"
+    )
+    parser.add_argument(
+        "--output", default="output/benchmarks.jsonl",
+        help="JSON lines file the results are appended to",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    with rd.temp_region():
+        df = run_benchmarks(args.sizes, args.only, args.output, args.seed)
+    print(df[["benchmark", "size", "wall", "cpu"]].to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
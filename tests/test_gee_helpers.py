@@ -0,0 +1,40 @@
+"""
+Tests of the local (NumPy) helpers of gee_helpers that do not need
+Earth Engine (NumPy must be installed).
+"""
+
+from functools import reduce
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import gee_helpers as gh  # noqa: E402
+
+
+def test_merge_covariance_matches_numpy():
+    rng = np.random.default_rng(0)
+    pixels = rng.normal(size=(3, 10, 8)) * [[[1.0]], [[2.0]], [[0.5]]]
+    pixels[1, 2, 3] = np.nan
+    partials = [
+        gh._covariancePartial(pixels[:, start:start + 3])
+        for start in range(0, 10, 3)
+    ]
+    empty = (0, np.zeros(3), np.zeros((3, 3)))
+    partials.append(gh._covariancePartial(np.full((3, 2, 2), np.nan)))
+    forward = reduce(gh._mergeCovariance, partials, empty)
+    backward = reduce(gh._mergeCovariance, partials[::-1], empty)
+
+    flat = pixels.reshape(3, -1)
+    flat = flat[:, ~np.isnan(flat).any(axis=0)]
+    for count, mean, comoment in [forward, backward]:
+        assert count == flat.shape[1]
+        np.testing.assert_allclose(mean, flat.mean(axis=1))
+        np.testing.assert_allclose(
+            comoment / (count - 1), np.cov(flat), atol=1e-12
+        )
+
+
+def test_principal_components_of_empty_input():
+    with pytest.raises(ValueError):
+        gh.getPrincipalComponentsLocal(np.full((2, 4, 4), np.nan))
@@ -0,0 +1,275 @@
+"""
+Tests of rapid_dem that do not need a GRASS location (GRASS, NumPy and
+pandas must be installed).
+"""
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("pandas")
+pytest.importorskip("grass.script")
+
+import rapid_dem as rd  # noqa: E402
+
+
+@rd.traced_stage
+def _stage(value):
+    return value * 2, list(rd._TRACE.stages()) if rd._TRACE else None
+
+
+def test_traced_stage_without_trace():
+    assert _stage(2) == (4, None)
+
+
+def test_traced_stage_records_stage_name():
+    with rd.trace_run() as trace:
+        with rd.trace_stage("outer"):
+            assert _stage(3) == (6, ["outer", "_stage"])
+        assert trace.stages() == []
+
+
+class _FakeGrass:
+    """
+    Stands in for grass.script: records the modules run and reports a
+    region of 100 cells.
+    """
+
+    def __init__(self):
+        self.modules = []
+
+    def run_command(self, module, **kwargs):
+        self.modules.append(module)
+
+    def parse_command(self, module, **kwargs):
+        self.modules.append(module)
+        return {"mean": "1.0", "stddev": "2.0"}
+
+    def mapcalc(self, exp, **kwargs):
+        self.modules.append("r.mapcalc")
+
+    def region(self, **kwargs):
+        return {"cells": 100}
+
+
+def test_pipeline_functions_record_module_calls(monkeypatch):
+    grass = _FakeGrass()
+    monkeypatch.setattr(rd, "_GRASS_SCRIPT", grass)
+    monkeypatch.setattr(rd, "_module_options", lambda module: frozenset())
+    monkeypatch.setattr(rd, "_mapcalc_takes_nprocs", lambda: False)
+    with rd.trace_run() as trace:
+        rd.binary_change("before", "after")
+    assert [event["module"] for event in trace.events] == grass.modules
+    assert grass.modules == ["r.mapcalc", "r.colors", "r.univar", "r.mapcalc"]
+    assert {event["stage"] for event in trace.events} == {"binary_change"}
+    assert {event["cells"] for event in trace.events} == {100}
+
+
+def _fake_chunks(arrays):
+    """
+    Replacement of rd._raster_chunks reading in-memory arrays.
+    """
+
+    def chunks(rasters, chunk_rows=512, report=None):
+        rows = arrays[rasters[0]].shape[0]
+        for start in range(0, rows, chunk_rows):
+            yield start, [
+                arrays[name][start:start + chunk_rows].astype(float)
+                for name in rasters
+            ]
+
+    return chunks
+
+
+def test_shift_array_matches_roll():
+    array = np.arange(30, dtype=float).reshape(5, 6)
+    shifted = rd._shift_array(array, 2, -1)
+    # shifted[i, j] = array[i + 2, j - 1]
+    assert shifted[0, 1] == array[2, 0]
+    assert shifted[2, 5] == array[4, 4]
+    assert np.isnan(shifted[3:]).all()
+    assert np.isnan(shifted[:, 0]).all()
+    assert rd._shift_array(array, 0, 0) is array
+    assert np.isnan(rd._shift_array(array, 5, 0)).all()
+
+
+def test_raster_expr_mapcalc_expression():
+    uas = rd.RasterExpr.map("uas").shift(-5, -1)
+    expr = (uas - 0.3 - rd.RasterExpr.map("dem")).mask(uas >= 0)
+    assert str(expr) == (
+        "if((uas[-5,-1] >= 0.0), ((uas[-5,-1] - 0.3) - dem), null())"
+    )
+    assert expr.maps() == ["uas", "dem"]
+    assert expr.max_row_shift() == 5
+
+
+def test_raster_expr_chunks_match_whole_array(monkeypatch):
+    rng = np.random.default_rng(1)
+    arrays = {
+        "uas": rng.normal(size=(23, 7)),
+        "dem": rng.normal(size=(23, 7)),
+    }
+    arrays["uas"][4, 2] = np.nan
+    monkeypatch.setattr(rd, "_raster_chunks", _fake_chunks(arrays))
+    uas = rd.RasterExpr.map("uas")
+    expr = (uas.subpixel_shift(2.5, -1) - "dem").mask(uas > -1)
+    expected = expr.evaluate(arrays)
+    chunked = np.vstack(list(expr.chunks(chunk_rows=4)))
+    np.testing.assert_allclose(chunked, expected, equal_nan=True)
+    manual = (
+        0.5 * rd._shift_array(arrays["uas"], 2, -1)
+        + 0.5 * rd._shift_array(arrays["uas"], 3, -1)
+        - arrays["dem"]
+    )
+    manual[~(arrays["uas"] > -1)] = np.nan
+    np.testing.assert_allclose(expected, manual, equal_nan=True)
+
+
+def test_phase_correlation_recovers_integer_shift():
+    terrain = _terrain(192)
+    # a(x) = b(x - (3, -5))
+    b = rd._slope_surface(terrain[32:160, 32:160], 1, 1)
+    a = rd._slope_surface(terrain[29:157, 37:165], 1, 1)
+    rows, cols, peak = rd._phase_correlation(a, b)
+    assert rows == pytest.approx(3, abs=0.2)
+    assert cols == pytest.approx(-5, abs=0.2)
+    assert 0 < peak <= 1
+
+
+def test_edge_distance_keep_matches_brute_force():
+    rng = np.random.default_rng(2)
+    valid = rng.random((30, 25)) > 0.05
+    nsres, ewres, distance = 2.0, 1.5, 5.0
+    keep = rd._edge_distance_keep(valid, distance, nsres, ewres)
+    # Invalid cells, including a ring of cells outside the array
+    rows, cols = np.nonzero(
+        np.pad(~valid, 1, constant_values=True)
+    )
+    rows, cols = rows - 1, cols - 1
+    expected = np.zeros_like(valid)
+    for i in range(valid.shape[0]):
+        for j in range(valid.shape[1]):
+            d2 = ((rows - i) * nsres) ** 2 + ((cols - j) * ewres) ** 2
+            expected[i, j] = valid[i, j] and d2.min() > distance**2
+    np.testing.assert_array_equal(keep, expected)
+
+
+def test_accuracy_assessment(monkeypatch):
+    arrays = {
+        "reference": np.array([[0, 0], [1, 1], [np.nan, np.nan]]),
+        "classified": np.array([[0, 0], [0, 1], [0, 1]]),
+    }
+    monkeypatch.setattr(rd, "_raster_chunks", _fake_chunks(arrays))
+
+    class Region:
+        def region(self):
+            return {"nsres": 10.0, "ewres": 10.0}
+
+    monkeypatch.setattr(rd, "gs", Region())
+    result = rd.accuracy_assessment(
+        "reference", "classified", classes=["a", "b"], chunk_rows=2
+    )
+    np.testing.assert_array_equal(result["matrix"].values, [[2, 0], [1, 1]])
+    assert result["overall"] == pytest.approx(0.75)
+    assert result["kappa"] == pytest.approx(0.5)
+    summary = result["classes"].set_index("class")
+    assert summary["producer_accuracy"].tolist() == pytest.approx([1, 0.5])
+    assert summary["user_accuracy"].tolist() == pytest.approx([2 / 3, 1])
+    # Mapped shares 4/6 and 2/6 weight the sample proportions
+    assert summary["mapped_area"].tolist() == pytest.approx([400, 200])
+    assert result["overall_weighted"] == pytest.approx(
+        4 / 6 * 2 / 3 + 2 / 6
+    )
+    assert summary["estimated_area"].tolist() == pytest.approx(
+        [4 / 6 * 2 / 3 * 600, (4 / 6 / 3 + 2 / 6) * 600]
+    )
+
+
+def _terrain(size=256, seed=0):
+    """
+    Smooth synthetic terrain of random Gaussian hills and hollows.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size]
+    terrain = np.zeros((size, size))
+    for _ in range(40):
+        cy, cx = rng.uniform(0, size, 2)
+        sigma, height = rng.uniform(5, 30), rng.uniform(-5, 5)
+        terrain += height * np.exp(
+            -((y - cy) ** 2 + (x - cx) ** 2) / (2 * sigma**2)
+        )
+    return terrain
+
+
+def _coarsen(array, factor):
+    size = array.shape[0] // factor
+    blocks = array[: size * factor, : size * factor].reshape(
+        size, factor, size, factor
+    )
+    return np.nanmean(blocks, axis=(1, 3))
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+def test_align_levels_recovers_known_shift():
+    dem = _terrain()
+    uas = rd._shift_array(dem, -6, 4) + 1.5
+
+    def read_level(level):
+        scale = 2**level
+        return _coarsen(uas, scale), _coarsen(dem, scale), scale, scale
+
+    rows, cols, offset, peak = rd._align_levels(read_level, 3, 2)
+    assert rows == pytest.approx(6, abs=0.1)
+    assert cols == pytest.approx(-4, abs=0.1)
+    assert offset == pytest.approx(1.5, abs=0.01)
+    assert peak > 0.5
+
+
+def test_progressive_morphological_filter_drops_objects():
+    y, x = np.mgrid[0:60, 0:60]
+    # Slope and a smooth hill, with a building and a tree cell on it.
+    # Each opening is compared with the previous one, so the hill top
+    # cut by the larger windows stays ground.
+    ground = 0.05 * x + 0.02 * y
+    ground += 3 * np.exp(-((x - 15) ** 2 + (y - 40) ** 2) / (2 * 8**2))
+    z = ground.copy()
+    z[20:32, 25:37] += 8.0
+    z[45, 50] += 3.0
+    mask = rd._progressive_morphological_filter(z, cell=1.0, max_window=20)
+    objects = np.zeros(z.shape, dtype=bool)
+    objects[20:32, 25:37] = True
+    objects[45, 50] = True
+    assert not mask[objects].any()
+    assert mask[~objects].all()
+
+
+def test_content_hash_covers_null_file_and_reclass_base(
+    tmp_path, monkeypatch
+):
+    mapset = tmp_path / "PERMANENT"
+    for element in ("cellhd", "fcell", "cell_misc/dem"):
+        (mapset / element).mkdir(parents=True)
+    (mapset / "cellhd" / "dem").write_text("proj: 99\n")
+    (mapset / "fcell" / "dem").write_bytes(b"data")
+    (mapset / "cell_misc" / "dem" / "null").write_bytes(b"\x00")
+    (mapset / "cellhd" / "classes").write_text(
+        "reclass\nname: dem\nmapset: PERMANENT\n"
+    )
+
+    def find_file(name, element):
+        base = name.split("@")[0]
+        path = mapset / element / base
+        if not path.exists():
+            return {"name": "", "file": ""}
+        return {"name": base, "file": str(path)}
+
+    grass = _FakeGrass()
+    grass.find_file = find_file
+    monkeypatch.setattr(rd, "_GRASS_SCRIPT", grass)
+    pipeline = rd.Pipeline([], provenance=str(tmp_path / "p.json"))
+    dem, classes = (
+        pipeline.content_hash("dem"), pipeline.content_hash("classes")
+    )
+    assert pipeline.content_hash("missing") is None
+    (mapset / "cell_misc" / "dem" / "null").write_bytes(b"\x00\x01")
+    assert pipeline.content_hash("dem") != dem
+    assert pipeline.content_hash("classes") != classes